@@ -0,0 +1,133 @@
+"""Admission control of client hellos
+
+When a connection node or its load balancer restarts, every client it served
+reconnects and sends its hello at once. Registering each of them right away
+throttles the router table, and the throttled hellos are retried by clients
+that only make the storm worse. :class:`HelloAdmission` instead runs a
+limited number of registrations at a time and queues the rest. The limit is
+an :class:`~autopush.retry.AIMDLimit` that backs off when registrations are
+throttled or slower than a latency target, and hellos queued too long are
+rejected so their clients back off.
+
+"""
+from collections import OrderedDict
+from functools import partial
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.python.failure import Failure
+
+from autopush.exceptions import AdmissionRejected
+from autopush.retry import AIMDLimit
+
+
+class HelloAdmission(object):
+    """Limits the hello registrations in flight, queueing the others"""
+    def __init__(self, metrics, max_concurrency=50, min_concurrency=1,
+                 max_queue=10000, queue_timeout=30, latency_target=1.0,
+                 clock=None):
+        """Create a new HelloAdmission
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param max_concurrency: Most registrations in flight, the adaptive
+                                limit never exceeds this.
+        :param min_concurrency: Fewest registrations in flight the limit
+                                backs off to.
+        :param max_queue: Most hellos waiting, further hellos are rejected
+                          immediately.
+        :param queue_timeout: Seconds a hello may wait before it's rejected.
+        :param latency_target: Seconds a registration may take before the
+                               limit backs off as if it was throttled.
+        :param clock: ``IReactorTime`` provider for the queue timeouts, the
+                      reactor by default.
+
+        """
+        self.metrics = metrics
+        self.limit = AIMDLimit(max_concurrency, minimum=min_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_target = latency_target
+        self.clock = clock or reactor
+        # Deferred -> (run, queued at, timeout call), oldest first
+        self.waiting = OrderedDict()
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def call(self, func, *args, **kwargs):
+        """Run a hello's registration once it's admitted
+
+        :param func: Callable starting the registration, and returning a
+                     deferred.
+        :returns: A deferred firing with the result of ``func``, or failing
+                  with :exc:`~autopush.exceptions.AdmissionRejected` if the
+                  hello couldn't be admitted in time. Cancelling it removes
+                  a waiting hello from the queue.
+
+        """
+        if len(self.waiting) >= self.max_queue:
+            self.metrics.increment("hello.admission.rejected",
+                                   tags=["reason:queue_full"])
+            return fail(AdmissionRejected("Hello queue full"))
+
+        def cancel(d):
+            self._discard(d)
+
+        d = Deferred(canceller=cancel)
+        run = partial(func, *args, **kwargs)
+        now = self.clock.seconds()
+        if not self.waiting and self.limit.available():
+            self._run(d, run, now)
+        else:
+            self.waiting[d] = (run, now, self.clock.callLater(
+                self.queue_timeout, self._expire, d))
+        self.metrics.gauge("hello.admission.queue", len(self.waiting))
+        return d
+
+    def _start(self):
+        """Start waiting hellos while under the limit"""
+        while self.waiting and self.limit.available():
+            d, (run, queued_at, timeout) = self.waiting.popitem(last=False)
+            if timeout.active():
+                timeout.cancel()
+            self._run(d, run, queued_at)
+
+    def _run(self, d, run, queued_at):
+        now = self.clock.seconds()
+        self.metrics.timing("hello.admission.wait", now - queued_at)
+        self.limit.active += 1
+        call = maybeDeferred(run)
+        call.addBoth(self._finished, d, now)
+
+    def _finished(self, result, d, started):
+        self.limit.active -= 1
+        latency = self.clock.seconds() - started
+        throttled = (isinstance(result, Failure) and
+                     result.check(ProvisionedThroughputExceededException))
+        if throttled or latency > self.latency_target:
+            self.limit.throttled()
+            self.metrics.gauge("hello.admission.limit",
+                               int(self.limit.limit))
+        elif not isinstance(result, Failure):
+            self.limit.succeeded()
+        self._start()
+        # The hello may have been cancelled while it registered
+        if d.called:
+            return
+        d.callback(result)
+
+    def _discard(self, d):
+        """Remove a waiting hello from the queue"""
+        entry = self.waiting.pop(d, None)
+        if entry is not None and entry[2].active():
+            entry[2].cancel()
+
+    def _expire(self, d):
+        """Reject a hello that waited out the queue timeout"""
+        if self.waiting.pop(d, None) is None:
+            return
+        self.metrics.increment("hello.admission.rejected",
+                               tags=["reason:timeout"])
+        d.errback(AdmissionRejected("Hello queue timeout"))
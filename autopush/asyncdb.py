@@ -0,0 +1,584 @@
+"""Non-blocking DynamoDB access on the Twisted reactor
+
+:class:`AsyncDynamoDBConnection` sends DynamoDB requests with a Twisted
+:class:`~twisted.web.client.Agent` instead of a blocking boto connection, so
+database calls don't each need a reactor threadpool thread.
+
+:class:`AsyncStorage`, :class:`AsyncMessage` and :class:`AsyncRouter` mirror
+the methods of :class:`~autopush.db.Storage`, :class:`~autopush.db.Message`
+and :class:`~autopush.db.Router` but return deferreds. They're attached to
+the synchronous objects as their ``async_db`` twin, and :func:`db_call` uses
+the twin when there is one.
+
+"""
+import json
+import time
+import uuid
+from StringIO import StringIO
+
+from boto.dynamodb2 import exceptions
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ItemNotFound,
+    ProvisionedThroughputExceededException,
+)
+from boto.dynamodb2.items import Item
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.dynamodb2.table import FILTER_OPERATORS, QUERY_OPERATORS
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks,
+    maybeDeferred,
+    returnValue,
+    succeed,
+)
+from twisted.internet.threads import deferToThread
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from autopush.db import (
+    BATCH_SIZE,
+    generate_last_connect,
+    hasher,
+    normalize_id,
+)
+
+
+def async_method(func):
+    """Return the method of the same name on the ``async_db`` twin of the
+    object ``func`` is bound to, or None when there isn't one"""
+    twin = getattr(getattr(func, "__self__", None), "async_db", None)
+    return getattr(twin, getattr(func, "__name__", ""), None)
+
+
+def db_call(func, *args, **kwargs):
+    """Call a table abstraction method without blocking the reactor
+
+    When ``func`` has an :func:`async_method`, that method is called
+    directly. Otherwise ``func`` is run in the reactor threadpool.
+
+    :returns: A deferred firing with the method's result.
+
+    """
+    method = async_method(func)
+    if method is not None:
+        return maybeDeferred(method, *args, **kwargs)
+    return deferToThread(func, *args, **kwargs)
+
+
+def _conditional_failed(fail, result=False):
+    """Errback returning ``result`` when a conditional write failed"""
+    fail.trap(ConditionalCheckFailedException)
+    return result
+
+
+class AsyncDynamoDBConnection(DynamoDBConnection):
+    """DynamoDB connection whose requests return deferreds
+
+    Requests are signed by boto as usual and sent over a persistent
+    :class:`~twisted.web.client.HTTPConnectionPool`. Every low level
+    operation, such as :meth:`get_item` or :meth:`update_item`, returns a
+    deferred firing with the decoded JSON response, or failing with the same
+    exceptions boto raises. Throughput errors are not retried.
+
+    """
+    def __init__(self, agent=None, max_connections=50, **kwargs):
+        """Create a new AsyncDynamoDBConnection
+
+        :param agent: Optional :class:`~twisted.web.client.Agent` to send
+                      requests with.
+        :param max_connections: Persistent connections kept to DynamoDB when
+                                no agent is given.
+
+        Other ``kwargs`` are passed to
+        :class:`~boto.dynamodb2.layer1.DynamoDBConnection`.
+
+        """
+        DynamoDBConnection.__init__(self, **kwargs)
+        if agent is None:
+            pool = HTTPConnectionPool(reactor)
+            pool.maxPersistentPerHost = max_connections
+            agent = Agent(reactor, connectTimeout=5, pool=pool)
+        self.agent = agent
+        self.faults = dict(self._faults,
+                           ValidationException=exceptions.ValidationException)
+
+    def make_request(self, action, body):
+        headers = {
+            'X-Amz-Target': '%s.%s' % (self.TargetPrefix, action),
+            'Host': self.host,
+            'Content-Type': 'application/x-amz-json-1.0',
+        }
+        http_request = self.build_base_http_request(
+            method='POST', path='/', auth_path='/', params={},
+            headers=headers, data=body, host=self.host)
+        http_request.authorize(connection=self)
+        url = "%s://%s:%s/" % (self.protocol, self.host, self.port)
+        d = self.agent.request(
+            "POST",
+            url,
+            Headers({k: [v] for k, v in http_request.headers.items()}),
+            FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._read_response)
+        return d
+
+    def _read_response(self, response):
+        d = readBody(response)
+        d.addCallback(self._decode_response, response.code, response.phrase)
+        return d
+
+    def _decode_response(self, body, code, phrase):
+        data = json.loads(body) if body else {}
+        if code == 200:
+            return data
+        fault_name = data.get("__type", "").split("#")[-1]
+        exception_class = self.faults.get(fault_name, self.ResponseError)
+        raise exception_class(code, phrase, body=data)
+
+
+class AsyncTable(object):
+    """Common base of the asynchronous table abstractions"""
+    def __init__(self, sync, connection):
+        """Create an asynchronous twin of a table abstraction
+
+        :param sync: The :class:`~autopush.db.Storage`,
+                     :class:`~autopush.db.Message` or
+                     :class:`~autopush.db.Router` object to mirror.
+        :param connection: :class:`AsyncDynamoDBConnection` object.
+
+        """
+        self.sync = sync
+        self.table = sync.table
+        self.metrics = sync.metrics
+        self.conn = connection
+        self.encode = self.table._encode_keys
+        self.decode = self.table._dynamizer.decode
+
+    def _track(self, d, name):
+        """Increment a metric when a request exceeds the provisioned
+        throughput, matching :func:`~autopush.db.track_provisioned`"""
+        def check(fail):
+            if fail.check(ProvisionedThroughputExceededException):
+                self.metrics.increment("error.provisioned.%s" % name)
+            return fail
+        d.addErrback(check)
+        return d
+
+    def _item(self, raw):
+        """Decode a raw DynamoDB item"""
+        return Item(self.table, data={k: self.decode(v)
+                                      for k, v in raw.items()})
+
+    def _encode_item(self, data):
+        """Encode an item, skipping values DynamoDB can't store"""
+        return Item(self.table, data=data).prepare_full()
+
+    @inlineCallbacks
+    def _query(self, limit=None, attributes=None, **filters):
+        """Run a consistent query, following pages up to ``limit`` items"""
+        key_conditions = self.table._build_filters(filters,
+                                                   using=QUERY_OPERATORS)
+        items = []
+        start_key = None
+        while True:
+            result = yield self.conn.query(
+                self.table.table_name,
+                key_conditions=key_conditions,
+                attributes_to_get=attributes,
+                limit=limit - len(items) if limit else None,
+                consistent_read=True,
+                exclusive_start_key=start_key,
+            )
+            items.extend(self._item(x) for x in result.get("Items", []))
+            start_key = result.get("LastEvaluatedKey")
+            if not start_key or (limit and len(items) >= limit):
+                returnValue(items)
+
+    def _delete_item(self, expected=None, **key):
+        """Delete an item, returning False if ``expected`` didn't match"""
+        d = self.conn.delete_item(
+            self.table.table_name,
+            self.encode(key),
+            expected=self.table._build_filters(expected,
+                                               using=FILTER_OPERATORS),
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(_conditional_failed)
+        return d
+
+
+class AsyncStorage(AsyncTable):
+    """Asynchronous twin of :class:`~autopush.db.Storage`"""
+    def fetch_notifications(self, uaid):
+        return self._track(self._query(uaid__eq=hasher(uaid), chid__gt=" "),
+                           "fetch_notifications")
+
+    def save_notification(self, uaid, chid, version):
+        d = self.conn.put_item(
+            self.table.table_name,
+            item=self.encode(dict(uaid=hasher(uaid),
+                                  chid=normalize_id(chid),
+                                  version=version)),
+            condition_expression="attribute_not_exists(version) or "
+                                 "version < :ver",
+            expression_attribute_values={
+                ":ver": {'N': str(version)}
+            }
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(_conditional_failed)
+        return self._track(d, "save_notification")
+
+    def delete_notification(self, uaid, chid, version=None):
+        expected = {"version__eq": version} if version else None
+        d = self._delete_item(expected, uaid=hasher(uaid),
+                              chid=normalize_id(chid))
+        d.addCallback(lambda _: True)
+
+        def provisioned(fail):
+            fail.trap(ProvisionedThroughputExceededException)
+            self.metrics.increment("error.provisioned.delete_notification")
+            return False
+        d.addErrback(provisioned)
+        return d
+
+
+class AsyncMessage(AsyncTable):
+    """Asynchronous twin of :class:`~autopush.db.Message`"""
+    def _update_channels(self, uaid, expr, channel_id, **kwargs):
+        self.sync._invalidate_channels(uaid)
+        return self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": hasher(uaid), "chidmessageid": " "}),
+            update_expression=expr,
+            expression_attribute_values=self.encode({
+                ":channel_id": set([normalize_id(channel_id)])}),
+            **kwargs
+        )
+
+    def register_channel(self, uaid, channel_id):
+        d = self._update_channels(uaid, "ADD chids :channel_id", channel_id)
+        d.addCallback(lambda _: True)
+        return self._track(d, "register_channel")
+
+    def unregister_channel(self, uaid, channel_id, **kwargs):
+        d = self._update_channels(uaid, "DELETE chids :channel_id",
+                                  channel_id, return_values="UPDATED_OLD")
+
+        def removed(result):
+            chids = result.get('Attributes', {}).get('chids', {})
+            return bool(chids) and channel_id in self.decode(chids)
+        d.addCallback(removed)
+        return self._track(d, "unregister_channel")
+
+    def all_channels(self, uaid):
+        d = self.conn.get_item(
+            self.table.table_name,
+            self.encode({"uaid": hasher(uaid), "chidmessageid": " "}),
+            consistent_read=True,
+        )
+
+        def channels(result):
+            if "Item" not in result:
+                return False, set([])
+            chids = self._item(result["Item"])["chids"] or set([])
+            self.sync._cache_channels(uaid, chids)
+            return True, chids
+        d.addCallback(channels)
+        return self._track(d, "all_channels")
+
+    def has_channel(self, uaid, channel_id):
+        try:
+            chid = normalize_id(channel_id)
+        except ValueError:
+            return succeed(False)
+        if self.sync._channel_cached(uaid, chid):
+            return succeed(True)
+
+        def registered(result):
+            exists, chids = result
+            return exists and chid in set(normalize_id(x) for x in chids)
+        d = self.all_channels(uaid)
+        d.addCallback(registered)
+        return d
+
+    def save_channels(self, uaid, channels):
+        self.sync._invalidate_channels(uaid)
+        d = self.conn.put_item(self.table.table_name, self._encode_item(dict(
+            uaid=hasher(uaid),
+            chidmessageid=" ",
+            chids=channels
+        )))
+        d.addCallback(lambda _: None)
+        return self._track(d, "save_channels")
+
+    def store_message(self, uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None):
+        item = self.sync._message_item(uaid, channel_id, message_id, ttl,
+                                       data, headers, timestamp)
+        d = self.conn.put_item(self.table.table_name,
+                               self._encode_item(item))
+        d.addCallback(lambda _: True)
+        return self._track(d, "store_message")
+
+    def store_messages(self, uaid, messages):
+        requests = [
+            {"PutRequest": {"Item": self._encode_item(
+                self.sync._message_item(uaid, **x))}}
+            for x in messages
+        ]
+        d = self._batch_write(requests)
+        d.addCallback(lambda _: True)
+        return self._track(d, "store_messages")
+
+    def update_message(self, uaid, channel_id, message_id, ttl, data=None,
+                       headers=None, timestamp=None):
+        item = dict(
+            ttl=ttl,
+            timestamp=timestamp or int(time.time()),
+            updateid=uuid.uuid4().hex
+        )
+        expr = "SET #tl=:ttl, #ts=:timestamp, updateid=:updateid"
+        if data:
+            item["headers"] = headers
+            item["data"] = data
+            expr += ", #dd=:data, headers=:headers"
+        else:
+            expr += " REMOVE #dd, headers"
+        chidmessageid = "%s:%s" % (normalize_id(channel_id), message_id)
+        d = self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": hasher(uaid),
+                         "chidmessageid": chidmessageid}),
+            condition_expression="attribute_exists(updateid)",
+            update_expression=expr,
+            expression_attribute_names={"#tl": "ttl",
+                                        "#ts": "timestamp",
+                                        "#dd": "data"},
+            expression_attribute_values=self.encode(
+                {":%s" % k: v for k, v in item.items()}),
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(_conditional_failed)
+        return self._track(d, "update_message")
+
+    def delete_message(self, uaid, channel_id, message_id, updateid=None):
+        expected = {"updateid__eq": updateid} if updateid else None
+        d = self._delete_item(
+            expected,
+            uaid=hasher(uaid),
+            chidmessageid="%s:%s" % (normalize_id(channel_id), message_id))
+        return self._track(d, "delete_message")
+
+    def delete_message_batch(self, messages):
+        keys, request_items = self.sync._delete_batch_request(messages)
+        d = self.conn.batch_write_item(request_items)
+        d.addCallback(lambda result: self.sync._delete_batch_unprocessed(
+            keys, result))
+        return self._track(d, "delete_message_batch")
+
+    def delete_messages(self, uaid, chidmessageids):
+        return self._batch_write([
+            {"DeleteRequest": {"Key": self.encode(
+                dict(uaid=hasher(uaid), chidmessageid=x))}}
+            for x in chidmessageids if x
+        ])
+
+    @inlineCallbacks
+    def _batch_write(self, requests):
+        """Send write requests with BatchWriteItem calls, resending any left
+        unprocessed"""
+        while requests:
+            batch, requests = requests[:BATCH_SIZE], requests[BATCH_SIZE:]
+            result = yield self.conn.batch_write_item(
+                {self.table.table_name: batch})
+            requests.extend(result.get("UnprocessedItems", {}).get(
+                self.table.table_name, []))
+
+    @inlineCallbacks
+    def _delete_matching(self, uaid, **filters):
+        """Delete the messages of a uaid matching a sort key filter"""
+        results = yield self._query(uaid__eq=hasher(uaid),
+                                    attributes=("chidmessageid",),
+                                    **filters)
+        chidmessageids = [x["chidmessageid"] for x in results]
+        if chidmessageids:
+            yield self.delete_messages(uaid, chidmessageids)
+        returnValue(len(chidmessageids) > 0)
+
+    def delete_messages_for_channel(self, uaid, channel_id):
+        return self._track(self._delete_matching(
+            uaid, chidmessageid__beginswith="%s:" % normalize_id(channel_id)),
+            "delete_messages_for_channel")
+
+    def delete_user(self, uaid):
+        self.sync._invalidate_channels(uaid)
+        d = self._delete_matching(uaid, chidmessageid__gte=" ")
+        d.addCallback(lambda _: None)
+        return self._track(d, "delete_user")
+
+    def fetch_messages(self, uaid, limit=10):
+        return self._track(self._query(uaid__eq=hasher(uaid),
+                                       chidmessageid__gt=" ",
+                                       limit=limit),
+                           "fetch_messages")
+
+
+class AsyncRouter(AsyncTable):
+    """Asynchronous twin of :class:`~autopush.db.Router`"""
+    def get_uaid(self, uaid, use_cache=True):
+        huaid = hasher(uaid)
+        if use_cache:
+            item = self.sync._cached_item(huaid)
+            if item is not None:
+                return succeed(item)
+        d = self.conn.get_item(self.table.table_name,
+                               self.encode({"uaid": huaid}),
+                               consistent_read=True)
+
+        def found(result):
+            if "Item" not in result:
+                raise ItemNotFound("uaid not found")
+            item = self._item(result["Item"])
+            if item.keys() == ['uaid']:
+                # Incomplete record, drop it.
+                d = self.drop_user(uaid)
+                d.addCallback(self._not_found)
+                return d
+            self.sync._cache_item(huaid, item)
+            return item
+        d.addCallback(found)
+        return self._track(d, "get_uaid")
+
+    def _not_found(self, result):
+        raise ItemNotFound("uaid not found")
+
+    def register_user(self, data):
+        # Work on a copy so the call can be retried with the same data
+        data = dict(data)
+        huaid = hasher(data.pop("uaid"))
+        self.sync.invalidate(huaid)
+        d = self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": huaid}),
+            update_expression="SET " + ", ".join(
+                ["%s=:%s" % (x, x) for x in data.keys()]),
+            condition_expression="""(
+                attribute_not_exists(router_type) or
+                (router_type = :router_type)
+            ) and (
+                attribute_not_exists(node_id) or
+                (connected_at < :connected_at)
+            )""",
+            expression_attribute_values=self.encode(
+                {":%s" % k: v for k, v in data.items()}),
+            return_values="ALL_OLD",
+        )
+
+        def registered(result):
+            old = {k: self.decode(v)
+                   for k, v in result.get("Attributes", {}).items()}
+            return (True, old, data)
+        d.addCallback(registered)
+        d.addErrback(_conditional_failed, (False, {}, data))
+        return self._track(d, "register_user")
+
+    def _update(self, uaid_hash, **kwargs):
+        d = self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": uaid_hash}),
+            update_expression="SET " + ", ".join(
+                ["%s=:%s" % (x, x) for x in kwargs.keys()]),
+            expression_attribute_values=self.encode(
+                {":%s" % k: v for k, v in kwargs.items()}),
+        )
+        d.addCallback(lambda _: True)
+        return d
+
+    def update_last_connect(self, uaid):
+        return self._track(self._update(
+            uaid, last_connect=generate_last_connect()),
+            "update_last_connect")
+
+    def drop_user(self, uaid):
+        huaid = hasher(uaid)
+        self.sync.invalidate(huaid)
+        return self._track(self._delete_item({"uaid__eq": huaid},
+                                             uaid=huaid),
+                           "drop_user")
+
+    def update_message_month(self, uaid, month):
+        huaid = hasher(uaid)
+        self.sync.invalidate(huaid)
+        return self._track(self._update(
+            huaid, current_month=month,
+            last_connect=generate_last_connect()),
+            "update_message_month")
+
+    def mark_messages_stored(self, uaid):
+        huaid = hasher(uaid)
+        self.sync.invalidate(huaid)
+        d = self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": huaid}),
+            update_expression="SET messages_stored_at=:stored_at",
+            condition_expression="attribute_exists(uaid)",
+            expression_attribute_values=self.encode({
+                ":stored_at": int(time.time() * 1000)}),
+            return_values="ALL_NEW",
+        )
+
+        def marked(result):
+            item = self._item(result["Attributes"])
+            self.sync._cache_item(huaid, item)
+            return item
+        d.addCallback(marked)
+        d.addErrback(_conditional_failed, None)
+        return self._track(d, "mark_messages_stored")
+
+    def clear_messages_stored(self, uaid, stored_at):
+        huaid = hasher(uaid)
+        self.sync.invalidate(huaid)
+        values = {":cleared": 0}
+        if stored_at is None:
+            cond = ("attribute_exists(uaid) and "
+                    "attribute_not_exists(messages_stored_at)")
+        else:
+            cond = "messages_stored_at = :stored_at"
+            values[":stored_at"] = stored_at
+        d = self.conn.update_item(
+            self.table.table_name,
+            self.encode({"uaid": huaid}),
+            update_expression="SET messages_stored_at=:cleared",
+            condition_expression=cond,
+            expression_attribute_values=self.encode(values),
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(_conditional_failed, False)
+        return self._track(d, "clear_messages_stored")
+
+    def clear_node(self, item):
+        # Pop out the node_id, leaving the caller's item as is for retries
+        item = dict(item)
+        node_id = item.pop("node_id")
+        self.sync.invalidate(item["uaid"])
+
+        d = self.conn.put_item(
+            self.table.table_name,
+            item=self.encode(item),
+            condition_expression="(node_id = :node) and "
+                                 "(connected_at = :conn)",
+            expression_attribute_values=self.encode({
+                ":node": node_id,
+                ":conn": item["connected_at"],
+            }),
+        )
+        d.addCallback(lambda _: True)
+        d.addErrback(_conditional_failed)
+        return self._track(d, "clear_node")
@@ -0,0 +1,415 @@
+"""Node-wide batching of DynamoDB writes and internal routing requests
+
+Connection nodes issue a large number of small, independent writes. These
+helpers gather them across all connections for a short interval and flush
+them with DynamoDB's batch operations, or drop the redundant ones, instead.
+Endpoint nodes likewise gather the notifications they route to each
+connection node into bulk requests.
+
+"""
+import json
+from collections import OrderedDict, namedtuple
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.logger import Logger
+from twisted.web.client import FileBodyProducer, readBody
+
+from autopush.asyncdb import db_call
+from autopush.db import BATCH_SIZE
+from autopush.protocol import IgnoreBody
+from autopush.scheduler import BACKGROUND
+
+
+class AckDeleteBatcher(object):
+    """Coalesces webpush ack deletes into BatchWriteItem calls
+
+    Deletes are collected per :class:`~autopush.db.Message` table for
+    ``interval`` seconds, then flushed in batches of up to 25. Unprocessed
+    items and failed batches are queued again, so every delete is retried
+    until it succeeds. With a :class:`~autopush.retry.RetryPolicy` they're
+    queued after its backoff and within its budget, otherwise for the next
+    flush.
+
+    """
+    log = Logger()
+
+    def __init__(self, metrics, interval=0.005, scheduler=None, retry=None):
+        """Create a new AckDeleteBatcher
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param interval: Seconds to gather deletes before flushing them.
+        :param scheduler: Optional :class:`~autopush.scheduler.DBScheduler`
+                          to run the batches in its background class.
+        :param retry: Optional :class:`~autopush.retry.RetryPolicy` pacing
+                      the retries of unprocessed and failed deletes.
+
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.scheduler = scheduler
+        self.retry = retry
+        # Message table -> OrderedDict of message key -> [Deferred, ...]
+        self._pending = OrderedDict()
+        # Message key -> retries so far
+        self._attempts = {}
+        self._flush_call = None
+
+    def delete(self, message, uaid, channel_id, message_id):
+        """Queue a message delete
+
+        :param message: The :class:`~autopush.db.Message` table holding the
+                        message.
+        :returns: A deferred that fires once the message has been deleted.
+
+        """
+        d = Deferred()
+        self._queue(message, (uaid, channel_id, message_id), [d])
+        return d
+
+    def _queue(self, message, key, defers, retry=False):
+        """Add deferreds waiting on a message key and schedule a flush
+
+        Retried keys always wait for the next scheduled flush, so a failing
+        table is not hammered in a tight loop.
+
+        """
+        pending = self._pending.setdefault(message, OrderedDict())
+        pending.setdefault(key, []).extend(defers)
+        if not retry and len(pending) >= BATCH_SIZE:
+            self._flush_table(message)
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        """Send every queued delete to DynamoDB"""
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        for message in self._pending.keys():
+            self._flush_table(message)
+
+    def _flush_table(self, message):
+        """Send all queued deletes for a table in batches"""
+        pending = self._pending.pop(message, {})
+        keys = pending.keys()
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = OrderedDict((key, pending[key])
+                                for key in keys[i:i + BATCH_SIZE])
+            self.metrics.increment("ack_batch.flush")
+            self.metrics.gauge("ack_batch.size", len(batch))
+            if self.scheduler is not None:
+                d = self.scheduler.call(BACKGROUND,
+                                        message.delete_message_batch,
+                                        batch.keys())
+            else:
+                d = db_call(message.delete_message_batch, batch.keys())
+            d.addCallback(self._batch_done, message, batch)
+            d.addErrback(self._batch_failed, message, batch)
+
+    def _batch_done(self, unprocessed, message, batch):
+        """Fire the deferreds of deleted messages, requeue the rest"""
+        unprocessed = set(unprocessed)
+        if unprocessed:
+            self.metrics.increment("ack_batch.unprocessed", len(unprocessed))
+        retries = []
+        for key, defers in batch.items():
+            if key in unprocessed:
+                retries.append((key, defers))
+                continue
+            self._attempts.pop(key, None)
+            for d in defers:
+                d.callback(True)
+        if retries:
+            self._retry(message, retries)
+
+    def _batch_failed(self, fail, message, batch):
+        """Log the failure and requeue the whole batch"""
+        self.log.failure("Failed to delete batch", fail)
+        self.metrics.increment("ack_batch.error")
+        self._retry(message, batch.items())
+
+    def _retry(self, message, items):
+        """Requeue message keys and their deferreds once the retry policy
+        allows"""
+        if self.retry is None:
+            self._requeue(message, items)
+            return
+        attempt = max(self._attempts.get(key, 0) for key, _ in items)
+        for key, _ in items:
+            self._attempts[key] = attempt + 1
+        self.retry.retry_later(message.delete_message_batch, attempt,
+                               self._requeue, message, items)
+
+    def _requeue(self, message, items):
+        for key, defers in items:
+            self._queue(message, key, defers, retry=True)
+
+
+class RouterUpdateBatcher(object):
+    """Write-behind buffer of router ``last_connect`` and
+    ``current_month`` updates
+
+    Updates are deduplicated per UAID while pending, a ``current_month``
+    update also writes ``last_connect`` so it replaces a pending
+    ``last_connect`` update. Every ``interval`` seconds at most
+    ``max_writes * interval`` updates are written, ``current_month``
+    updates first as clients wait on them during message table rotation.
+    Failed updates are queued again.
+
+    """
+    log = Logger()
+
+    def __init__(self, metrics, router, max_writes=100, interval=0.05,
+                 scheduler=None):
+        """Create a new RouterUpdateBatcher
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param router: The :class:`~autopush.db.Router` to update.
+        :param max_writes: Most updates written a second.
+        :param interval: Seconds between writes of pending updates.
+        :param scheduler: Optional :class:`~autopush.scheduler.DBScheduler`
+                          to run the updates in its background class.
+
+        """
+        self.metrics = metrics
+        self.router = router
+        self.interval = interval
+        self.per_flush = max(1, int(max_writes * interval))
+        self.scheduler = scheduler
+        # uaid -> (month, [Deferred, ...])
+        self._months = OrderedDict()
+        # uaid -> [Deferred, ...]
+        self._connects = OrderedDict()
+        self._flush_call = None
+
+    def __len__(self):
+        return len(self._months) + len(self._connects)
+
+    def update_last_connect(self, uaid):
+        """Queue a ``last_connect`` update
+
+        :returns: A deferred that fires once the update has been written.
+
+        """
+        d = Deferred()
+        if uaid in self._months:
+            self._months[uaid][1].append(d)
+        else:
+            self._connects.setdefault(uaid, []).append(d)
+        self._schedule()
+        return d
+
+    def update_message_month(self, uaid, month):
+        """Queue a ``current_month`` and ``last_connect`` update
+
+        :returns: A deferred that fires once the update has been written.
+
+        """
+        d = Deferred()
+        self._queue_month(uaid, month, [d])
+        self._schedule()
+        return d
+
+    def _queue_month(self, uaid, month, defers):
+        defers = self._connects.pop(uaid, []) + defers
+        if uaid in self._months:
+            defers = self._months[uaid][1] + defers
+        self._months[uaid] = (month, defers)
+
+    def _schedule(self):
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        """Write the next updates within the write ceiling"""
+        self._flush_call = None
+        self.metrics.gauge("router_update.pending", len(self))
+        self._write(self.per_flush)
+        if len(self):
+            self._schedule()
+
+    def flush(self):
+        """Write every pending update, ignoring the write ceiling
+
+        :returns: A deferred that fires once the writes have finished.
+
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        return DeferredList(self._write(len(self)), consumeErrors=True)
+
+    def _write(self, count):
+        writes = []
+        while count > 0 and self._months:
+            uaid, (month, defers) = self._months.popitem(last=False)
+            writes.append(self._call(
+                self.router.update_message_month, (uaid, month),
+                defers, self._month_failed, uaid, month))
+            count -= 1
+        while count > 0 and self._connects:
+            uaid, defers = self._connects.popitem(last=False)
+            writes.append(self._call(
+                self.router.update_last_connect, (uaid,),
+                defers, self._connect_failed, uaid))
+            count -= 1
+        if writes:
+            self.metrics.increment("router_update.write", len(writes))
+        return writes
+
+    def _call(self, func, args, defers, errback, *errback_args):
+        if self.scheduler is not None:
+            d = self.scheduler.call(BACKGROUND, func, *args)
+        else:
+            d = db_call(func, *args)
+        d.addCallback(self._written, defers)
+        d.addErrback(errback, defers, *errback_args)
+        return d
+
+    def _written(self, result, defers):
+        for d in defers:
+            # Skip deferreds cancelled by their connection closing
+            if not d.called:
+                d.callback(result)
+
+    def _month_failed(self, fail, defers, uaid, month):
+        """Log the failure and queue the update again, unless a newer month
+        was queued meanwhile"""
+        self.log.failure("Failed to update router", fail)
+        self.metrics.increment("router_update.error")
+        if uaid in self._months:
+            self._months[uaid][1].extend(defers)
+        else:
+            self._queue_month(uaid, month, defers)
+        self._schedule()
+
+    def _connect_failed(self, fail, defers, uaid):
+        self.log.failure("Failed to update router", fail)
+        self.metrics.increment("router_update.error")
+        if uaid in self._months:
+            self._months[uaid][1].extend(defers)
+        else:
+            self._connects.setdefault(uaid, []).extend(defers)
+        self._schedule()
+
+
+# Result of a notification routed in a bulk request, in place of the
+# response to its own request
+BulkResult = namedtuple("BulkResult", ["code"])
+
+
+class PushBatcher(object):
+    """Gathers the notifications routed to each connection node into bulk
+    requests
+
+    Notifications for a node are collected for ``interval`` seconds, or
+    until ``max_batch`` are waiting, then sent in a single ``POST`` to the
+    node's ``/push`` endpoint. Its reply holds the status of each
+    notification, so each can fall back to storage on its own. Nodes
+    without the bulk endpoint get each notification sent separately.
+
+    """
+    log = Logger()
+
+    def __init__(self, metrics, agent, interval=0.001, max_batch=100):
+        """Create a new PushBatcher
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param agent: HTTP agent for the requests.
+        :param interval: Seconds to gather notifications for a node.
+        :param max_batch: Most notifications sent in a single request.
+
+        """
+        self.metrics = metrics
+        self.agent = agent
+        self.interval = interval
+        self.max_batch = max_batch
+        # node_id -> [(uaid, payload, Deferred), ...]
+        self._pending = OrderedDict()
+        self._flush_call = None
+
+    def send(self, node_id, uaid, payload):
+        """Queue a notification for a connected client
+
+        :param payload: JSON serializable notification for the node's
+                        ``/push/<uaid>`` endpoint.
+        :returns: A deferred firing with a :class:`BulkResult` or a
+                  response, whose ``code`` is the delivery status, or
+                  failing with the error of the request.
+
+        """
+        d = Deferred()
+        pending = self._pending.setdefault(node_id, [])
+        pending.append((uaid, payload, d))
+        if len(pending) >= self.max_batch:
+            self._flush_node(node_id)
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.interval, self.flush)
+        return d
+
+    def flush(self):
+        """Send every queued notification"""
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        for node_id in self._pending.keys():
+            self._flush_node(node_id)
+
+    def _flush_node(self, node_id):
+        batch = self._pending.pop(node_id, [])
+        if not batch:
+            return
+        self.metrics.increment("router_batch.flush")
+        self.metrics.gauge("router_batch.size", len(batch))
+        body = json.dumps([dict(uaid=uaid, update=payload)
+                           for uaid, payload, _ in batch])
+        d = self.agent.request(
+            "POST",
+            (node_id + "/push").encode("utf8"),
+            bodyProducer=FileBodyProducer(StringIO(body)),
+        )
+        d.addCallback(self._batch_response, node_id, batch)
+        d.addErrback(self._batch_failed, batch)
+
+    def _batch_response(self, response, node_id, batch):
+        if response.code != 200:
+            # The node predates the bulk endpoint
+            self.metrics.increment("router_batch.unsupported")
+            d = IgnoreBody.ignore(response)
+            d.addCallback(lambda _: self._send_each(node_id, batch))
+            return d
+        d = readBody(response)
+        d.addCallback(self._batch_results, batch)
+        return d
+
+    def _batch_results(self, body, batch):
+        results = json.loads(body)["results"]
+        if len(results) != len(batch):
+            raise ValueError("Bulk push returned %d results for %d "
+                             "notifications" % (len(results), len(batch)))
+        for (uaid, payload, d), code in zip(batch, results):
+            d.callback(BulkResult(code))
+
+    def _batch_failed(self, fail, batch):
+        """Fail every notification of the batch, for each to fall back to
+        storage"""
+        self.metrics.increment("router_batch.error")
+        for _, _, d in batch:
+            if not d.called:
+                d.errback(fail)
+
+    def _send_each(self, node_id, batch):
+        for uaid, payload, d in batch:
+            url = node_id + "/push/" + uaid
+            request = self.agent.request(
+                "PUT",
+                url.encode("utf8"),
+                bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
+            )
+            request.addCallback(IgnoreBody.ignore)
+            request.chainDeferred(d)
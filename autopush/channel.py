@@ -0,0 +1,270 @@
+"""Binary channel for internal routing between nodes
+
+Internal routing requests are otherwise each sent as an HTTP request to the
+connection node, with its headers built and parsed on both sides. With a
+``channel_offset`` set, nodes instead keep a long-lived connection to each
+connection node, on its router port plus the offset, and send the same
+requests over it as length-prefixed binary frames.
+
+Requests are multiplexed on the connection, each frame carrying the ID of
+the request it belongs to. For flow control the sender keeps at most a
+window of requests waiting for their results, queueing the others until
+results come back. Nodes whose channel can't be reached are sent their
+requests over HTTP for a while instead, so connection nodes can be upgraded
+before the endpoints.
+
+Every frame follows its 4 byte length prefix with:
+
+=========  =====  ===================================================
+Field      Bytes  Content
+=========  =====  ===================================================
+request    4      ID of the request, echoed in its result
+command    1      :data:`PUSH`, :data:`CHECK`, :data:`DISCONNECT` or
+                  :data:`RESULT`
+body              A 1 byte length prefixed UAID followed by the
+                  command's arguments, or the 2 byte HTTP status of a
+                  :data:`RESULT`
+=========  =====  ===================================================
+
+"""
+import json
+import struct
+from collections import deque, namedtuple
+from urlparse import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.endpoints import (
+    SSL4ClientEndpoint,
+    TCP4ClientEndpoint,
+    connectProtocol,
+)
+from twisted.internet.ssl import optionsForClientTLS
+from twisted.logger import Logger
+from twisted.protocols.basic import Int32StringReceiver
+
+from autopush.exceptions import ChannelUnavailable
+
+# Deliver a notification, followed by its JSON
+PUSH = 1
+# Start a check of stored notifications
+CHECK = 2
+# Drop a client that connected elsewhere, followed by its connection time
+DISCONNECT = 3
+# Result of a request
+RESULT = 128
+
+HEADER = struct.Struct(">IB")
+STATUS = struct.Struct(">H")
+CONNECTED_AT = struct.Struct(">Q")
+
+# Result of a request, in place of an HTTP response
+ChannelResult = namedtuple("ChannelResult", ["code"])
+
+
+def encode_uaid(uaid):
+    """Prefix a UAID with its length for a frame body"""
+    uaid = str(uaid)
+    return chr(len(uaid)) + uaid
+
+
+def decode_uaid(body):
+    """Split the UAID off a frame body
+
+    :returns: The UAID and the rest of the body.
+
+    """
+    length = ord(body[0])
+    return body[1:length + 1], body[length + 1:]
+
+
+def http_fallback(d, func, *args):
+    """Send a channel request with ``func(*args)`` instead if its node has no
+    channel"""
+    def unavailable(failure):
+        failure.trap(ChannelUnavailable)
+        return func(*args)
+    return d.addErrback(unavailable)
+
+
+class ChannelProtocol(Int32StringReceiver):
+    """Framing shared by both ends of a channel"""
+    log = Logger()
+    MAX_LENGTH = 1024 * 1024
+
+    def stringReceived(self, frame):
+        if len(frame) < HEADER.size:
+            self.log.info("Dropping channel with a short frame")
+            self.transport.loseConnection()
+            return
+        request_id, command = HEADER.unpack_from(frame)
+        self.frameReceived(request_id, command, frame[HEADER.size:])
+
+    def frameReceived(self, request_id, command, body):
+        """Handle a frame of the channel"""
+        raise NotImplementedError()  # pragma: nocover
+
+    def sendFrame(self, request_id, command, body):
+        self.sendString(HEADER.pack(request_id, command) + body)
+
+
+class ChannelClientProtocol(ChannelProtocol):
+    """Sends requests to a connection node over its channel"""
+    def __init__(self, channels, node_id, window=100):
+        self.channels = channels
+        self.node_id = node_id
+        self.window = window
+        self._last_id = 0
+        # request ID -> Deferred
+        self._inflight = {}
+        # Requests waiting for a place in the window
+        self._waiting = deque()
+
+    def request(self, command, body):
+        """Send a request, once the window allows
+
+        :returns: A deferred firing with a :class:`ChannelResult`.
+
+        """
+        d = Deferred()
+        if len(self._inflight) < self.window:
+            self._send(command, body, d)
+        else:
+            self._waiting.append((command, body, d))
+        return d
+
+    def _send(self, command, body, d):
+        self._last_id = (self._last_id + 1) & 0xffffffff
+        self._inflight[self._last_id] = d
+        self.sendFrame(self._last_id, command, body)
+
+    def frameReceived(self, request_id, command, body):
+        d = self._inflight.pop(request_id, None)
+        if command != RESULT or d is None or len(body) != STATUS.size:
+            self.log.info("Dropping channel to {node_id} with an "
+                          "unexpected frame", node_id=self.node_id)
+            self.transport.loseConnection()
+            return
+        d.callback(ChannelResult(STATUS.unpack(body)[0]))
+        if self._waiting and len(self._inflight) < self.window:
+            self._send(*self._waiting.popleft())
+
+    def connectionLost(self, reason):
+        self.channels._lost(self)
+        inflight, self._inflight = self._inflight, {}
+        for d in inflight.itervalues():
+            d.errback(reason)
+        # Requests that were never sent can still go over HTTP
+        waiting, self._waiting = self._waiting, deque()
+        for _, _, d in waiting:
+            d.errback(ChannelUnavailable("Channel closed"))
+
+
+class NodeChannels(object):
+    """Channels to the connection nodes a node routes to
+
+    Each method returns a deferred firing with a :class:`ChannelResult`.
+    It fails with :exc:`~autopush.exceptions.ChannelUnavailable` when the
+    node has no channel, for the request to be sent over HTTP instead.
+
+    """
+    log = Logger()
+
+    def __init__(self, metrics, offset, window=100, retry_interval=60,
+                 connect_timeout=5, clock=None):
+        """Create a new NodeChannels
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param offset: Offset of a connection node's channel port from its
+                       router port.
+        :param window: Most requests waiting for their result on a channel.
+        :param retry_interval: Seconds to wait before connecting again to a
+                               node whose channel couldn't be reached.
+        :param connect_timeout: Seconds to wait for a channel to connect.
+        :param clock: ``IReactorTime`` provider, the reactor by default.
+
+        """
+        self.metrics = metrics
+        self.offset = offset
+        self.window = window
+        self.retry_interval = retry_interval
+        self.connect_timeout = connect_timeout
+        self.clock = clock or reactor
+        # node_id -> ChannelClientProtocol
+        self._channels = {}
+        # node_id -> [(command, body, Deferred), ...] waiting for a connect
+        self._connecting = {}
+        # node_id -> time to connect again after a failed connect
+        self._unavailable = {}
+
+    def push(self, node_id, uaid, update):
+        """Deliver a notification to a client connected to a node"""
+        return self.request(node_id, PUSH,
+                            encode_uaid(uaid) + json.dumps(update))
+
+    def check(self, node_id, uaid):
+        """Have a node check storage for a client's notifications"""
+        return self.request(node_id, CHECK, encode_uaid(uaid))
+
+    def disconnect(self, node_id, uaid, connected_at):
+        """Have a node drop a client that has connected elsewhere"""
+        return self.request(node_id, DISCONNECT,
+                            encode_uaid(uaid) +
+                            CONNECTED_AT.pack(int(connected_at)))
+
+    def request(self, node_id, command, body):
+        """Send a request to a node, connecting its channel if needed"""
+        channel = self._channels.get(node_id)
+        if channel is not None:
+            return channel.request(command, body)
+        retry_at = self._unavailable.get(node_id)
+        if retry_at is not None:
+            if retry_at > self.clock.seconds():
+                return fail(ChannelUnavailable(node_id))
+            del self._unavailable[node_id]
+        waiting = self._connecting.get(node_id)
+        if waiting is None:
+            waiting = self._connecting[node_id] = []
+            self._connect(node_id)
+        d = Deferred()
+        waiting.append((command, body, d))
+        return d
+
+    def _endpoint(self, node_id):
+        url = urlparse(node_id)
+        if url.scheme == "https":
+            port = (url.port or 443) + self.offset
+            return SSL4ClientEndpoint(
+                reactor, url.hostname, port,
+                optionsForClientTLS(unicode(url.hostname)),
+                timeout=self.connect_timeout)
+        port = (url.port or 80) + self.offset
+        return TCP4ClientEndpoint(reactor, url.hostname, port,
+                                  timeout=self.connect_timeout)
+
+    def _connect(self, node_id):
+        protocol = ChannelClientProtocol(self, node_id, self.window)
+        d = connectProtocol(self._endpoint(node_id), protocol)
+        d.addCallbacks(self._connected, self._connect_failed,
+                       errbackArgs=(node_id,))
+
+    def _connected(self, channel):
+        self.metrics.increment("channel.connect")
+        self._channels[channel.node_id] = channel
+        for command, body, d in self._connecting.pop(channel.node_id, []):
+            channel.request(command, body).chainDeferred(d)
+
+    def _connect_failed(self, failure, node_id):
+        self.log.debug("No channel to {node_id}: {failure}",
+                       node_id=node_id, failure=failure.value)
+        self.metrics.increment("channel.unavailable")
+        self._unavailable[node_id] = self.clock.seconds() + \
+            self.retry_interval
+        for _, _, d in self._connecting.pop(node_id, []):
+            d.errback(ChannelUnavailable(node_id))
+
+    def _lost(self, channel):
+        if self._channels.get(channel.node_id) is channel:
+            del self._channels[channel.node_id]
+            self.metrics.increment("channel.lost")
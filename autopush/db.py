@@ -14,13 +14,17 @@ from boto.dynamodb2.exceptions import (
     ProvisionedThroughputExceededException,
 )
 from boto.dynamodb2.fields import HashKey, RangeKey, GlobalKeysOnlyIndex
+from boto.dynamodb2.items import Item
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.types import NUMBER
+from repoze.lru import ExpiringLRUCache
 
 from autopush.utils import generate_hash
 
 key_hash = ""
+# DynamoDB's limit on the number of requests in a single BatchWriteItem
+BATCH_SIZE = 25
 TRACK_DB_CALLS = False
 DB_CALLS = []
 
@@ -227,7 +231,178 @@ def generate_last_connect():
     return int(val)
 
 
-class Storage(object):
+class IStorage(object):
+    """Simplepush notification storage interface
+
+    Implemented by :class:`Storage` for DynamoDB and by
+    :class:`autopush.memory.MemoryStorage`. UAIDs are stored under their
+    :func:`hasher` value and channel IDs under their :func:`normalize_id`
+    value.
+
+    """
+    def fetch_notifications(self, uaid):
+        """Fetch all notifications for a UAID"""
+        raise NotImplementedError("No fetch_notifications implemented")
+
+    def save_notification(self, uaid, chid, version):
+        """Save a notification if it is newer than the stored one
+
+        :returns: Whether the notification was saved.
+
+        """
+        raise NotImplementedError("No save_notification implemented")
+
+    def delete_notification(self, uaid, chid, version=None):
+        """Delete a notification, only if it is at ``version`` when given"""
+        raise NotImplementedError("No delete_notification implemented")
+
+
+class IMessage(object):
+    """Webpush message and channel storage interface for one month's table
+
+    Implemented by :class:`Message` for DynamoDB and by
+    :class:`autopush.memory.MemoryMessage`. The ``table.table_name``
+    attribute names the month the messages are stored in.
+
+    """
+    def register_channel(self, uaid, channel_id):
+        """Register a channel for a given uaid"""
+        raise NotImplementedError("No register_channel implemented")
+
+    def unregister_channel(self, uaid, channel_id, **kwargs):
+        """Remove a channel registration, returning whether it existed"""
+        raise NotImplementedError("No unregister_channel implemented")
+
+    def all_channels(self, uaid):
+        """Return a tuple of whether the uaid exists and its channel set"""
+        raise NotImplementedError("No all_channels implemented")
+
+    def has_channel(self, uaid, channel_id):
+        """Whether a channel is registered for a given uaid"""
+        raise NotImplementedError("No has_channel implemented")
+
+    def save_channels(self, uaid, channels):
+        """Replace the channel set of a uaid"""
+        raise NotImplementedError("No save_channels implemented")
+
+    def store_message(self, uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None):
+        """Store a message for the given uaid/channel"""
+        raise NotImplementedError("No store_message implemented")
+
+    def store_messages(self, uaid, messages):
+        """Store several messages for the given uaid
+
+        :param messages: List of dicts of the :meth:`store_message`
+                         arguments other than ``uaid``.
+
+        """
+        raise NotImplementedError("No store_messages implemented")
+
+    def update_message(self, uaid, channel_id, message_id, ttl, data=None,
+                       headers=None, timestamp=None):
+        """Update an existing message, returning False if it is missing"""
+        raise NotImplementedError("No update_message implemented")
+
+    def delete_message(self, uaid, channel_id, message_id, updateid=None):
+        """Delete a message, only if it is at ``updateid`` when given"""
+        raise NotImplementedError("No delete_message implemented")
+
+    def delete_message_batch(self, messages):
+        """Delete ``(uaid, channel_id, message_id)`` tuples, returning the
+        ones that should be retried"""
+        raise NotImplementedError("No delete_message_batch implemented")
+
+    def delete_messages(self, uaid, chidmessageids):
+        """Delete messages of a uaid by their sort keys"""
+        raise NotImplementedError("No delete_messages implemented")
+
+    def delete_messages_for_channel(self, uaid, channel_id):
+        """Delete all messages for a uaid/channel_id, returning whether
+        there were any"""
+        raise NotImplementedError("No delete_messages_for_channel implemented")
+
+    def delete_user(self, uaid):
+        """Delete all messages and channel info for a given uaid"""
+        raise NotImplementedError("No delete_user implemented")
+
+    def fetch_messages(self, uaid, limit=10):
+        """Fetch up to ``limit`` messages for a uaid"""
+        raise NotImplementedError("No fetch_messages implemented")
+
+
+class IRouter(object):
+    """Router record storage interface
+
+    Implemented by :class:`Router` for DynamoDB and by
+    :class:`autopush.memory.MemoryRouter`. Router items are dict-like and
+    keyed by the hashed UAID.
+
+    """
+    # Cache of router items, None if get_uaid always reads consistently
+    cache = None
+
+    def get_uaid(self, uaid, use_cache=True):
+        """Get the router item for a UAID
+
+        :raises: :exc:`ItemNotFound` if there is no record for this UAID.
+
+        """
+        raise NotImplementedError("No get_uaid implemented")
+
+    def register_user(self, data):
+        """Register a user, unless the stored record has a different
+        ``router_type`` or a newer ``connected_at`` on a node
+
+        :returns: A tuple of whether the user was registered, the previous
+                  record and the data written.
+
+        """
+        raise NotImplementedError("No register_user implemented")
+
+    def update_last_connect(self, uaid):
+        """Update the last_connect value for a user to this month"""
+        raise NotImplementedError("No update_last_connect implemented")
+
+    def drop_user(self, uaid):
+        """Delete a user, returning whether it existed"""
+        raise NotImplementedError("No drop_user implemented")
+
+    def update_message_month(self, uaid, month):
+        """Update the user's current message month and last_connect"""
+        raise NotImplementedError("No update_message_month implemented")
+
+    def mark_messages_stored(self, uaid):
+        """Flag a user's record as having messages in storage
+
+        :returns: The updated router item, or None if the user's record
+                  doesn't exist.
+
+        """
+        raise NotImplementedError("No mark_messages_stored implemented")
+
+    def clear_messages_stored(self, uaid, stored_at):
+        """Flag a user's record as having no messages in storage, if it
+        wasn't flagged again since ``stored_at`` was read
+
+        :param stored_at: The ``messages_stored_at`` value read from the
+                          record, or None if it had none.
+        :returns: Whether the flag was cleared.
+
+        """
+        raise NotImplementedError("No clear_messages_stored implemented")
+
+    def clear_node(self, item):
+        """Remove the node_id of a router item, if the stored ``node_id``
+        and ``connected_at`` still match it
+
+        :returns: Whether the node was cleared or not.
+
+        """
+        raise NotImplementedError("No clear_node implemented")
+
+
+class Storage(IStorage):
     """Create a Storage table abstraction on top of a DynamoDB Table object"""
     def __init__(self, table, metrics):
         """Create a new Storage object
@@ -301,23 +476,37 @@ class Storage(object):
             return False
 
 
-class Message(object):
+class Message(IMessage):
     """Create a Message table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    def __init__(self, table, metrics, channel_cache=None):
         """Create a new Message object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param channel_cache: Optional :class:`~repoze.lru.ExpiringLRUCache`
+                              of normalized channel sets, which may be
+                              shared by several message tables.
 
         """
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
+        self.channel_cache = channel_cache
+
+    def _channel_key(self, uaid):
+        """Key for a UAID's channels in the channel cache"""
+        return (self.table.table_name, hasher(uaid))
+
+    def _invalidate_channels(self, uaid):
+        """Drop a UAID's cached channel set"""
+        if self.channel_cache is not None:
+            self.channel_cache.invalidate(self._channel_key(uaid))
 
     @track_provisioned
     def register_channel(self, uaid, channel_id):
         """Register a channel for a given uaid"""
+        self._invalidate_channels(uaid)
         conn = self.table.connection
         db_key = self.encode({"uaid": hasher(uaid), "chidmessageid": " "})
         # Generate our update expression
@@ -335,6 +524,7 @@ class Message(object):
     @track_provisioned
     def unregister_channel(self, uaid, channel_id, **kwargs):
         """Remove a channel registration for a given uaid"""
+        self._invalidate_channels(uaid)
         conn = self.table.connection
         db_key = self.encode({"uaid": hasher(uaid), "chidmessageid": " "})
         expr = "DELETE chids :channel_id"
@@ -367,13 +557,52 @@ class Message(object):
         try:
             result = self.table.get_item(consistent=True, uaid=hasher(uaid),
                                          chidmessageid=" ")
-            return (True, result["chids"] or set([]))
+            chids = result["chids"] or set([])
         except ItemNotFound:
             return False, set([])
+        self._cache_channels(uaid, chids)
+        return True, chids
+
+    def _cache_channels(self, uaid, chids):
+        """Store a UAID's channel set in the channel cache"""
+        if self.channel_cache is not None:
+            self.channel_cache.put(self._channel_key(uaid),
+                                   frozenset(normalize_id(x) for x in chids))
+
+    def _channel_cached(self, uaid, chid):
+        """Whether a normalized channel ID is in the UAID's cached set"""
+        if self.channel_cache is None:
+            return False
+        chids = self.channel_cache.get(self._channel_key(uaid))
+        if chids is not None and chid in chids:
+            self.metrics.increment("message.channel_cache.hit")
+            return True
+        self.metrics.increment("message.channel_cache.miss")
+        return False
+
+    def has_channel(self, uaid, channel_id):
+        """Whether a channel is registered for a given uaid
+
+        Channels found in the channel cache are trusted. A channel missing
+        from a cached set may have been registered since, so the channels
+        are read again in that case.
+
+        :rtype: bool
+
+        """
+        try:
+            chid = normalize_id(channel_id)
+        except ValueError:
+            return False
+        if self._channel_cached(uaid, chid):
+            return True
+        exists, chids = self.all_channels(uaid)
+        return exists and chid in set(normalize_id(x) for x in chids)
 
     @track_provisioned
     def save_channels(self, uaid, channels):
         """Save out a set of channels"""
+        self._invalidate_channels(uaid)
         self.table.put_item(data=dict(
             uaid=hasher(uaid),
             chidmessageid=" ",
@@ -385,11 +614,25 @@ class Message(object):
                       headers=None, timestamp=None):
         """Stores a message in the message table for the given uaid/channel
         with the message id"""
+        self.table.put_item(data=self._message_item(
+            uaid, channel_id, message_id, ttl, data, headers, timestamp))
+        return True
+
+    @track_provisioned
+    def store_messages(self, uaid, messages):
+        """Stores several messages for the given uaid with BatchWriteItem
+        calls of up to 25 messages, resending any left unprocessed"""
+        with self.table.batch_write() as batch:
+            for message in messages:
+                batch.put_item(data=self._message_item(uaid, **message))
+        return True
+
+    def _message_item(self, uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None):
+        """Build the item of a stored message"""
         item = dict(
             uaid=hasher(uaid),
             chidmessageid="%s:%s" % (normalize_id(channel_id), message_id),
-            data=data,
-            headers=headers,
             ttl=ttl,
             timestamp=timestamp or int(time.time()),
             updateid=uuid.uuid4().hex
@@ -397,8 +640,7 @@ class Message(object):
         if data:
             item["headers"] = headers
             item["data"] = data
-        self.table.put_item(data=item)
-        return True
+        return item
 
     @track_provisioned
     def update_message(self, uaid, channel_id, message_id, ttl, data=None,
@@ -462,6 +704,55 @@ class Message(object):
                                          message_id))
         return True
 
+    @track_provisioned
+    def delete_message_batch(self, messages):
+        """Deletes a batch of messages with a single BatchWriteItem call
+
+        BatchWriteItem does not support conditions, so unlike
+        :meth:`delete_message` the ``updateid`` is not checked.
+
+        :param messages: List of up to 25 ``(uaid, channel_id, message_id)``
+                         tuples, with no duplicates.
+        :returns: The tuples DynamoDB left unprocessed, which should be
+                  retried.
+        :rtype: list
+
+        """
+        conn = self.table.connection
+        keys, request_items = self._delete_batch_request(messages)
+        result = conn.batch_write_item(request_items)
+        return self._delete_batch_unprocessed(keys, result)
+
+    def _delete_batch_request(self, messages):
+        """Build the BatchWriteItem request for :meth:`delete_message_batch`
+
+        :returns: A dict of the hashed message keys to the given tuples, and
+                  the request items.
+
+        """
+        keys = {}
+        requests = []
+        for uaid, channel_id, message_id in messages:
+            key = (hasher(uaid), "%s:%s" % (normalize_id(channel_id),
+                                            message_id))
+            keys[key] = (uaid, channel_id, message_id)
+            requests.append({"DeleteRequest": {"Key": self.encode(
+                dict(uaid=key[0], chidmessageid=key[1]))}})
+        return keys, {self.table.table_name: requests}
+
+    def _delete_batch_unprocessed(self, keys, result):
+        """Map the unprocessed deletes of a BatchWriteItem result back to
+        the tuples given to :meth:`delete_message_batch`"""
+        unprocessed = result.get("UnprocessedItems", {}).get(
+            self.table.table_name, [])
+        decode = self.table._dynamizer.decode
+        retry = []
+        for request in unprocessed:
+            key = request["DeleteRequest"]["Key"]
+            retry.append(keys[(decode(key["uaid"]),
+                               decode(key["chidmessageid"]))])
+        return retry
+
     def delete_messages(self, uaid, chidmessageids):
         with self.table.batch_write() as batch:
             for chidmessageid in chidmessageids:
@@ -488,6 +779,7 @@ class Message(object):
     @track_provisioned
     def delete_user(self, uaid):
         """Deletes all messages and channel info for a given uaid"""
+        self._invalidate_channels(uaid)
         results = self.table.query_2(
             uaid__eq=hasher(uaid),
             chidmessageid__gte=" ",
@@ -507,23 +799,59 @@ class Message(object):
                                        consistent=True, limit=limit))
 
 
-class Router(object):
+class Router(IRouter):
     """Create a Router table abstraction on top of a DynamoDB Table object"""
-    def __init__(self, table, metrics):
+    def __init__(self, table, metrics, cache_size=0, cache_ttl=60):
         """Create a new Router object
 
         :param table: :class:`Table` object.
         :param metrics: Metrics object that implements the
                         :class:`autopush.metrics.IMetrics` interface.
+        :param cache_size: Maximum number of router items to cache for
+                           :meth:`get_uaid`, 0 disables the cache.
+        :param cache_ttl: Seconds a cached router item remains valid.
 
         """
         self.table = table
         self.metrics = metrics
         self.encode = table._encode_keys
-
-    def get_uaid(self, uaid):
+        self.cache = None
+        if cache_size > 0:
+            self.cache = ExpiringLRUCache(cache_size,
+                                          default_timeout=cache_ttl)
+
+    def _copy_item(self, item):
+        """Return a copy of a router item that callers are free to modify"""
+        return Item(self.table, data=dict(item.items()))
+
+    def invalidate(self, uaid_hash):
+        """Drop a cached router item, given the hashed UAID"""
+        if self.cache is not None:
+            self.cache.invalidate(uaid_hash)
+
+    def _cached_item(self, uaid_hash):
+        """Return a copy of a cached router item, or None on a miss"""
+        if self.cache is None:
+            return None
+        item = self.cache.get(uaid_hash)
+        if item is None:
+            self.metrics.increment("router.cache.miss")
+            return None
+        self.metrics.increment("router.cache.hit")
+        return self._copy_item(item)
+
+    def _cache_item(self, uaid_hash, item):
+        """Store a copy of a router item in the cache"""
+        if self.cache is not None:
+            self.cache.put(uaid_hash, self._copy_item(item))
+
+    def get_uaid(self, uaid, use_cache=True):
         """Get the database record for the UAID
 
+        If the router item cache is enabled, a cached item is returned when
+        ``use_cache`` is set. Otherwise, or on a miss, a consistent read is
+        done and its result is cached.
+
         :returns: User item
         :rtype: :class:`~boto.dynamodb2.items.Item`
         :raises:
@@ -532,12 +860,18 @@ class Router(object):
             exceeds throughput.
 
         """
+        huaid = hasher(uaid)
+        if use_cache:
+            item = self._cached_item(huaid)
+            if item is not None:
+                return item
         try:
-            item = self.table.get_item(consistent=True, uaid=hasher(uaid))
+            item = self.table.get_item(consistent=True, uaid=huaid)
             if item.keys() == ['uaid']:
                 # Incomplete record, drop it.
                 self.drop_user(uaid)
                 raise ItemNotFound("uaid not found")
+            self._cache_item(huaid, item)
             return item
         except ProvisionedThroughputExceededException:
             # We unfortunately have to catch this here, as track_provisioned
@@ -567,7 +901,11 @@ class Router(object):
         """
         # Fetch a senderid for this user
         conn = self.table.connection
-        db_key = self.encode({"uaid": hasher(data.pop("uaid"))})
+        # Work on a copy so the call can be retried with the same data
+        data = dict(data)
+        huaid = hasher(data.pop("uaid"))
+        self.invalidate(huaid)
+        db_key = self.encode({"uaid": huaid})
         # Generate our update expression
         expr = "SET " + ", ".join(["%s=:%s" % (x, x) for x in data.keys()])
         expr_values = self.encode({":%s" % k: v for k, v in data.items()})
@@ -622,6 +960,7 @@ class Router(object):
         # The following hack ensures that only uaids that exist and are
         # deleted return true.
         huaid = hasher(uaid)
+        self.invalidate(huaid)
         return self.table.delete_item(uaid=huaid,
                                       expected={"uaid__eq": huaid})
 
@@ -634,7 +973,9 @@ class Router(object):
 
         """
         conn = self.table.connection
-        db_key = self.encode({"uaid": hasher(uaid)})
+        huaid = hasher(uaid)
+        self.invalidate(huaid)
+        db_key = self.encode({"uaid": huaid})
         expr = "SET current_month=:curmonth, last_connect=:last_connect"
         expr_values = self.encode({":curmonth": month,
                                    ":last_connect": generate_last_connect()
@@ -647,6 +988,83 @@ class Router(object):
         )
         return True
 
+    @track_provisioned
+    def mark_messages_stored(self, uaid):
+        """Flag a user's record as having messages in storage
+
+        Sets ``messages_stored_at`` to the current time in milliseconds.
+        Records are not created if they don't already exist. The item
+        returned is the record as written, so it can stand in for a
+        consistent read.
+
+        :returns: The updated router item, or None if the user's record
+                  doesn't exist.
+        :rtype: :class:`~boto.dynamodb2.items.Item`
+        :raises:
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        conn = self.table.connection
+        huaid = hasher(uaid)
+        self.invalidate(huaid)
+        try:
+            result = conn.update_item(
+                self.table.table_name,
+                self.encode({"uaid": huaid}),
+                update_expression="SET messages_stored_at=:stored_at",
+                condition_expression="attribute_exists(uaid)",
+                expression_attribute_values=self.encode({
+                    ":stored_at": int(time.time() * 1000)}),
+                return_values="ALL_NEW",
+            )
+        except ConditionalCheckFailedException:
+            return None
+        decode = self.table._dynamizer.decode
+        item = Item(self.table, data={
+            key: decode(value)
+            for key, value in result.get("Attributes", {}).items()})
+        self._cache_item(huaid, item)
+        return item
+
+    @track_provisioned
+    def clear_messages_stored(self, uaid, stored_at):
+        """Flag a user's record as having no messages in storage
+
+        ``messages_stored_at`` is set to 0, only if it still holds
+        ``stored_at`` so messages stored meanwhile keep the record flagged.
+
+        :param stored_at: The ``messages_stored_at`` value read from the
+                          record, or None if it had none.
+        :returns: Whether the flag was cleared.
+        :rtype: bool
+        :raises:
+            :exc:`ProvisionedThroughputExceededException` if dynamodb table
+            exceeds throughput.
+
+        """
+        conn = self.table.connection
+        huaid = hasher(uaid)
+        self.invalidate(huaid)
+        values = {":cleared": 0}
+        if stored_at is None:
+            cond = ("attribute_exists(uaid) and "
+                    "attribute_not_exists(messages_stored_at)")
+        else:
+            cond = "messages_stored_at = :stored_at"
+            values[":stored_at"] = stored_at
+        try:
+            conn.update_item(
+                self.table.table_name,
+                self.encode({"uaid": huaid}),
+                update_expression="SET messages_stored_at=:cleared",
+                condition_expression=cond,
+                expression_attribute_values=self.encode(values),
+            )
+            return True
+        except ConditionalCheckFailedException:
+            return False
+
     @track_provisioned
     def clear_node(self, item):
         """Given a router item and remove the node_id
@@ -662,9 +1080,10 @@ class Router(object):
 
         """
         conn = self.table.connection
-        # Pop out the node_id
-        node_id = item["node_id"]
-        del item["node_id"]
+        # Pop out the node_id, leaving the caller's item as is for retries
+        item = dict(item)
+        node_id = item.pop("node_id")
+        self.invalidate(item["uaid"])
 
         try:
             cond = "(node_id = :node) and (connected_at = :conn)"
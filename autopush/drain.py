@@ -0,0 +1,105 @@
+"""Paced drain of a connection node's clients
+
+Stopping a connection node drops every client at once, and they all
+reconnect to the rest of the fleet, and rescue their pending notifications
+into storage, in the same instant. :class:`ConnectionDrainer` instead stops
+accepting new clients and closes the connected ones at a steady rate, each
+at a random point of its interval, so the reconnects and the writes of
+pending notifications are spread out.
+
+"""
+import random
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+
+class ConnectionDrainer(object):
+    """Closes the connected clients of a node at a limited rate"""
+    log = Logger()
+
+    def __init__(self, settings, rate=100, interval=1.0, clock=None):
+        """Create a new ConnectionDrainer
+
+        :param settings: The node's
+                         :class:`~autopush.settings.AutopushSettings`.
+        :param rate: Clients closed a second.
+        :param interval: Seconds between batches of closes, each close of a
+                         batch is spread randomly over the interval.
+        :param clock: ``IReactorTime`` provider, the reactor by default.
+
+        """
+        self.settings = settings
+        self.rate = rate
+        self.interval = interval
+        self.clock = clock or reactor
+        # Listening ports of the websocket server
+        self.ports = []
+        self.draining = False
+        self._pending = deque()
+        self._waiters = []
+        self._loop = LoopingCall(self._close_batch)
+        self._loop.clock = self.clock
+
+    def start(self):
+        """Stop accepting clients and start closing the connected ones
+
+        :returns: A deferred firing once every client disconnected.
+
+        """
+        d = self.drained()
+        if self.draining:
+            return d
+        self.draining = True
+        self.log.info("Draining {count} clients",
+                      count=len(self.settings.clients))
+        self.settings.metrics.increment("drain.start")
+        for port in self.ports:
+            port.stopListening()
+        self._loop.start(self.interval)
+        return d
+
+    def drained(self):
+        """Return a deferred firing once a drain has closed every client"""
+        if self.draining and not self._loop.running:
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _close_batch(self):
+        """Schedule the next clients to close within this interval"""
+        clients = self.settings.clients
+        self.settings.metrics.gauge("drain.remaining", len(clients))
+        if not clients:
+            self._finish()
+            return
+        if not self._pending:
+            # Clients that finished their hello since the last pass, and
+            # any whose close hasn't started
+            self._pending.extend(client for client in clients.itervalues()
+                                 if client.state == client.STATE_OPEN)
+        count = max(1, int(self.rate * self.interval))
+        while count and self._pending:
+            client = self._pending.popleft()
+            self.clock.callLater(random.uniform(0, self.interval),
+                                 self._close, client)
+            count -= 1
+
+    def _close(self, client):
+        if client.state != client.STATE_OPEN:
+            # Already closing
+            return
+        self.settings.metrics.increment("drain.closed")
+        client.sendClose()
+
+    def _finish(self):
+        self._loop.stop()
+        self.log.info("Drain complete")
+        self.settings.metrics.increment("drain.complete")
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
@@ -44,7 +44,8 @@ from autopush.db import (
     normalize_id,
 )
 from autopush.exceptions import InvalidTokenException
-from autopush.router.interface import RouterException
+from autopush.router.interface import RouteContext, RouterException
+from autopush.scheduler import INTERACTIVE
 from autopush.utils import (
     generate_hash,
     validate_uaid,
@@ -131,6 +132,11 @@ class AutoendpointHandler(ErrorLogger, cyclone.web.RequestHandler):
         self.request_id = str(uuid.uuid4())
         self._client_info = self._init_info()
 
+    def db_call(self, func, *args, **kwargs):
+        """Schedule a blocking database call on behalf of the request"""
+        return self.ap_settings.db_scheduler.call(INTERACTIVE, func, *args,
+                                                  **kwargs)
+
     def prepare(self):
         """Common request preparation"""
         if self.ap_settings.cors:
@@ -376,8 +382,8 @@ class MessageHandler(AutoendpointHandler):
         return d
 
     def _delete_message(self, kind, uaid, chid):
-        d = deferToThread(self.ap_settings.message.delete_message, uaid,
-                          chid, self.version)
+        d = self.db_call(self.ap_settings.message.delete_message, uaid,
+                         chid, self.version)
         d.addCallback(self._delete_completed)
         self._db_error_handling(d)
         return d
@@ -428,7 +434,7 @@ class EndpointHandler(AutoendpointHandler):
         """Called after the token is decrypted successfully"""
         self.uaid = result.get("uaid")
         self.chid = result.get("chid")
-        d = deferToThread(self.ap_settings.router.get_uaid, self.uaid)
+        d = self.db_call(self.ap_settings.router.get_uaid, self.uaid)
         d.addCallback(self._uaid_lookup_results)
         d.addErrback(self._uaid_not_found_err)
         self._db_error_handling(d)
@@ -510,8 +516,15 @@ class EndpointHandler(AutoendpointHandler):
                                     headers=self.request.headers,
                                     ttl=ttl)
 
+        # Without a router item cache, the record was read consistently
+        # and the router needn't read it again.
+        context = RouteContext(
+            self.ap_settings, self.uaid, result,
+            consistent=self.ap_settings.router.cache is None)
+
         d = Deferred()
-        d.addCallback(self.router.route_notification, result)
+        d.addCallback(self.router.route_notification, result,
+                      context=context)
         d.addCallback(self._router_completed, result)
         d.addErrback(self._router_fail_err)
         d.addErrback(self._response_err)
@@ -531,8 +544,8 @@ class EndpointHandler(AutoendpointHandler):
             else:
                 uaid_data["router_data"] = response.router_data
             uaid_data["connected_at"] = int(time.time() * 1000)
-            d = deferToThread(self.ap_settings.router.register_user,
-                              uaid_data)
+            d = self.db_call(self.ap_settings.router.register_user,
+                             uaid_data)
             response.router_data = None
             d.addCallback(lambda x: self._router_completed(response,
                                                            uaid_data))
@@ -712,14 +725,13 @@ class RegistrationHandler(AutoendpointHandler):
             # mark channel as dead
             self.ap_settings.metrics.increment("updates.client.unregister",
                                                tags=self.base_tags())
-            d = deferToThread(self._delete_channel, uaid, chid)
+            d = self.db_call(self._delete_channel, uaid, chid)
             d.addCallback(self._success)
             d.addErrback(self._chid_not_found_err)
             d.addErrback(self._response_err)
             return d
         # nuke uaid
-        d = deferToThread(self._delete_uaid, uaid,
-                          self.ap_settings.router)
+        d = self.db_call(self._delete_uaid, uaid, self.ap_settings.router)
         d.addCallback(self._success)
         d.addErrback(self._uaid_not_found_err)
         d.addErrback(self._response_err)
@@ -737,7 +749,7 @@ class RegistrationHandler(AutoendpointHandler):
             connected_at=int(time.time() * 1000),
             last_connect=generate_last_connect(),
         )
-        return deferToThread(self.ap_settings.router.register_user, user_item)
+        return self.db_call(self.ap_settings.router.register_user, user_item)
 
     def _create_endpoint(self, result=None):
         router_data = None
@@ -746,7 +758,7 @@ class RegistrationHandler(AutoendpointHandler):
         except (IndexError, TypeError):
             pass
         """Called to register a new channel and create its endpoint."""
-        return deferToThread(self._register_channel, router_data)
+        return self.db_call(self._register_channel, router_data)
 
     def _return_endpoint(self, endpoint_data, new_uaid, router=None):
         """Called after the endpoint was made and should be returned to the
@@ -7,3 +7,11 @@ class AutopushException(Exception):
 
 class InvalidTokenException(Exception):
     """Invalid URL token Exception"""
+
+
+class AdmissionRejected(AutopushException):
+    """A client hello wasn't admitted for registration"""
+
+
+class ChannelUnavailable(AutopushException):
+    """A node has no binary channel to send a request over"""
@@ -9,6 +9,7 @@ from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 
 from autopush import __version__
+from autopush.websocket import state_footprint
 
 
 class MissingTableException(Exception):
@@ -34,10 +35,19 @@ class HealthHandler(cyclone.web.RequestHandler):
             "clients": len(self.ap_settings.clients)
         }
 
-        dl = DeferredList([
-            self._check_table(self.ap_settings.router.table),
-            self._check_table(self.ap_settings.storage.table)
-        ])
+        if self.ap_settings.drainer.draining:
+            # Take the node out of the load balancer while it drains
+            self._healthy = False
+            self._health_checks["draining"] = True
+
+        checks = []
+        # In-memory tables always exist
+        if self.ap_settings.db_backend == "dynamodb":
+            checks = [
+                self._check_table(self.ap_settings.router.table),
+                self._check_table(self.ap_settings.storage.table)
+            ]
+        dl = DeferredList(checks)
         dl.addBoth(self._finish_response)
 
     def _check_table(self, table):
@@ -83,10 +93,31 @@ class StatusHandler(cyclone.web.RequestHandler):
     def get(self):
         """HTTP Get
 
-        Returns that this node is alive, and the version.
+        Returns that this node is alive, the version, and on connection
+        nodes the average bytes of state held per connected client.
 
         """
         self.write({
             "status": "OK",
-            "version": __version__
+            "version": __version__,
+            "connection_state_bytes": state_footprint(
+                self.ap_settings.clients),
+        })
+
+
+class DrainHandler(cyclone.web.RequestHandler):
+    """HTTP Drain Handler"""
+    def put(self):
+        """HTTP Put
+
+        Starts draining the clients of a connection node, the node shuts
+        down once they have all disconnected.
+
+        """
+        drainer = self.ap_settings.drainer
+        drainer.start()
+        self.set_status(202)
+        self.write({
+            "status": "draining",
+            "clients": len(self.ap_settings.clients),
         })
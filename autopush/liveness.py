@@ -0,0 +1,84 @@
+"""Liveness of the connection nodes notifications are routed to
+
+Router records keep naming the node a client was last connected to after
+that node goes away, until each record is cleared. Without a record of dead
+nodes, every notification for those clients waits for a connect to time out
+before it's stored. :class:`NodeDirectory` remembers the nodes that couldn't
+be reached, so routing to them skips straight to storage, and probes them
+in the background to readmit them once they're back.
+
+"""
+from repoze.lru import LRUCache
+from twisted.internet import reactor
+from twisted.logger import Logger
+
+from autopush.protocol import IgnoreBody
+
+
+class NodeDirectory(object):
+    """Directory of the connection nodes known to be unreachable
+
+    A node is probed, with a ``GET`` of its ``/status``, when a notification
+    is routed to it at least ``probe_interval`` seconds after it was last
+    found dead. The node is readmitted once a probe succeeds, while the
+    notifications routed to it in the meantime are stored.
+
+    """
+    log = Logger()
+
+    def __init__(self, metrics, agent, probe_interval=10, size=150,
+                 clock=None):
+        """Create a new NodeDirectory
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param agent: HTTP agent for the probes.
+        :param probe_interval: Seconds between probes of a dead node.
+        :param size: Most dead nodes remembered.
+        :param clock: ``IReactorTime`` provider, the reactor by default.
+
+        """
+        self.metrics = metrics
+        self.agent = agent
+        self.probe_interval = probe_interval
+        self.clock = clock or reactor
+        # node_id -> time of the node's next probe
+        self._dead = LRUCache(size)
+        self._probing = set()
+
+    def alive(self, node_id):
+        """Whether notifications should be routed to a node"""
+        probe_at = self._dead.get(node_id)
+        if probe_at is None:
+            return True
+        if probe_at <= self.clock.seconds() and node_id not in self._probing:
+            self._probe(node_id)
+        return False
+
+    def mark_dead(self, node_id):
+        """Record a node that couldn't be reached"""
+        if self._dead.get(node_id) is None:
+            self.log.debug("Node {node_id} is dead", node_id=node_id)
+            self.metrics.increment("node_directory.dead")
+        self._dead.put(node_id, self.clock.seconds() + self.probe_interval)
+
+    def _probe(self, node_id):
+        self._probing.add(node_id)
+        self.metrics.increment("node_directory.probe")
+        d = self.agent.request("GET", (node_id + "/status").encode("utf8"))
+        d.addCallback(IgnoreBody.ignore)
+        d.addCallbacks(self._probed, self._probe_failed,
+                       callbackArgs=(node_id,), errbackArgs=(node_id,))
+
+    def _probed(self, response, node_id):
+        self._probing.discard(node_id)
+        if response.code != 200:
+            self.mark_dead(node_id)
+            return
+        self.log.debug("Node {node_id} is back", node_id=node_id)
+        self.metrics.increment("node_directory.readmit")
+        self._dead.invalidate(node_id)
+
+    def _probe_failed(self, failure, node_id):
+        self._probing.discard(node_id)
+        self.mark_dead(node_id)
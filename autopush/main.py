@@ -1,13 +1,17 @@
 """autopush/autoendpoint daemon scripts"""
 import json
 import os
+import signal
+import socket
 
 import configargparse
 import cyclone.web
 from autobahn.twisted.resource import WebSocketResource
 from autobahn.twisted.websocket import WebSocketServerFactory
 from twisted.internet import reactor, task
+from twisted.internet.protocol import Factory
 from twisted.logger import Logger
+from twisted.protocols.tls import TLSMemoryBIOFactory
 from twisted.web.server import Site
 
 import autopush.db as db
@@ -16,11 +20,13 @@ from autopush.endpoint import (
     MessageHandler,
     RegistrationHandler,
 )
-from autopush.health import (HealthHandler, StatusHandler)
+from autopush.health import (DrainHandler, HealthHandler, StatusHandler)
 from autopush.logging import PushLogger
 from autopush.settings import AutopushSettings
 from autopush.ssl import AutopushSSLContextFactory
 from autopush.websocket import (
+    BulkRouterHandler,
+    ChannelServerProtocol,
     PushServerProtocol,
     RouterHandler,
     NotificationHandler,
@@ -29,6 +35,7 @@ from autopush.websocket import (
     StatusResource,
 )
 from autopush.senderids import SenderIDs, SENDERID_EXPRY, DEFAULT_BUCKET
+from autopush.workers import UAIDIndex, reuseport_socket, spawn_workers
 
 
 shared_config_files = [
@@ -82,6 +89,45 @@ def add_shared_args(parser):
     parser.add_argument('--ssl_dh_param',
                         help="SSL DH Param file (openssl dhparam 1024)",
                         type=str, default="", env_var="SSL_DH_PARAM")
+    parser.add_argument('--db_backend',
+                        help="Storage backend, memory keeps all data in this "
+                        "process", type=str, default="dynamodb",
+                        choices=["dynamodb", "memory"], env_var="DB_BACKEND")
+    parser.add_argument('--db_async',
+                        help="Send DynamoDB requests from the reactor "
+                        "instead of the threadpool", action="store_true",
+                        default=False, env_var="DB_ASYNC")
+    parser.add_argument('--db_threads',
+                        help="Threadpool workers shared by blocking database "
+                        "calls", type=int, default=50, env_var="DB_THREADS")
+    parser.add_argument('--db_retry_budget',
+                        help="Retries a second of calls throttled by "
+                        "DynamoDB, per table", type=float, default=10.0,
+                        env_var="DB_RETRY_BUDGET")
+    parser.add_argument('--channel_offset',
+                        help="Offset from a connection node's router port "
+                        "of the port it takes internal routing requests on "
+                        "over a binary channel, set on every node. At least "
+                        "the number of workers. Set to 0 to send internal "
+                        "routing requests over HTTP.",
+                        type=int, default=0, env_var="CHANNEL_OFFSET")
+    parser.add_argument('--channel_window',
+                        help="Most internal routing requests waiting for "
+                        "their result on a channel to a connection node",
+                        type=int, default=100, env_var="CHANNEL_WINDOW")
+    parser.add_argument('--http_pool_size',
+                        help="Idle HTTP connections kept to each node for "
+                        "internal requests", type=int, default=10,
+                        env_var="HTTP_POOL_SIZE")
+    parser.add_argument('--http_pool_idle_timeout',
+                        help="Seconds an idle HTTP connection to a node is "
+                        "kept", type=int, default=240,
+                        env_var="HTTP_POOL_IDLE_TIMEOUT")
+    parser.add_argument('--http_pool_max_connections',
+                        help="Most HTTP connections open to each node, "
+                        "further internal requests wait for a connection. "
+                        "Set to 0 for no limit.", type=int, default=0,
+                        env_var="HTTP_POOL_MAX_CONNECTIONS")
     parser.add_argument('--router_tablename', help="DynamoDB Router Tablename",
                         type=str, default="router", env_var="ROUTER_TABLENAME")
     parser.add_argument('--storage_tablename',
@@ -240,9 +286,86 @@ def _parse_connection(sysargs, use_files=True):
                         help="The client handshake timeout. Set to 0 to"
                         "disable.", default=0, type=int,
                         env_var="HELLO_TIMEOUT")
+    parser.add_argument('--hello_prefetch',
+                        help="Fetch stored notifications for a returning "
+                        "client while its hello is being registered",
+                        action="store_true", default=False,
+                        env_var="HELLO_PREFETCH")
+    parser.add_argument('--hello_skip_storage',
+                        help="Skip the storage query of a hello when the "
+                        "router record shows nothing was stored. Only safe "
+                        "once every endpoint flags the messages it stores.",
+                        action="store_true", default=False,
+                        env_var="HELLO_SKIP_STORAGE")
+    parser.add_argument('--ack_batch_interval',
+                        help="Seconds to gather webpush ack deletes into a "
+                        "batch. Set to 0 to delete each ack individually.",
+                        default=0.005, type=float,
+                        env_var="ACK_BATCH_INTERVAL")
+    parser.add_argument('--router_write_rate',
+                        help="Most last_connect and current_month router "
+                        "updates written a second, pending updates are "
+                        "deduplicated per UAID. Set to 0 to write each "
+                        "update immediately.", default=0, type=int,
+                        env_var="ROUTER_WRITE_RATE")
+    parser.add_argument('--timer_resolution',
+                        help="Seconds of resolution of the timer wheel "
+                        "shared by client hello, idle and notification check "
+                        "timeouts. Set to 0 to give each timeout its own "
+                        "reactor timer.",
+                        default=1.0, type=float,
+                        env_var="TIMER_RESOLUTION")
+    parser.add_argument('--hello_concurrency',
+                        help="Most client hellos registered at once, the "
+                        "limit backs off when registrations are throttled "
+                        "or slow. Set to 0 to register every hello "
+                        "immediately.", default=0, type=int,
+                        env_var="HELLO_CONCURRENCY")
+    parser.add_argument('--hello_queue_size',
+                        help="Most client hellos waiting to be registered, "
+                        "further hellos are told to back off", default=10000,
+                        type=int, env_var="HELLO_QUEUE_SIZE")
+    parser.add_argument('--hello_queue_timeout',
+                        help="Seconds a client hello may wait to be "
+                        "registered before it's told to back off",
+                        default=30, type=int, env_var="HELLO_QUEUE_TIMEOUT")
+    parser.add_argument('--hello_latency_target',
+                        help="Seconds a hello registration may take before "
+                        "the hello concurrency backs off", default=1.0,
+                        type=float, env_var="HELLO_LATENCY_TARGET")
+    parser.add_argument('--drain_rate',
+                        help="Clients closed a second while draining the "
+                        "node before a shutdown, started by SIGUSR1 or a PUT "
+                        "to /drain on the router port", default=100,
+                        type=int, env_var="DRAIN_RATE")
+    parser.add_argument('--workers',
+                        help="Worker processes sharing the websocket port "
+                        "through SO_REUSEPORT. Each worker's internal "
+                        "router listens on the router port plus its worker "
+                        "number. Set to 1 to run a single process.",
+                        default=1, type=int, env_var="WORKERS")
+    parser.add_argument('--worker_index_size',
+                        help="Clients each worker can record in the index "
+                        "shared by the workers, keep above twice the "
+                        "clients a worker holds", default=262144, type=int,
+                        env_var="WORKER_INDEX_SIZE")
+    parser.add_argument('--outbound_queue_size',
+                        help="Notifications queued per client while its "
+                        "connection is backed up, further notifications are "
+                        "refused as busy. Set to 0 to refuse them all.",
+                        default=10, type=int, env_var="OUTBOUND_QUEUE_SIZE")
+    parser.add_argument('--outbound_queue_bytes',
+                        help="Bytes of notifications queued per client while "
+                        "its connection is backed up", default=32768,
+                        type=int, env_var="OUTBOUND_QUEUE_BYTES")
 
     add_shared_args(parser)
     args = parser.parse_args(sysargs)
+    # Each worker's router port is the router port plus its worker number,
+    # its channel port must not be another worker's router port
+    if args.channel_offset and abs(args.channel_offset) < args.workers:
+        parser.error("channel_offset must be at least the number of "
+                     "workers")
     return args, parser
 
 
@@ -270,6 +393,36 @@ def _parse_endpoint(sysargs, use_files=True):
     parser.add_argument('--auth_key', help='Bearer Token source key',
                         type=str, default=[], env_var='AUTH_KEY',
                         action="append")
+    parser.add_argument('--router_cache_size',
+                        help="Number of router records to cache, 0 disables "
+                        "the cache", type=int, default=0,
+                        env_var="ROUTER_CACHE_SIZE")
+    parser.add_argument('--router_cache_ttl',
+                        help="Seconds a cached router record is used",
+                        type=int, default=60, env_var="ROUTER_CACHE_TTL")
+    parser.add_argument('--channel_cache_size',
+                        help="Number of channel sets to cache, 0 disables "
+                        "the cache", type=int, default=0,
+                        env_var="CHANNEL_CACHE_SIZE")
+    parser.add_argument('--channel_cache_ttl',
+                        help="Seconds a cached channel set is used",
+                        type=int, default=60, env_var="CHANNEL_CACHE_TTL")
+    parser.add_argument('--route_batch_interval',
+                        help="Seconds to gather notifications for a "
+                        "connection node into a single bulk request. Set "
+                        "to 0 to send each notification on its own.",
+                        type=float, default=0,
+                        env_var="ROUTE_BATCH_INTERVAL")
+    parser.add_argument('--route_batch_size',
+                        help="Most notifications sent to a connection node "
+                        "in a single bulk request", type=int, default=100,
+                        env_var="ROUTE_BATCH_SIZE")
+    parser.add_argument('--node_probe_interval',
+                        help="Seconds between probes of a connection node "
+                        "that couldn't be reached. Notifications for its "
+                        "clients are stored until a probe succeeds.",
+                        type=float, default=10,
+                        env_var="NODE_PROBE_INTERVAL")
 
     add_shared_args(parser)
 
@@ -324,6 +477,15 @@ def make_settings(args, **kwargs):
         statsd_host=args.statsd_host,
         statsd_port=args.statsd_port,
         router_conf=router_conf,
+        db_backend=args.db_backend,
+        db_async=args.db_async,
+        db_threads=args.db_threads,
+        db_retry_budget=args.db_retry_budget,
+        channel_offset=args.channel_offset,
+        channel_window=args.channel_window,
+        http_pool_size=args.http_pool_size,
+        http_pool_idle_timeout=args.http_pool_idle_timeout,
+        http_pool_max_connections=args.http_pool_max_connections,
         router_tablename=args.router_tablename,
         storage_tablename=args.storage_tablename,
         storage_read_throughput=args.storage_read_throughput,
@@ -359,6 +521,18 @@ def mount_health_handlers(site, settings):
 def connection_main(sysargs=None, use_files=True):
     """Main entry point to setup a connection node, aka the autopush script"""
     args, parser = _parse_connection(sysargs, use_files)
+    # Fork the workers before anything starts threads
+    uaid_index = None
+    worker = 0
+    if args.workers > 1:
+        uaid_index = UAIDIndex(args.workers, args.worker_index_size)
+        worker = spawn_workers(args.workers)
+        if worker is None:
+            # Supervisor, every worker has exited
+            return
+        uaid_index.claim(worker)
+    router_port = args.router_port + worker
+
     log_format = "text" if args.human_logs else "json"
     log_level = args.log_level or ("debug" if args.debug else "info")
     sentry_dsn = bool(os.environ.get("SENTRY_DSN"))
@@ -378,20 +552,39 @@ def connection_main(sysargs=None, use_files=True):
         endpoint_port=args.endpoint_port,
         router_scheme="https" if args.router_ssl_key else "http",
         router_hostname=args.router_hostname,
-        router_port=args.router_port,
+        router_port=router_port,
         env=args.env,
         hello_timeout=args.hello_timeout,
+        hello_prefetch=args.hello_prefetch,
+        hello_skip_storage=args.hello_skip_storage,
+        ack_batch_interval=args.ack_batch_interval,
+        router_write_rate=args.router_write_rate,
+        timer_resolution=args.timer_resolution,
+        hello_concurrency=args.hello_concurrency,
+        hello_queue_size=args.hello_queue_size,
+        hello_queue_timeout=args.hello_queue_timeout,
+        hello_latency_target=args.hello_latency_target,
+        drain_rate=args.drain_rate,
+        uaid_index=uaid_index,
+        outbound_queue_size=args.outbound_queue_size,
+        outbound_queue_bytes=args.outbound_queue_bytes,
     )
 
     r = RouterHandler
     r.ap_settings = settings
+    b = BulkRouterHandler
+    b.ap_settings = settings
     n = NotificationHandler
     n.ap_settings = settings
+    d = DrainHandler
+    d.ap_settings = settings
 
     # Internal HTTP notification router
     site = cyclone.web.Application([
+        (r"/push", b),
         (r"/push/([^\/]+)", r),
         (r"/notif/([^\/]+)(/([^\/]+))?", n),
+        (r"/drain", d),
     ],
         default_host=settings.router_hostname, debug=args.debug,
         log_function=skip_request_logging
@@ -416,6 +609,11 @@ def connection_main(sysargs=None, use_files=True):
     settings.factory = factory
 
     settings.metrics.start()
+    settings.db_scheduler.start()
+    if settings.router_updates is not None:
+        # Write out pending router updates before exiting
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      settings.router_updates.flush)
 
     # Wrap the WebSocket server in a default resource that exposes the
     # `/status` handler, and delegates to the WebSocket resource for all
@@ -431,21 +629,46 @@ def connection_main(sysargs=None, use_files=True):
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
 
-        reactor.listenSSL(args.port, siteFactory, contextFactory)
+        if uaid_index is not None:
+            port = reactor.adoptStreamPort(
+                reuseport_socket(args.port).fileno(), socket.AF_INET,
+                TLSMemoryBIOFactory(contextFactory, False, siteFactory))
+        else:
+            port = reactor.listenSSL(args.port, siteFactory, contextFactory)
+    elif uaid_index is not None:
+        # Workers share the port, the kernel spreads clients across them
+        port = reactor.adoptStreamPort(reuseport_socket(args.port).fileno(),
+                                       socket.AF_INET, siteFactory)
     else:
-        reactor.listenTCP(args.port, siteFactory)
-
-    # Start the internal routing listener.
+        port = reactor.listenTCP(args.port, siteFactory)
+    settings.drainer.ports.append(port)
+
+    # Drain the clients on SIGUSR1, and shut down once they're all gone
+    def start_drain(signum, frame):
+        reactor.callFromThread(settings.drainer.start)
+    signal.signal(signal.SIGUSR1, start_drain)
+    settings.drainer.drained().addCallback(lambda _: reactor.stop())
+
+    # Start the internal routing listeners.
+    channel = None
+    if args.channel_offset:
+        channel = Factory.forProtocol(ChannelServerProtocol)
+        ChannelServerProtocol.ap_settings = settings
     if args.router_ssl_key:
         contextFactory = AutopushSSLContextFactory(args.router_ssl_key,
                                                    args.router_ssl_cert)
         if args.ssl_dh_param:
             contextFactory.getContext().load_tmp_dh(args.ssl_dh_param)
-        reactor.listenSSL(args.router_port, site, contextFactory)
+        reactor.listenSSL(router_port, site, contextFactory)
+        if channel is not None:
+            reactor.listenSSL(router_port + args.channel_offset, channel,
+                              contextFactory)
     else:
-        reactor.listenTCP(args.router_port, site)
+        reactor.listenTCP(router_port, site)
+        if channel is not None:
+            reactor.listenTCP(router_port + args.channel_offset, channel)
 
-    reactor.suggestThreadPoolSize(50)
+    reactor.suggestThreadPoolSize(settings.db_scheduler.capacity)
 
     l = task.LoopingCall(periodic_reporter, settings)
     l.start(1.0)
@@ -490,6 +713,13 @@ def endpoint_main(sysargs=None, use_files=True):
         senderid_expry=args.senderid_expry,
         senderid_list=senderid_list,
         bear_hash_key=args.auth_key,
+        router_cache_size=args.router_cache_size,
+        router_cache_ttl=args.router_cache_ttl,
+        channel_cache_size=args.channel_cache_size,
+        channel_cache_ttl=args.channel_cache_ttl,
+        route_batch_interval=args.route_batch_interval,
+        route_batch_size=args.route_batch_size,
+        node_probe_interval=args.node_probe_interval,
     )
 
     # Endpoint HTTP router
@@ -510,6 +740,7 @@ def endpoint_main(sysargs=None, use_files=True):
     mount_health_handlers(site, settings)
 
     settings.metrics.start()
+    settings.db_scheduler.start()
 
     # start the senderIDs refresh timer
     if settings.routers.get('gcm') and settings.routers['gcm'].senderIDs:
@@ -530,5 +761,5 @@ def endpoint_main(sysargs=None, use_files=True):
     l = task.LoopingCall(settings.update_rotating_tables)
     l.start(60)
 
-    reactor.suggestThreadPoolSize(50)
+    reactor.suggestThreadPoolSize(settings.db_scheduler.capacity)
     reactor.run()
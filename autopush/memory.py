@@ -0,0 +1,383 @@
+"""In-memory storage backend
+
+Implements the :mod:`autopush.db` storage interfaces on plain dicts held by
+the current process, following the same conditional write semantics as the
+DynamoDB tables. Intended for local load tests and benchmarks, nothing is
+persisted or shared between processes.
+
+"""
+import threading
+import time
+import uuid
+
+from boto.dynamodb2.exceptions import ItemNotFound
+
+from autopush.db import (
+    generate_last_connect,
+    hasher,
+    normalize_id,
+    track_provisioned,
+    IMessage,
+    IRouter,
+    IStorage,
+)
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_memory_table(tablename):
+    """Get an in-memory table by name
+
+    Creates the table if it doesn't already exist, otherwise returns the
+    existing table.
+
+    """
+    with _tables_lock:
+        if tablename not in _tables:
+            _tables[tablename] = MemoryTable(tablename)
+        return _tables[tablename]
+
+
+def _storable(data):
+    """Drop the values DynamoDB would not store, such as ``None`` and empty
+    sets, from an item"""
+    return {k: v for k, v in data.items()
+            if v or v in (0, 0.0, False)}
+
+
+def _copy(item):
+    """Copy an item so callers are free to modify it"""
+    item = dict(item)
+    if "chids" in item:
+        item["chids"] = set(item["chids"])
+    return item
+
+
+class MemoryTable(object):
+    """A table of items keyed by hash key, then by range key
+
+    Tables without a range key store their items under a range key of
+    ``None``.
+
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, hash_key, range_key=None):
+        return self.items.get(hash_key, {}).get(range_key)
+
+    def put(self, hash_key, range_key, item):
+        self.items.setdefault(hash_key, {})[range_key] = _storable(item)
+
+    def delete(self, hash_key, range_key=None):
+        """Delete an item, returning whether it existed"""
+        items = self.items.get(hash_key, {})
+        if range_key not in items:
+            return False
+        del items[range_key]
+        if not items:
+            del self.items[hash_key]
+        return True
+
+    def query(self, hash_key, after=" "):
+        """Return the items of a hash key with range keys above ``after``,
+        in range key order"""
+        items = self.items.get(hash_key, {})
+        return [items[k] for k in sorted(items) if k > after]
+
+
+class MemoryStorage(IStorage):
+    """In-memory implementation of :class:`~autopush.db.IStorage`"""
+    def __init__(self, table, metrics):
+        """Create a new MemoryStorage object
+
+        :param table: :class:`MemoryTable` object.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+
+        """
+        self.table = table
+        self.metrics = metrics
+
+    @track_provisioned
+    def fetch_notifications(self, uaid):
+        with self.table.lock:
+            return map(_copy, self.table.query(hasher(uaid)))
+
+    @track_provisioned
+    def save_notification(self, uaid, chid, version):
+        huaid, chid = hasher(uaid), normalize_id(chid)
+        with self.table.lock:
+            item = self.table.get(huaid, chid)
+            if item and "version" in item and item["version"] >= version:
+                return False
+            self.table.put(huaid, chid,
+                           dict(uaid=huaid, chid=chid, version=version))
+            return True
+
+    def delete_notification(self, uaid, chid, version=None):
+        huaid, chid = hasher(uaid), normalize_id(chid)
+        with self.table.lock:
+            item = self.table.get(huaid, chid)
+            if item and (not version or item.get("version") == version):
+                self.table.delete(huaid, chid)
+        return True
+
+
+class MemoryMessage(IMessage):
+    """In-memory implementation of :class:`~autopush.db.IMessage`"""
+    def __init__(self, table, metrics):
+        """Create a new MemoryMessage object
+
+        :param table: :class:`MemoryTable` object.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+
+        """
+        self.table = table
+        self.metrics = metrics
+
+    def _update_channels(self, uaid, update):
+        """Apply ``update`` to a copy of the uaid's channel set, creating the
+        channel record if needed, and return the previous set"""
+        huaid = hasher(uaid)
+        with self.table.lock:
+            item = (self.table.get(huaid, " ") or
+                    dict(uaid=huaid, chidmessageid=" "))
+            old = set(item.get("chids", ()))
+            item["chids"] = update(set(old))
+            self.table.put(huaid, " ", item)
+        return old
+
+    @track_provisioned
+    def register_channel(self, uaid, channel_id):
+        chid = normalize_id(channel_id)
+        self._update_channels(uaid, lambda chids: chids | set([chid]))
+        return True
+
+    @track_provisioned
+    def unregister_channel(self, uaid, channel_id, **kwargs):
+        chid = normalize_id(channel_id)
+        old = self._update_channels(uaid, lambda chids: chids - set([chid]))
+        return channel_id in old
+
+    @track_provisioned
+    def all_channels(self, uaid):
+        with self.table.lock:
+            item = self.table.get(hasher(uaid), " ")
+            if item is None:
+                return False, set([])
+            return True, set(item.get("chids", ()))
+
+    def has_channel(self, uaid, channel_id):
+        try:
+            chid = normalize_id(channel_id)
+        except ValueError:
+            return False
+        exists, chids = self.all_channels(uaid)
+        return exists and chid in set(normalize_id(x) for x in chids)
+
+    @track_provisioned
+    def save_channels(self, uaid, channels):
+        huaid = hasher(uaid)
+        with self.table.lock:
+            self.table.put(huaid, " ", dict(uaid=huaid, chidmessageid=" ",
+                                            chids=set(channels)))
+
+    @track_provisioned
+    def store_message(self, uaid, channel_id, message_id, ttl, data=None,
+                      headers=None, timestamp=None):
+        huaid = hasher(uaid)
+        chidmessageid = "%s:%s" % (normalize_id(channel_id), message_id)
+        item = dict(
+            uaid=huaid,
+            chidmessageid=chidmessageid,
+            data=data,
+            headers=headers,
+            ttl=ttl,
+            timestamp=timestamp or int(time.time()),
+            updateid=uuid.uuid4().hex
+        )
+        with self.table.lock:
+            self.table.put(huaid, chidmessageid, item)
+        return True
+
+    def store_messages(self, uaid, messages):
+        for message in messages:
+            self.store_message(uaid, **message)
+        return True
+
+    @track_provisioned
+    def update_message(self, uaid, channel_id, message_id, ttl, data=None,
+                       headers=None, timestamp=None):
+        huaid = hasher(uaid)
+        chidmessageid = "%s:%s" % (normalize_id(channel_id), message_id)
+        with self.table.lock:
+            item = self.table.get(huaid, chidmessageid)
+            if not item or "updateid" not in item:
+                return False
+            item = dict(item,
+                        ttl=ttl,
+                        timestamp=timestamp or int(time.time()),
+                        updateid=uuid.uuid4().hex,
+                        data=data,
+                        headers=headers if data else None)
+            self.table.put(huaid, chidmessageid, item)
+        return True
+
+    @track_provisioned
+    def delete_message(self, uaid, channel_id, message_id, updateid=None):
+        huaid = hasher(uaid)
+        chidmessageid = "%s:%s" % (normalize_id(channel_id), message_id)
+        with self.table.lock:
+            if updateid:
+                item = self.table.get(huaid, chidmessageid)
+                if not item or item.get("updateid") != updateid:
+                    return False
+            self.table.delete(huaid, chidmessageid)
+        return True
+
+    @track_provisioned
+    def delete_message_batch(self, messages):
+        with self.table.lock:
+            for uaid, channel_id, message_id in messages:
+                self.table.delete(hasher(uaid), "%s:%s" % (
+                    normalize_id(channel_id), message_id))
+        return []
+
+    def delete_messages(self, uaid, chidmessageids):
+        huaid = hasher(uaid)
+        with self.table.lock:
+            for chidmessageid in chidmessageids:
+                if chidmessageid:
+                    self.table.delete(huaid, chidmessageid)
+
+    @track_provisioned
+    def delete_messages_for_channel(self, uaid, channel_id):
+        prefix = "%s:" % normalize_id(channel_id)
+        with self.table.lock:
+            chidmessageids = [x["chidmessageid"] for x in
+                              self.table.query(hasher(uaid))
+                              if x["chidmessageid"].startswith(prefix)]
+        if chidmessageids:
+            self.delete_messages(uaid, chidmessageids)
+        return len(chidmessageids) > 0
+
+    @track_provisioned
+    def delete_user(self, uaid):
+        with self.table.lock:
+            chidmessageids = [x["chidmessageid"] for x in
+                              self.table.query(hasher(uaid), after="")]
+        if chidmessageids:
+            self.delete_messages(uaid, chidmessageids)
+
+    @track_provisioned
+    def fetch_messages(self, uaid, limit=10):
+        with self.table.lock:
+            return map(_copy, self.table.query(hasher(uaid))[:limit])
+
+
+class MemoryRouter(IRouter):
+    """In-memory implementation of :class:`~autopush.db.IRouter`"""
+    def __init__(self, table, metrics):
+        """Create a new MemoryRouter object
+
+        :param table: :class:`MemoryTable` object.
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+
+        """
+        self.table = table
+        self.metrics = metrics
+
+    def _update(self, huaid, **kwargs):
+        """Set attributes of a router item, creating it if needed"""
+        with self.table.lock:
+            item = self.table.get(huaid) or dict(uaid=huaid)
+            item.update(kwargs)
+            self.table.put(huaid, None, item)
+        return True
+
+    def get_uaid(self, uaid, use_cache=True):
+        with self.table.lock:
+            item = self.table.get(hasher(uaid))
+        if item is None:
+            raise ItemNotFound("uaid not found")
+        if item.keys() == ['uaid']:
+            # Incomplete record, drop it.
+            self.drop_user(uaid)
+            raise ItemNotFound("uaid not found")
+        return _copy(item)
+
+    @track_provisioned
+    def register_user(self, data):
+        # Work on a copy so the call can be retried with the same data
+        data = dict(data)
+        huaid = hasher(data.pop("uaid"))
+        with self.table.lock:
+            item = self.table.get(huaid)
+            if item is not None:
+                if ("router_type" in item and
+                        item["router_type"] != data.get("router_type")):
+                    return (False, {}, data)
+                if ("node_id" in item and
+                        not ("connected_at" in item and
+                             item["connected_at"] < data["connected_at"])):
+                    return (False, {}, data)
+            new_item = dict(item or dict(uaid=huaid))
+            new_item.update(data)
+            self.table.put(huaid, None, new_item)
+        return (True, _copy(item) if item else {}, data)
+
+    @track_provisioned
+    def update_last_connect(self, uaid):
+        return self._update(uaid, last_connect=generate_last_connect())
+
+    @track_provisioned
+    def drop_user(self, uaid):
+        with self.table.lock:
+            return self.table.delete(hasher(uaid))
+
+    @track_provisioned
+    def update_message_month(self, uaid, month):
+        return self._update(hasher(uaid), current_month=month,
+                            last_connect=generate_last_connect())
+
+    @track_provisioned
+    def mark_messages_stored(self, uaid):
+        huaid = hasher(uaid)
+        with self.table.lock:
+            item = self.table.get(huaid)
+            if item is None:
+                return None
+            item["messages_stored_at"] = int(time.time() * 1000)
+            self.table.put(huaid, None, item)
+            return _copy(item)
+
+    @track_provisioned
+    def clear_messages_stored(self, uaid, stored_at):
+        huaid = hasher(uaid)
+        with self.table.lock:
+            item = self.table.get(huaid)
+            if item is None or item.get("messages_stored_at") != stored_at:
+                return False
+            item["messages_stored_at"] = 0
+            self.table.put(huaid, None, item)
+        return True
+
+    @track_provisioned
+    def clear_node(self, item):
+        # Pop out the node_id, leaving the caller's item as is for retries
+        item = dict(item)
+        node_id = item.pop("node_id")
+
+        with self.table.lock:
+            stored = self.table.get(item["uaid"])
+            if (stored is None or stored.get("node_id") != node_id or
+                    stored.get("connected_at") != item["connected_at"]):
+                return False
+            self.table.put(item["uaid"], None, item)
+        return True
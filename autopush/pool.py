@@ -0,0 +1,165 @@
+"""Instrumented HTTP connection pool for requests between nodes
+
+Twisted's :class:`~twisted.web.client.HTTPConnectionPool` keeps two idle
+connections to each destination, and opens as many more as there are
+concurrent requests. Endpoint nodes send a steady stream of requests to
+each connection node, so most of them pay for a new connection.
+:class:`NodeConnectionPool` keeps more idle connections, can cap the
+connections open to a destination, queueing the requests beyond it, and
+reports how well connections are reused.
+
+"""
+from collections import deque
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Factory
+from twisted.web._newclient import HTTP11ClientProtocol
+from twisted.web.client import HTTPConnectionPool
+
+
+class NodeClientProtocol(HTTP11ClientProtocol):
+    """HTTP client protocol that tells its pool when it disconnects"""
+    def __init__(self, quiescentCallback, lostCallback):
+        HTTP11ClientProtocol.__init__(self, quiescentCallback)
+        self._lostCallback = lostCallback
+
+    def connectionLost(self, reason):
+        HTTP11ClientProtocol.connectionLost(self, reason)
+        self._lostCallback(self)
+
+
+class NodeClientFactory(Factory):
+    """Builds the :class:`NodeClientProtocol` of a pool's connection"""
+    def __init__(self, quiescentCallback, lostCallback):
+        self._quiescentCallback = quiescentCallback
+        self._lostCallback = lostCallback
+
+    def buildProtocol(self, addr):
+        return NodeClientProtocol(self._quiescentCallback, self._lostCallback)
+
+
+class NodeConnectionPool(HTTPConnectionPool):
+    """Pool of persistent HTTP connections to each destination
+
+    Reports to metrics, tagged by destination:
+
+    - ``http_pool.hit`` and ``http_pool.miss``, requests that reused an
+      idle connection or needed a new one
+    - ``http_pool.connect`` and ``http_pool.disconnect``, connections
+      opened and closed
+    - ``http_pool.queued`` and ``http_pool.wait``, requests that waited for
+      a connection under the limit, and how long they waited
+
+    """
+    _factory = NodeClientFactory
+
+    def __init__(self, reactor, metrics, max_idle=10, idle_timeout=240,
+                 max_connections=0):
+        """Create a new NodeConnectionPool
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param max_idle: Most idle connections kept to a destination.
+        :param idle_timeout: Seconds an idle connection is kept.
+        :param max_connections: Most connections open to a destination,
+                                0 for no limit.
+
+        """
+        HTTPConnectionPool.__init__(self, reactor)
+        self.metrics = metrics
+        self.maxPersistentPerHost = max_idle
+        self.cachedConnectionTimeout = idle_timeout
+        self.max_connections = max_connections
+        # key -> connections open or opening
+        self._open = {}
+        # key -> deque of (Deferred, endpoint, queued at) waiting for a
+        # connection
+        self._waiting = {}
+
+    def _tags(self, key):
+        return ["destination:%s:%s" % key[1:]]
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key, ())
+        if any(conn.state == "QUIESCENT" for conn in connections):
+            self.metrics.increment("http_pool.hit", tags=self._tags(key))
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        tags = self._tags(key)
+        self.metrics.increment("http_pool.miss", tags=tags)
+        if self.max_connections and \
+                self._open.get(key, 0) >= self.max_connections:
+            # Wait for a connection to come back to the pool
+            self.metrics.increment("http_pool.queued", tags=tags)
+            waiting = self._waiting.setdefault(key, deque())
+            entry = []
+            d = Deferred(lambda _: self._cancel_waiting(key, entry))
+            entry.extend([d, endpoint, self._reactor.seconds()])
+            waiting.append(entry)
+            return d
+        return self._connect(key, endpoint)
+
+    def _connect(self, key, endpoint):
+        self._open[key] = self._open.get(key, 0) + 1
+        self.metrics.increment("http_pool.connect", tags=self._tags(key))
+        factory = self._factory(
+            lambda conn: self._putConnection(key, conn),
+            lambda conn: self._lost(key),
+        )
+        d = endpoint.connect(factory)
+        d.addErrback(self._connect_failed, key)
+        return d
+
+    def _connect_failed(self, failure, key):
+        self._release(key)
+        return failure
+
+    def _lost(self, key):
+        self.metrics.increment("http_pool.disconnect", tags=self._tags(key))
+        self._release(key)
+
+    def _release(self, key):
+        """Account for a closed connection, opening one for the next
+        request waiting"""
+        self._open[key] -= 1
+        if not self._open[key]:
+            del self._open[key]
+        d, endpoint = self._next_waiting(key)
+        if d is not None:
+            self._connect(key, endpoint).chainDeferred(d)
+
+    def _putConnection(self, key, connection):
+        HTTPConnectionPool._putConnection(self, key, connection)
+        if self._waiting.get(key):
+            # Not from within the response the connection just finished
+            self._reactor.callLater(0, self._reuse_waiting, key)
+
+    def _reuse_waiting(self, key):
+        """Hand idle connections to the requests waiting for one"""
+        while any(conn.state == "QUIESCENT"
+                  for conn in self._connections.get(key, ())):
+            d, endpoint = self._next_waiting(key)
+            if d is None:
+                return
+            HTTPConnectionPool.getConnection(
+                self, key, endpoint).chainDeferred(d)
+
+    def _next_waiting(self, key):
+        waiting = self._waiting.get(key)
+        if not waiting:
+            return None, None
+        d, endpoint, queued_at = waiting.popleft()
+        if not waiting:
+            del self._waiting[key]
+        self.metrics.timing("http_pool.wait",
+                            self._reactor.seconds() - queued_at,
+                            tags=self._tags(key))
+        return d, endpoint
+
+    def _cancel_waiting(self, key, entry):
+        waiting = self._waiting.get(key)
+        if waiting and entry in waiting:
+            waiting.remove(entry)
+            if not waiting:
+                del self._waiting[key]
@@ -0,0 +1,228 @@
+"""Retry budgets and adaptive concurrency for throttled tables
+
+When DynamoDB throttles a table, immediately retrying every failed call
+keeps the table throttled. :class:`RetryPolicy` instead retries throttled
+calls after an exponential backoff with jitter, only while the table's
+:class:`RetryBudget` has tokens left, and limits the calls in flight per
+table with an :class:`AIMDLimit` that backs off on throttling.
+
+"""
+import random
+import time
+from collections import defaultdict, deque
+
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+
+def backoff(attempt, base_delay=0.05, max_delay=5.0):
+    """Return a randomized delay before retry number ``attempt``
+
+    Uses "full jitter", a delay picked uniformly up to an exponentially
+    growing, capped ceiling, so retries from many nodes spread out.
+
+    """
+    # Bound the exponent, callers retrying indefinitely pass any attempt
+    return random.uniform(0, min(max_delay,
+                                 base_delay * 2 ** min(attempt, 16)))
+
+
+class RetryBudget(object):
+    """Token bucket of retries, refilled at ``rate`` tokens a second up to
+    ``burst`` tokens"""
+    def __init__(self, rate=10.0, burst=20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def acquire(self):
+        """Take a token for a retry, returns False if there are none"""
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AIMDLimit(object):
+    """Additive increase, multiplicative decrease limit of calls in flight
+
+    Every successful call raises the limit by ``increase / limit``, so it
+    grows by about ``increase`` for each limit's worth of calls. A
+    throttled call multiplies it by ``decrease``, at most once every
+    ``cooldown`` seconds so a burst of throttles from calls already in
+    flight only counts once.
+
+    """
+    def __init__(self, maximum, minimum=1, increase=1.0, decrease=0.5,
+                 cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.active = 0
+        self._decreased_at = 0
+
+    def available(self):
+        return self.active < max(self.minimum, int(self.limit))
+
+    def succeeded(self):
+        self.limit = min(self.maximum,
+                         self.limit + self.increase / self.limit)
+
+    def throttled(self):
+        now = time.time()
+        if now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class TableThrottle(object):
+    """Retry budget, concurrency limit and waiting calls of a table"""
+    def __init__(self, name, budget, limit):
+        self.name = name
+        self.tags = ["table:%s" % name]
+        self.budget = budget
+        self.limit = limit
+        # Rank -> deque of (Deferred, run, attempt)
+        self.waiting = defaultdict(deque)
+
+    def next_waiting(self):
+        """Pop the waiting call with the lowest rank, if any"""
+        for rank in sorted(self.waiting):
+            if self.waiting[rank]:
+                return self.waiting[rank].popleft()
+        return None
+
+
+class RetryPolicy(object):
+    """Retries calls throttled by DynamoDB within a per-table budget"""
+    def __init__(self, metrics, max_concurrency=50, max_attempts=3,
+                 base_delay=0.05, max_delay=5.0, budget_rate=10.0,
+                 budget_burst=20):
+        """Create a new RetryPolicy
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param max_concurrency: Most calls in flight per table, the
+                                :class:`AIMDLimit` never exceeds this.
+        :param max_attempts: Most attempts of a call before its throttling
+                             error is returned.
+        :param base_delay: Seconds of backoff ceiling for the first retry.
+        :param max_delay: Seconds the backoff ceiling is capped at.
+        :param budget_rate: Retries a second each table's budget regains.
+        :param budget_burst: Retries each table's budget holds.
+
+        """
+        self.metrics = metrics
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_rate = budget_rate
+        self.budget_burst = budget_burst
+        self.tables = {}
+
+    def delay(self, attempt):
+        """Backoff delay before retry number ``attempt``"""
+        return backoff(attempt, self.base_delay, self.max_delay)
+
+    def retry_later(self, func, attempt, retry, *args, **kwargs):
+        """Call ``retry(*args, **kwargs)`` after the backoff of retry number
+        ``attempt`` of ``func``
+
+        For callers that retry until a call succeeds. Each retry takes a
+        token from the budget of the table ``func`` uses, and while the
+        budget is empty retries wait ``max_delay`` instead.
+
+        :returns: The ``IDelayedCall`` of the retry.
+
+        """
+        table = self.table_for(func)
+        delay = self.delay(attempt)
+        if table is not None:
+            if table.budget.acquire():
+                self.metrics.increment("db_retry.retry", tags=table.tags)
+            else:
+                self.metrics.increment("db_retry.deferred", tags=table.tags)
+                delay = self.max_delay
+        return reactor.callLater(delay, retry, *args, **kwargs)
+
+    def table_for(self, func):
+        """Return the :class:`TableThrottle` of the table a table
+        abstraction method uses, or None for other functions"""
+        table = getattr(getattr(func, "__self__", None), "table", None)
+        name = getattr(table, "table_name", None)
+        if name is None:
+            return None
+        if name not in self.tables:
+            self.tables[name] = TableThrottle(
+                name,
+                RetryBudget(self.budget_rate, self.budget_burst),
+                AIMDLimit(self.max_concurrency))
+        return self.tables[name]
+
+    def call(self, func, run, rank=0):
+        """Run attempts of ``func`` within its table's limits
+
+        :param func: The table abstraction method being called.
+        :param run: Callable starting a single attempt of the call, and
+                    returning a deferred.
+        :param rank: Waiting calls of a table start lowest rank first.
+        :returns: A deferred firing with the result of the last attempt.
+
+        """
+        table = self.table_for(func)
+        if table is None:
+            return maybeDeferred(run)
+        d = Deferred()
+        table.waiting[rank].append((d, run, 0))
+        self._start(table)
+        return d
+
+    def _start(self, table):
+        """Start waiting calls while the table is under its limit"""
+        while table.limit.available():
+            waiting = table.next_waiting()
+            if waiting is None:
+                break
+            d, run, attempt = waiting
+            table.limit.active += 1
+            call = maybeDeferred(run)
+            call.addBoth(self._finished, table, d, run, attempt)
+
+    def _finished(self, result, table, d, run, attempt):
+        table.limit.active -= 1
+        throttled = (isinstance(result, Failure) and
+                     result.check(ProvisionedThroughputExceededException))
+        if not throttled:
+            table.limit.succeeded()
+            d.callback(result)
+            self._start(table)
+            return
+
+        table.limit.throttled()
+        self.metrics.gauge("db_retry.limit", int(table.limit.limit),
+                           tags=table.tags)
+        if attempt + 1 < self.max_attempts and table.budget.acquire():
+            self.metrics.increment("db_retry.retry", tags=table.tags)
+            reactor.callLater(self.delay(attempt), self._retry, table,
+                              (d, run, attempt + 1))
+        else:
+            self.metrics.increment("db_retry.exhausted", tags=table.tags)
+            d.errback(result)
+        self._start(table)
+
+    def _retry(self, table, waiting):
+        """Queue a retry ahead of the table's other waiting calls"""
+        table.waiting[-1].append(waiting)
+        self._start(table)
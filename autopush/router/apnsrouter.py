@@ -56,7 +56,7 @@ class APNSRouter(object):
     def check_token(self, token):
         return (True, token)
 
-    def route_notification(self, notification, uaid_data):
+    def route_notification(self, notification, uaid_data, context=None):
         """Start the APNS notification routing, returns a deferred"""
         router_data = uaid_data["router_data"]
         # Kick the entire notification routing off to a thread
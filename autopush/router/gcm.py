@@ -51,7 +51,7 @@ class GCMRouter(object):
         router_data["creds"] = self.senderIDs.get_ID(router_token)
         return router_data
 
-    def route_notification(self, notification, uaid_data):
+    def route_notification(self, notification, uaid_data, context=None):
         """Start the GCM notification routing, returns a deferred"""
         router_data = uaid_data["router_data"]
         # Kick the entire notification routing off to a thread
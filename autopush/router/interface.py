@@ -1,4 +1,6 @@
 """Router interface"""
+from twisted.internet.defer import succeed
+
 from autopush.exceptions import AutopushException
 
 
@@ -39,6 +41,51 @@ class RouterResponse(object):
         self.logged_status = logged_status
 
 
+class RouteContext(object):
+    """Router record of a user, shared by the steps routing one notification
+
+    The endpoint passes the record it looked the user up with, which may
+    come from the router item cache. Steps that can't use a stale record
+    ask for :meth:`consistent_record`, which only reads it again when the
+    record held isn't already consistent. Writes that return the record
+    keep it with :meth:`update`.
+
+    """
+    def __init__(self, settings, uaid, record, consistent=False):
+        """Create a new RouteContext
+
+        :param uaid: UAID the notification is addressed to.
+        :param record: Router record the notification was addressed with.
+        :param consistent: Whether ``record`` came from a consistent read.
+
+        """
+        self.settings = settings
+        self.uaid = uaid
+        self.record = record
+        self.consistent = consistent
+
+    def consistent_record(self, priority):
+        """Return the record as currently stored, reading it at ``priority``
+        if needed
+
+        :returns: A deferred firing with the router record.
+
+        """
+        if self.consistent:
+            return succeed(self.record)
+        d = self.settings.db_scheduler.call(priority,
+                                            self.settings.router.get_uaid,
+                                            self.uaid, use_cache=False)
+        d.addCallback(self.update)
+        return d
+
+    def update(self, record):
+        """Keep a record read or written consistently"""
+        self.record = record
+        self.consistent = True
+        return record
+
+
 class IRouter(object):
     def __init__(self, settings, router_conf):
         """Initialize the Router to handle notifications and registrations with
@@ -79,12 +126,13 @@ class IRouter(object):
         """
         raise NotImplementedError("check_token must be implemented")
 
-    def route_notification(self, notification, uaid_data):
+    def route_notification(self, notification, uaid_data, context=None):
         """Route a notification
 
         :param notification: A :class:`~autopush.endpoint.Notificaiton`
                              instance.
         :param uaid_data: A dict of the full user item from the db record.
+        :param context: The :class:`RouteContext` of the request, if any.
         :returns: A response object upon successful routing.
         :rtype: :class:`RouterResponse`
         :raises: :exc:`RouterException` if routing fails.
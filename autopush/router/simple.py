@@ -7,7 +7,6 @@ based channel ID's (only newest version is stored, no data stored).
 """
 import json
 import requests
-import time
 from urllib import urlencode
 from StringIO import StringIO
 
@@ -15,7 +14,6 @@ from boto.dynamodb2.exceptions import (
     ItemNotFound,
     ProvisionedThroughputExceededException,
 )
-from repoze.lru import LRUCache
 from twisted.internet.threads import deferToThread
 from twisted.internet.defer import (
     inlineCallbacks,
@@ -29,21 +27,16 @@ from twisted.internet.error import (
 from twisted.logger import Logger
 from twisted.web.client import FileBodyProducer
 
+from autopush.channel import http_fallback
 from autopush.protocol import IgnoreBody
+from autopush.scheduler import BACKGROUND, DELIVERY
 from autopush.router.interface import (
+    RouteContext,
     RouterException,
     RouterResponse,
 )
 
 
-dead_cache = LRUCache(150)
-
-
-def node_key(node_id):
-    """Generate a node key for the dead node cache"""
-    return node_id + "-%s" % int(time.time() / 3600)
-
-
 class SimpleRouter(object):
     """Implements :class:`autopush.router.interface.IRouter` for internal
     routing to an Autopush node
@@ -67,7 +60,7 @@ class SimpleRouter(object):
     def check_token(self, token):
         return (True, token)
 
-    def preflight_check(self, uaid, channel_id):
+    def preflight_check(self, uaid, channel_id, context):
         """Verifies this routing call can be done successfully"""
         return True
 
@@ -78,19 +71,28 @@ class SimpleRouter(object):
         return RouterResponse(200, "Delivered")
 
     @inlineCallbacks
-    def route_notification(self, notification, uaid_data):
+    def route_notification(self, notification, uaid_data, context=None):
         """Route a notification to an internal node, and store it if the node
         can't deliver immediately or is no longer a valid node
+
+        The router record is read again only where a stale one matters,
+        through the request's
+        :class:`~autopush.router.interface.RouteContext`.
+
         """
         # Determine if they're connected at the moment
         node_id = uaid_data.get("node_id")
         uaid = uaid_data["uaid"]
         self.udp = uaid_data.get("udp")
         router = self.ap_settings.router
+        nodes = self.ap_settings.node_directory
+        if context is None:
+            context = RouteContext(self.ap_settings, uaid, uaid_data)
 
         # Preflight check, hook used by webpush to verify channel id, extra
         # stores any additional data to pass to storing the message
-        extra = yield self.preflight_check(uaid, notification.channel_id)
+        extra = yield self.preflight_check(uaid, notification.channel_id,
+                                           context)
 
         # Node_id is present, attempt delivery.
         # - Send Notification to node
@@ -98,6 +100,12 @@ class SimpleRouter(object):
         #   - Error (Node busy): Jump to Save notification below
         #   - Error (Client gone, node gone/dead): Clear node entry for user
         #       - Both: Done, return 503
+        # Node_id of a node known to be dead: Save notification. The node
+        # entry is only cleared after a request for this client failed, a
+        # node marked dead by another client's request may still hold it.
+        if node_id and not nodes.alive(node_id):
+            self.metrics.increment("updates.client.host_dead")
+            node_id = None
         if node_id:
             result = None
             try:
@@ -105,9 +113,8 @@ class SimpleRouter(object):
                                                        notification)
             except (ConnectError, UserError, ConnectionRefusedError) as exc:
                 self.metrics.increment("updates.client.host_gone")
-                dead_cache.put(node_key(node_id), True)
-                yield deferToThread(router.clear_node,
-                                    uaid_data).addErrback(self._eat_db_err)
+                nodes.mark_dead(node_id)
+                yield self._clear_node(uaid_data)
                 if isinstance(exc, ConnectionRefusedError):
                     # Occurs if an IP record is now used by some other node
                     # in AWS.
@@ -122,51 +129,67 @@ class SimpleRouter(object):
         #   - Error (db error): Done, return 503
         try:
             result = yield self._save_notification(uaid, notification, extra)
-            if result is False:
-                self.metrics.increment("router.broadcast.miss")
-                returnValue(self.stored_response(notification))
         except ProvisionedThroughputExceededException:
             raise RouterException("Provisioned throughput error",
                                   status_code=503,
                                   response_body="Retry Request",
                                   errno=201)
+        if result is False:
+            self.metrics.increment("router.broadcast.miss")
+            returnValue(self.stored_response(notification))
 
-        # - Lookup client
-        #   - Success (node found): Notify node of new notification
-        #     - Success: Done, return 200
-        #     - Error (no client): Done, return 202
-        #     - Error (no node): Clear node entry
-        #       - Both: Done, return 202
-        #   - Success (no node): Done, return 202
-        #   - Error (db error): Done, return 202
-        #   - Error (no client) : Done, return 404
+        # Let the client's next hello know to check storage. The record
+        # written is also the freshest read of the client's node. The
+        # message is already stored, so a throttled write mustn't have the
+        # sender retry it. The flag is retried in the background instead,
+        # and the client's node read to check it now.
         try:
-            uaid_data = yield deferToThread(router.get_uaid, uaid)
+            uaid_data = yield self.ap_settings.db_scheduler.call(
+                DELIVERY, router.mark_messages_stored, uaid)
         except ProvisionedThroughputExceededException:
-            self.metrics.increment("router.broadcast.miss")
-            returnValue(self.stored_response(notification))
-        except ItemNotFound:
+            self.log.info("Throttled flagging stored messages for {uaid}",
+                          uaid=uaid)
+            self._retry_mark_stored(uaid)
+            try:
+                uaid_data = yield context.consistent_record(DELIVERY)
+            except ProvisionedThroughputExceededException:
+                self.metrics.increment("router.broadcast.miss")
+                returnValue(self.stored_response(notification))
+            except ItemNotFound:
+                uaid_data = None
+        if uaid_data is None:
             self.metrics.increment("updates.client.deleted")
             raise RouterException("User was deleted",
                                   status_code=410,
                                   response_body="Invalid UAID",
                                   errno=105)
+        context.update(uaid_data)
 
+        # - Lookup client
+        #   - Success (node found): Notify node of new notification
+        #     - Success: Done, return 200
+        #     - Error (no client): Done, return 202
+        #     - Error (no node): Clear node entry
+        #       - Both: Done, return 202
+        #   - Success (no node): Done, return 202
+        #   - Error (no client) : Done, return 410
         # Verify there's a node_id in here, if not we're done
         node_id = uaid_data.get("node_id")
         if not node_id:
             self.metrics.increment("router.broadcast.miss")
             returnValue(self.stored_response(notification))
+        if not nodes.alive(node_id):
+            self.metrics.increment("updates.client.host_dead")
+            self.metrics.increment("router.broadcast.miss")
+            returnValue(self.stored_response(notification))
         try:
             result = yield self._send_notification_check(uaid, node_id)
         except (ConnectError, UserError, ConnectionRefusedError) as exc:
             self.metrics.increment("updates.client.host_gone")
-            dead_cache.put(node_key(node_id), True)
+            nodes.mark_dead(node_id)
             if isinstance(exc, ConnectionRefusedError):
                 self.log.debug("Could not route message: {exc}", exc=exc)
-            yield deferToThread(
-                router.clear_node,
-                uaid_data).addErrback(self._eat_db_err)
+            yield self._clear_node(uaid_data)
             self.metrics.increment("router.broadcast.miss")
             returnValue(self.stored_response(notification))
 
@@ -200,26 +223,82 @@ class SimpleRouter(object):
         message storage to subclass and override.
 
         """
-        return deferToThread(self.ap_settings.storage.save_notification,
-                             uaid=uaid, chid=notification.channel_id,
-                             version=notification.version)
+        return self.ap_settings.db_scheduler.call(
+            DELIVERY, self.ap_settings.storage.save_notification,
+            uaid=uaid, chid=notification.channel_id,
+            version=notification.version)
 
     def _send_notification(self, uaid, node_id, notification):
         """Send a notification to a specific node_id"""
-        payload = json.dumps({"channelID": notification.channel_id,
-                              "version": notification.version,
-                              "data": notification.data})
+        payload = {"channelID": notification.channel_id,
+                   "version": notification.version,
+                   "data": notification.data}
+        return self._push(uaid, node_id, payload)
+
+    def _push(self, uaid, node_id, payload):
+        """Send a notification payload to the node of a client, over its
+        binary channel if the settings have
+        :class:`~autopush.channel.NodeChannels`"""
+        channels = self.ap_settings.node_channels
+        if channels is not None:
+            return http_fallback(channels.push(node_id, uaid, payload),
+                                 self._push_http, uaid, node_id, payload)
+        return self._push_http(uaid, node_id, payload)
+
+    def _push_http(self, uaid, node_id, payload):
+        """Send a notification payload to the node of a client, in a bulk
+        request if the settings have a
+        :class:`~autopush.batching.PushBatcher`"""
+        batcher = self.ap_settings.push_batcher
+        if batcher is not None:
+            return batcher.send(node_id, uaid, payload)
         url = node_id + "/push/" + uaid
         d = self.ap_settings.agent.request(
             "PUT",
             url.encode("utf8"),
-            bodyProducer=FileBodyProducer(StringIO(payload)),
+            bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
         )
         d.addCallback(IgnoreBody.ignore)
         return d
 
+    def _clear_node(self, uaid_data):
+        """Clear the node of a client whose node is gone"""
+        return self.ap_settings.db_scheduler.call(
+            BACKGROUND, self.ap_settings.router.clear_node,
+            uaid_data).addErrback(self._eat_db_err)
+
+    def _retry_mark_stored(self, uaid, attempt=0):
+        """Retry flagging stored messages until the flag is written
+
+        A hello skips fetching storage for a record without the flag, so
+        the message would be stranded otherwise.
+
+        """
+        mark = self.ap_settings.router.mark_messages_stored
+        self.ap_settings.db_retry.retry_later(
+            mark, attempt, self._mark_stored, uaid, attempt + 1)
+
+    def _mark_stored(self, uaid, attempt):
+        d = self.ap_settings.db_scheduler.call(
+            BACKGROUND, self.ap_settings.router.mark_messages_stored, uaid)
+        d.addErrback(self._mark_stored_failed, uaid, attempt)
+        return d
+
+    def _mark_stored_failed(self, fail, uaid, attempt):
+        if not fail.check(ProvisionedThroughputExceededException):
+            self.log.failure("Failed flagging stored messages", fail)
+            return
+        self._retry_mark_stored(uaid, attempt)
+
     def _send_notification_check(self, uaid, node_id):
         """Send a command to the node to check for notifications"""
+        channels = self.ap_settings.node_channels
+        if channels is not None:
+            return http_fallback(channels.check(node_id, uaid),
+                                 self._check_http, uaid, node_id)
+        return self._check_http(uaid, node_id)
+
+    def _check_http(self, uaid, node_id):
         url = node_id + "/notif/" + uaid
         return self.ap_settings.agent.request(
             "PUT",
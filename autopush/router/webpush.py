@@ -5,20 +5,16 @@ node, or stores each individual message, along with its data, in a Message
 table for retrieval by the client.
 
 """
-import json
 import time
-from StringIO import StringIO
 
 from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
 )
-from twisted.internet.threads import deferToThread
-from twisted.web.client import FileBodyProducer
 
-from autopush.protocol import IgnoreBody
 from autopush.router.interface import RouterException, RouterResponse
 from autopush.router.simple import SimpleRouter
+from autopush.scheduler import DELIVERY, INTERACTIVE
 from autopush.db import normalize_id
 
 TTL_URL = "https://webpush-wg.github.io/webpush-protocol/#rfc.section.6.2"
@@ -60,22 +56,24 @@ class WebPushRouter(SimpleRouter):
         return data
 
     @inlineCallbacks
-    def preflight_check(self, uaid, channel_id):
+    def preflight_check(self, uaid, channel_id, context):
         """Verifies this routing call can be done successfully"""
-        # Locate the user agent's message table
-        record = yield deferToThread(self.ap_settings.router.get_uaid, uaid)
+        # Locate the user agent's message table. A cached router item could
+        # hold last month's table after a rotation, so it needs a consistent
+        # record.
+        record = yield context.consistent_record(INTERACTIVE)
 
         if 'current_month' not in record:
             raise RouterException("No such subscription", status_code=404,
                                   log_exception=False, errno=106)
 
         month_table = record["current_month"]
-        exists, chans = yield deferToThread(
-            self.ap_settings.message_tables[month_table].all_channels,
-            uaid=uaid)
+        exists = yield self.ap_settings.db_scheduler.call(
+            INTERACTIVE,
+            self.ap_settings.message_tables[month_table].has_channel,
+            uaid, channel_id)
 
-        if (not exists or channel_id.lower() not
-                in map(lambda x: normalize_id(x), chans)):
+        if not exists:
             raise RouterException("No such subscription", status_code=404,
                                   log_exception=False, errno=106)
         returnValue(month_table)
@@ -96,14 +94,7 @@ class WebPushRouter(SimpleRouter):
         if notification.data:
             payload["headers"] = self._crypto_headers(notification)
             payload["data"] = notification.data
-        url = node_id + "/push/" + uaid
-        d = self.ap_settings.agent.request(
-            "PUT",
-            url.encode("utf8"),
-            bodyProducer=FileBodyProducer(StringIO(json.dumps(payload))),
-        )
-        d.addCallback(IgnoreBody.ignore)
-        return d
+        return self._push(uaid, node_id, payload)
 
     def _save_notification(self, uaid, notification, month_table):
         """Saves a notification, returns a deferred.
@@ -134,7 +125,8 @@ class WebPushRouter(SimpleRouter):
         headers = None
         if notification.data:
             headers = self._crypto_headers(notification)
-        return deferToThread(
+        return self.ap_settings.db_scheduler.call(
+            DELIVERY,
             self.ap_settings.message_tables[month_table].store_message,
             uaid=uaid,
             channel_id=notification.channel_id,
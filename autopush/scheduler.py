@@ -0,0 +1,155 @@
+"""Priority-classed scheduling of blocking database work
+
+Blocking database calls share the reactor threadpool. :class:`DBScheduler`
+queues them per priority class on the reactor side and only hands each
+class a limited number of threadpool workers, so a backlog of background
+writes can't hold up the calls a client is waiting on.
+
+"""
+import time
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from autopush.asyncdb import async_method
+
+# Calls a client or app server is waiting on, such as hello registrations
+INTERACTIVE = "interactive"
+# Notification fetches and stores
+DELIVERY = "delivery"
+# Fire-and-forget writes, such as ack deletes and retried cleanups
+BACKGROUND = "background"
+
+
+class PriorityClass(object):
+    """Queue and worker limit of a single priority class"""
+    def __init__(self, name, minimum, maximum):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.workers = minimum
+        self.running = 0
+        self.queue = deque()
+        self.max_wait = 0.0
+
+
+class DBScheduler(object):
+    """Runs blocking database calls in the threadpool by priority class
+
+    Each class may use up to its current number of workers, between its
+    minimum and maximum. Every ``interval`` seconds, classes whose calls
+    waited longer than ``target_wait`` get more workers and idle classes
+    give workers back. The workers of all classes are kept within
+    ``capacity``, taking workers from the lowest priority classes first.
+
+    """
+    def __init__(self, metrics, capacity=50, target_wait=0.05,
+                 interval=1.0, retry=None):
+        """Create a new DBScheduler
+
+        :param metrics: Metrics object that implements the
+                        :class:`autopush.metrics.IMetrics` interface.
+        :param capacity: Size of the reactor threadpool.
+        :param target_wait: Seconds calls may queue before their class is
+                            given more workers.
+        :param interval: Seconds between worker adjustments.
+        :param retry: Optional :class:`~autopush.retry.RetryPolicy` for
+                      throttled calls.
+
+        """
+        self.metrics = metrics
+        self.capacity = capacity
+        self.target_wait = target_wait
+        self.interval = interval
+        self.retry = retry
+        # Highest priority first
+        self.classes = [
+            PriorityClass(INTERACTIVE, max(1, capacity * 2 / 5), capacity),
+            PriorityClass(DELIVERY, max(1, capacity / 5), capacity),
+            PriorityClass(BACKGROUND, max(1, capacity / 10), capacity / 2),
+        ]
+        self.by_name = {cls.name: cls for cls in self.classes}
+        self._adjust_loop = LoopingCall(self.adjust)
+
+    def start(self):
+        """Start adjusting the worker counts"""
+        self._adjust_loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._adjust_loop.running:
+            self._adjust_loop.stop()
+
+    def call(self, priority, func, *args, **kwargs):
+        """Schedule a blocking call in a priority class
+
+        Table abstraction methods with an
+        :func:`~autopush.asyncdb.async_method` don't block, so they are
+        called directly instead. Throttled calls are retried by the
+        scheduler's :class:`~autopush.retry.RetryPolicy`, if any.
+
+        :returns: A deferred firing with the call's result.
+
+        """
+        cls = self.by_name[priority]
+
+        def run():
+            return self._run(cls, func, args, kwargs)
+        if self.retry is None:
+            return run()
+        return self.retry.call(func, run, rank=self.classes.index(cls))
+
+    def _run(self, cls, func, args, kwargs):
+        """Start a single attempt of a call"""
+        method = async_method(func)
+        if method is not None:
+            return maybeDeferred(method, *args, **kwargs)
+        d = Deferred()
+        cls.queue.append((time.time(), d, func, args, kwargs))
+        self._dispatch(cls)
+        return d
+
+    def _dispatch(self, cls):
+        """Start queued calls while the class has free workers"""
+        while cls.queue and cls.running < cls.workers:
+            queued_at, d, func, args, kwargs = cls.queue.popleft()
+            wait = time.time() - queued_at
+            cls.max_wait = max(cls.max_wait, wait)
+            self.metrics.timing("db_scheduler.%s.wait" % cls.name,
+                                duration=wait * 1000)
+            cls.running += 1
+            call = deferToThread(func, *args, **kwargs)
+            call.addBoth(self._finished, cls)
+            call.chainDeferred(d)
+
+    def _finished(self, result, cls):
+        cls.running -= 1
+        self._dispatch(cls)
+        return result
+
+    def adjust(self):
+        """Resize the worker counts from the waits seen since the last
+        adjustment, and publish the queue metrics"""
+        for cls in self.classes:
+            if cls.max_wait > self.target_wait:
+                cls.workers = min(cls.maximum,
+                                  cls.workers + max(1, cls.workers / 4))
+            elif not cls.queue and cls.workers > cls.minimum:
+                cls.workers -= 1
+
+        over = sum(cls.workers for cls in self.classes) - self.capacity
+        for cls in reversed(self.classes):
+            if over <= 0:
+                break
+            cut = min(over, cls.workers - cls.minimum)
+            cls.workers -= cut
+            over -= cut
+
+        for cls in self.classes:
+            self.metrics.gauge("db_scheduler.%s.depth" % cls.name,
+                               len(cls.queue))
+            self.metrics.gauge("db_scheduler.%s.workers" % cls.name,
+                               cls.workers)
+            cls.max_wait = 0.0
+            self._dispatch(cls)
@@ -7,24 +7,47 @@ from hashlib import sha256
 
 from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.primitives import constant_time
+from repoze.lru import ExpiringLRUCache
 from twisted.internet import reactor
 from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
 )
 from twisted.internet.threads import deferToThread
-from twisted.web.client import Agent, HTTPConnectionPool
-
+from twisted.web.client import Agent
+
+from autopush.admission import HelloAdmission
+from autopush.asyncdb import (
+    AsyncDynamoDBConnection,
+    AsyncMessage,
+    AsyncRouter,
+    AsyncStorage,
+)
+from autopush.batching import (
+    AckDeleteBatcher,
+    PushBatcher,
+    RouterUpdateBatcher,
+)
+from autopush.channel import NodeChannels
 from autopush.db import (
     get_router_table,
     get_storage_table,
     get_rotating_message_table,
+    make_rotating_tablename,
     preflight_check,
     Storage,
     Router,
     Message,
 )
+from autopush.drain import ConnectionDrainer
 from autopush.exceptions import InvalidTokenException
+from autopush.liveness import NodeDirectory
+from autopush.memory import (
+    get_memory_table,
+    MemoryMessage,
+    MemoryRouter,
+    MemoryStorage,
+)
 from autopush.metrics import (
     DatadogMetrics,
     TwistedMetrics,
@@ -37,7 +60,11 @@ from autopush.router import (
     WebPushRouter,
 )
 from autopush.utils import canonical_url, resolve_ip, base64url_decode
+from autopush.pool import NodeConnectionPool
+from autopush.retry import RetryPolicy
+from autopush.scheduler import DBScheduler
 from autopush.senderids import SENDERID_EXPRY, DEFAULT_BUCKET
+from autopush.timerwheel import TimerWheel
 from autopush.crypto_key import (CryptoKey, CryptoKeyException)
 
 
@@ -66,6 +93,10 @@ class AutopushSettings(object):
                  router_tablename="router",
                  router_read_throughput=5,
                  router_write_throughput=5,
+                 router_cache_size=0,
+                 router_cache_ttl=60,
+                 channel_cache_size=0,
+                 channel_cache_ttl=60,
                  storage_tablename="storage",
                  storage_read_throughput=5,
                  storage_write_throughput=5,
@@ -84,7 +115,32 @@ class AutopushSettings(object):
                  senderid_expry=SENDERID_EXPRY,
                  senderid_list={},
                  hello_timeout=0,
+                 hello_prefetch=False,
+                 hello_skip_storage=False,
                  bear_hash_key=None,
+                 ack_batch_interval=0.005,
+                 router_write_rate=0,
+                 timer_resolution=1.0,
+                 hello_concurrency=0,
+                 hello_queue_size=10000,
+                 hello_queue_timeout=30,
+                 hello_latency_target=1.0,
+                 drain_rate=100,
+                 outbound_queue_size=10,
+                 outbound_queue_bytes=32768,
+                 route_batch_interval=0,
+                 route_batch_size=100,
+                 node_probe_interval=10,
+                 channel_offset=0,
+                 channel_window=100,
+                 http_pool_size=10,
+                 http_pool_idle_timeout=240,
+                 http_pool_max_connections=0,
+                 uaid_index=None,
+                 db_backend="dynamodb",
+                 db_async=False,
+                 db_threads=50,
+                 db_retry_budget=10.0,
                  ):
         """Initialize the Settings object
 
@@ -93,10 +149,6 @@ class AutopushSettings(object):
         will have a preflight check done.
 
         """
-        # Use a persistent connection pool for HTTP requests.
-        pool = HTTPConnectionPool(reactor)
-        self.agent = Agent(reactor, connectTimeout=5, pool=pool)
-
         # Metrics setup
         if datadog_api_key:
             self.metrics = DatadogMetrics(
@@ -108,6 +160,22 @@ class AutopushSettings(object):
             self.metrics = TwistedMetrics(statsd_host, statsd_port)
         else:
             self.metrics = SinkMetrics()
+
+        # Use a persistent connection pool for HTTP requests.
+        pool = NodeConnectionPool(reactor, self.metrics,
+                                  max_idle=http_pool_size,
+                                  idle_timeout=http_pool_idle_timeout,
+                                  max_connections=http_pool_max_connections)
+        self.agent = Agent(reactor, connectTimeout=5, pool=pool)
+
+        # Throttled database calls back off within a per-table budget
+        self.db_retry = RetryPolicy(self.metrics,
+                                    max_concurrency=db_threads,
+                                    budget_rate=db_retry_budget,
+                                    budget_burst=int(db_retry_budget * 2))
+        # Threadpool workers for blocking database calls, by priority
+        self.db_scheduler = DBScheduler(self.metrics, capacity=db_threads,
+                                        retry=self.db_retry)
         if not crypto_key:
             crypto_key = [Fernet.generate_key()]
         if not isinstance(crypto_key, list):
@@ -123,6 +191,9 @@ class AutopushSettings(object):
 
         self.max_data = max_data
         self.clients = {}
+        # Notifications accepted per client while its output is paused
+        self.outbound_queue_size = outbound_queue_size
+        self.outbound_queue_bytes = outbound_queue_bytes
 
         # Setup hosts/ports/urls
         default_hostname = socket.gethostname()
@@ -141,6 +212,18 @@ class AutopushSettings(object):
             router_port
         )
 
+        # Clients held by the other workers of a multi-process node, and
+        # the internal router of each worker
+        self.uaid_index = uaid_index
+        self.worker_urls = []
+        if uaid_index is not None:
+            first_port = router_port - uaid_index.worker
+            self.worker_urls = [
+                canonical_url(router_scheme or 'http', self.router_hostname,
+                              first_port + worker)
+                for worker in range(uaid_index.workers)
+            ]
+
         self.endpoint_url = canonical_url(
             endpoint_scheme or 'http',
             self.endpoint_hostname,
@@ -148,18 +231,39 @@ class AutopushSettings(object):
         )
 
         # Database objects
-        self.router_table = get_router_table(router_tablename,
-                                             router_read_throughput,
-                                             router_write_throughput)
-        self.storage_table = get_storage_table(
-            storage_tablename,
-            storage_read_throughput,
-            storage_write_throughput)
-        self.message_table = get_rotating_message_table(
-            message_tablename)
+        self.db_backend = db_backend
         self._message_prefix = message_tablename
-        self.storage = Storage(self.storage_table, self.metrics)
-        self.router = Router(self.router_table, self.metrics)
+        if db_backend == "memory":
+            self.router_table = get_memory_table(router_tablename)
+            self.storage_table = get_memory_table(storage_tablename)
+            self.storage = MemoryStorage(self.storage_table, self.metrics)
+            self.router = MemoryRouter(self.router_table, self.metrics)
+        else:
+            self.router_table = get_router_table(router_tablename,
+                                                 router_read_throughput,
+                                                 router_write_throughput)
+            self.storage_table = get_storage_table(
+                storage_tablename,
+                storage_read_throughput,
+                storage_write_throughput)
+            self.storage = Storage(self.storage_table, self.metrics)
+            self.router = Router(self.router_table, self.metrics,
+                                 cache_size=router_cache_size,
+                                 cache_ttl=router_cache_ttl)
+        # Send database calls made with db_call over HTTP from the reactor
+        self.db_connection = None
+        if db_async and db_backend == "dynamodb":
+            self.db_connection = AsyncDynamoDBConnection()
+            self.storage.async_db = AsyncStorage(self.storage,
+                                                 self.db_connection)
+            self.router.async_db = AsyncRouter(self.router,
+                                               self.db_connection)
+        self.message_table = self._get_message_table()
+        # Channel sets shared by every message table
+        self.channel_cache = None
+        if channel_cache_size > 0:
+            self.channel_cache = ExpiringLRUCache(
+                channel_cache_size, default_timeout=channel_cache_ttl)
 
         # Used to determine whether a connection is out of date with current
         # db objects. There are three noteworty cases:
@@ -196,6 +300,63 @@ class AutopushSettings(object):
         self.env = env
 
         self.hello_timeout = hello_timeout
+        # Fetch stored notifications in parallel with hello registration
+        self.hello_prefetch = hello_prefetch
+        # Skip the hello storage query for records flagged as drained
+        self.hello_skip_storage = hello_skip_storage
+        # Clients whose hello is being registered, by UAID, while either of
+        # the above relies on the stored messages flag
+        self.pending_hellos = {}
+
+        # Coalesce webpush ack deletes across connections
+        self.ack_batcher = None
+        if ack_batch_interval > 0:
+            self.ack_batcher = AckDeleteBatcher(self.metrics,
+                                                ack_batch_interval,
+                                                self.db_scheduler,
+                                                self.db_retry)
+
+        # Timer wheel shared by per-connection timeouts
+        self.timers = None
+        if timer_resolution > 0:
+            self.timers = TimerWheel(timer_resolution)
+
+        # Bulk requests of the notifications routed to each connection node
+        self.push_batcher = None
+        if route_batch_interval > 0:
+            self.push_batcher = PushBatcher(self.metrics, self.agent,
+                                            interval=route_batch_interval,
+                                            max_batch=route_batch_size)
+
+        # Connection nodes that couldn't be reached
+        self.node_directory = NodeDirectory(
+            self.metrics, self.agent, probe_interval=node_probe_interval)
+
+        # Binary channels to the connection nodes, in place of HTTP
+        self.node_channels = None
+        if channel_offset:
+            self.node_channels = NodeChannels(self.metrics, channel_offset,
+                                              window=channel_window)
+
+        # Registrations of client hellos in flight, the others wait
+        self.hello_admission = None
+        if hello_concurrency > 0:
+            self.hello_admission = HelloAdmission(
+                self.metrics, max_concurrency=hello_concurrency,
+                max_queue=hello_queue_size,
+                queue_timeout=hello_queue_timeout,
+                latency_target=hello_latency_target,
+                clock=self.timers)
+
+        # Paced close of the connected clients before a shutdown
+        self.drainer = ConnectionDrainer(self, rate=drain_rate)
+
+        # Write-behind buffer of last_connect and current_month updates
+        self.router_updates = None
+        if router_write_rate > 0:
+            self.router_updates = RouterUpdateBatcher(
+                self.metrics, self.router, max_writes=router_write_rate,
+                scheduler=self.db_scheduler)
 
     @property
     def message(self):
@@ -210,6 +371,23 @@ class AutopushSettings(object):
     def _tomorrow(self):
         return datetime.date.today() + datetime.timedelta(days=1)
 
+    def _get_message_table(self, delta=0, date=None):
+        """Get the message table for a month, creating it if needed"""
+        if self.db_backend == "memory":
+            return get_memory_table(make_rotating_tablename(
+                self._message_prefix, delta, date))
+        return get_rotating_message_table(self._message_prefix, delta, date)
+
+    def _make_message(self, table):
+        """Create a message table abstraction for a message table"""
+        if self.db_backend == "memory":
+            return MemoryMessage(table, self.metrics)
+        message = Message(table, self.metrics,
+                          channel_cache=self.channel_cache)
+        if self.db_connection is not None:
+            message.async_db = AsyncMessage(message, self.db_connection)
+        return message
+
     def create_initial_message_tables(self):
         """Initializes a dict of the initial rotating messages tables.
 
@@ -218,18 +396,18 @@ class AutopushSettings(object):
 
         """
         today = datetime.date.today()
-        last_month = get_rotating_message_table(self._message_prefix, -1)
-        this_month = get_rotating_message_table(self._message_prefix)
+        last_month = self._get_message_table(-1)
+        this_month = self._get_message_table()
         self.current_month = today.month
         self.current_msg_month = this_month.table_name
         self.message_tables = {
-            last_month.table_name: Message(last_month, self.metrics),
-            this_month.table_name: Message(this_month, self.metrics)
+            last_month.table_name: self._make_message(last_month),
+            this_month.table_name: self._make_message(this_month)
         }
         if self._tomorrow().month != today.month:
-            next_month = get_rotating_message_table(delta=1)
-            self.message_tables[next_month.table_name] = Message(
-                next_month, self.metrics)
+            next_month = self._get_message_table(delta=1)
+            self.message_tables[next_month.table_name] = \
+                self._make_message(next_month)
 
     @inlineCallbacks
     def update_rotating_tables(self):
@@ -245,10 +423,9 @@ class AutopushSettings(object):
         if ((tomorrow.month != today.month) and
                 sorted(self.message_tables.keys())[-1] !=
                 tomorrow.month):
-            next_month = get_rotating_message_table(
-                self._message_prefix, 0, tomorrow)
-            self.message_tables[next_month.table_name] = Message(
-                next_month, self.metrics)
+            next_month = self._get_message_table(0, tomorrow)
+            self.message_tables[next_month.table_name] = \
+                self._make_message(next_month)
 
         if today.month == self.current_month:
             # No change in month, we're fine.
@@ -256,14 +433,13 @@ class AutopushSettings(object):
 
         # Get tables for the new month, and verify they exist before we try to
         # switch over
-        message_table = yield deferToThread(get_rotating_message_table,
-                                            self._message_prefix)
+        message_table = yield deferToThread(self._get_message_table)
 
         # Both tables found, safe to switch-over
         self.current_month = today.month
         self.current_msg_month = message_table.table_name
         self.message_tables[self.current_msg_month] = \
-            Message(message_table, self.metrics)
+            self._make_message(message_table)
         returnValue(True)
 
     def update(self, **kwargs):
@@ -0,0 +1,90 @@
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.admission import HelloAdmission
+from autopush.exceptions import AdmissionRejected
+
+
+class HelloAdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock()
+        self.admission = HelloAdmission(self.metrics, max_concurrency=2,
+                                        max_queue=2, queue_timeout=10,
+                                        latency_target=1.0,
+                                        clock=self.clock)
+
+    def test_queued(self):
+        registrations = [Deferred() for _ in range(3)]
+        results = []
+        for reg in registrations:
+            d = self.admission.call(lambda reg=reg: reg)
+            d.addCallback(results.append)
+        eq_(self.admission.limit.active, 2)
+        eq_(len(self.admission), 1)
+
+        self.clock.advance(0.5)
+        registrations[0].callback("a")
+        eq_(results, ["a"])
+        eq_(len(self.admission), 0)
+        self.metrics.timing.assert_called_with("hello.admission.wait", 0.5)
+        registrations[1].callback("b")
+        registrations[2].callback("c")
+        eq_(results, ["a", "b", "c"])
+        eq_(self.admission.limit.active, 0)
+        eq_(self.clock.getDelayedCalls(), [])
+
+    def test_queue_full(self):
+        for _ in range(4):
+            self.admission.call(Deferred)
+        d = self.admission.call(Deferred)
+        self.failureResultOf(d, AdmissionRejected)
+        self.metrics.increment.assert_called_with(
+            "hello.admission.rejected", tags=["reason:queue_full"])
+
+    def test_queue_timeout(self):
+        self.admission.call(Deferred)
+        self.admission.call(Deferred)
+        d = self.admission.call(Deferred)
+        self.clock.advance(10)
+        self.failureResultOf(d, AdmissionRejected)
+        eq_(len(self.admission), 0)
+        self.metrics.increment.assert_called_with(
+            "hello.admission.rejected", tags=["reason:timeout"])
+
+    def test_cancel_waiting(self):
+        self.admission.call(Deferred)
+        self.admission.call(Deferred)
+        func = Mock()
+        d = self.admission.call(func)
+        d.addErrback(lambda x: None)
+        d.cancel()
+        eq_(len(self.admission), 0)
+        eq_(self.clock.getDelayedCalls(), [])
+        ok_(not func.called)
+
+    def test_cancel_running(self):
+        reg = Deferred()
+        d = self.admission.call(lambda: reg)
+        d.addErrback(lambda x: None)
+        d.cancel()
+        reg.callback("late")
+        eq_(self.admission.limit.active, 0)
+
+    def test_backs_off_on_throttle(self):
+        err = ProvisionedThroughputExceededException(400, "Throttled")
+        d = self.admission.call(lambda: fail(err))
+        self.failureResultOf(d, ProvisionedThroughputExceededException)
+        eq_(self.admission.limit.limit, 1)
+        self.metrics.gauge.assert_any_call("hello.admission.limit", 1)
+
+    def test_backs_off_on_latency(self):
+        reg = Deferred()
+        self.admission.call(lambda: reg)
+        self.clock.advance(2)
+        reg.callback(None)
+        eq_(self.admission.limit.limit, 1)
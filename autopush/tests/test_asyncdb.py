@@ -0,0 +1,261 @@
+import uuid
+
+from boto.dynamodb2.exceptions import (
+    ConditionalCheckFailedException,
+    ItemNotFound,
+    ProvisionedThroughputExceededException,
+)
+from boto.dynamodb2.table import Table
+from boto.exception import JSONResponseError
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import fail, inlineCallbacks, succeed
+from twisted.trial import unittest
+
+from autopush.asyncdb import (
+    db_call,
+    AsyncDynamoDBConnection,
+    AsyncMessage,
+    AsyncRouter,
+    AsyncStorage,
+)
+from autopush.db import Message, Router, Storage
+from autopush.metrics import SinkMetrics
+
+
+dummy_uaid = str(uuid.UUID("abad1dea00000000aabbccdd00000000"))
+dummy_chid = str(uuid.UUID("deadbeef00000000decafbad00000000"))
+
+
+def conditional_failed(*args, **kwargs):
+    return fail(ConditionalCheckFailedException(400, "Bad Request"))
+
+
+class AsyncDynamoDBConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.agent = Mock()
+        self.conn = AsyncDynamoDBConnection(
+            agent=self.agent,
+            aws_access_key_id="access",
+            aws_secret_access_key="secret",
+        )
+
+    @patch("autopush.asyncdb.readBody")
+    @inlineCallbacks
+    def test_request(self, mock_read):
+        self.agent.request.return_value = succeed(Mock(code=200,
+                                                       phrase="OK"))
+        mock_read.return_value = succeed('{"Item": {"uaid": {"S": "x"}}}')
+        result = yield self.conn.get_item("router", {"uaid": {"S": "x"}})
+        eq_(result, {"Item": {"uaid": {"S": "x"}}})
+
+        method, url, headers, body = self.agent.request.call_args[0]
+        eq_(method, "POST")
+        eq_(url, "https://%s:443/" % self.conn.host)
+        eq_(headers.getRawHeaders("x-amz-target"),
+            ["DynamoDB_20120810.GetItem"])
+        ok_(headers.getRawHeaders("authorization")[0].startswith(
+            "AWS4-HMAC-SHA256"))
+
+    def test_errors(self):
+        with self.assertRaises(ConditionalCheckFailedException):
+            self.conn._decode_response(
+                '{"__type": "com.amazonaws.dynamodb.v20120810#'
+                'ConditionalCheckFailedException"}', 400, "Bad Request")
+        with self.assertRaises(ProvisionedThroughputExceededException):
+            self.conn._decode_response(
+                '{"__type": "com.amazonaws.dynamodb.v20120810#'
+                'ProvisionedThroughputExceededException"}', 400,
+                "Bad Request")
+        with self.assertRaises(JSONResponseError):
+            self.conn._decode_response('{"__type": "Unknown"}', 500,
+                                       "Internal Server Error")
+
+
+class DbCallTestCase(unittest.TestCase):
+    @inlineCallbacks
+    def test_twin(self):
+        router = Router(Table("router", connection=Mock()), SinkMetrics())
+        router.async_db = Mock()
+        router.async_db.get_uaid.return_value = succeed("item")
+        result = yield db_call(router.get_uaid, dummy_uaid, use_cache=False)
+        eq_(result, "item")
+        router.async_db.get_uaid.assert_called_with(dummy_uaid,
+                                                    use_cache=False)
+
+    @inlineCallbacks
+    def test_threadpool(self):
+        result = yield db_call(lambda x: x + 1, 1)
+        eq_(result, 2)
+
+
+class AsyncStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        storage = Storage(Table("storage", connection=Mock()), SinkMetrics())
+        self.storage = AsyncStorage(storage, self.conn)
+
+    @inlineCallbacks
+    def test_save_notification(self):
+        self.conn.put_item.return_value = succeed({})
+        result = yield self.storage.save_notification(dummy_uaid,
+                                                      dummy_chid, 10)
+        ok_(result)
+        self.conn.put_item.side_effect = conditional_failed
+        result = yield self.storage.save_notification(dummy_uaid,
+                                                      dummy_chid, 8)
+        eq_(result, False)
+
+    @inlineCallbacks
+    def test_delete_over_provisioned(self):
+        self.conn.delete_item.return_value = fail(
+            ProvisionedThroughputExceededException(400, "Bad Request"))
+        result = yield self.storage.delete_notification(dummy_uaid,
+                                                        dummy_chid)
+        eq_(result, False)
+
+
+class AsyncMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        message = Message(Table("message", connection=Mock()),
+                          SinkMetrics())
+        self.message = AsyncMessage(message, self.conn)
+
+    @inlineCallbacks
+    def test_fetch_messages_pages(self):
+        def item(i):
+            return {"uaid": {"S": dummy_uaid},
+                    "chidmessageid": {"S": "%s:%s" % (dummy_chid, i)}}
+        self.conn.query.side_effect = [
+            succeed({"Items": [item(0)], "LastEvaluatedKey": item(0)}),
+            succeed({"Items": [item(1)]}),
+        ]
+        results = yield self.message.fetch_messages(dummy_uaid)
+        eq_([x["chidmessageid"] for x in results],
+            ["%s:0" % dummy_chid, "%s:1" % dummy_chid])
+        eq_(self.conn.query.call_args_list[1][1]["exclusive_start_key"],
+            item(0))
+        eq_(self.conn.query.call_args_list[1][1]["limit"], 9)
+
+    @inlineCallbacks
+    def test_has_channel(self):
+        self.conn.get_item.return_value = succeed({"Item": {
+            "chids": {"SS": [dummy_chid]}}})
+        result = yield self.message.has_channel(dummy_uaid,
+                                                dummy_chid.replace("-", ""))
+        ok_(result)
+        self.conn.get_item.return_value = succeed({})
+        result = yield self.message.has_channel(dummy_uaid, dummy_chid)
+        eq_(result, False)
+
+    @inlineCallbacks
+    def test_delete_message_updateid(self):
+        self.conn.delete_item.side_effect = conditional_failed
+        result = yield self.message.delete_message(dummy_uaid, dummy_chid,
+                                                   "abc", updateid="123")
+        eq_(result, False)
+        expected = self.conn.delete_item.call_args[1]["expected"]
+        eq_(expected["updateid"]["AttributeValueList"], [{"S": "123"}])
+
+    @inlineCallbacks
+    def test_store_messages(self):
+        unprocessed = {"message": [{"PutRequest": {"Item": {}}}]}
+        self.conn.batch_write_item.side_effect = [
+            succeed({"UnprocessedItems": unprocessed}),
+            succeed({}),
+        ]
+        result = yield self.message.store_messages(dummy_uaid, [
+            dict(channel_id=dummy_chid, message_id=str(i), ttl=60,
+                 data="abc", headers={}) for i in range(30)
+        ])
+        ok_(result)
+        calls = self.conn.batch_write_item.call_args_list
+        # Unprocessed items are resent with the rest
+        eq_([len(x[0][0]["message"]) for x in calls], [25, 6])
+        item = calls[0][0][0]["message"][0]["PutRequest"]["Item"]
+        eq_(item["data"], {"S": "abc"})
+        eq_(calls[1][0][0]["message"][-1], unprocessed["message"][0])
+
+    @inlineCallbacks
+    def test_delete_messages_unprocessed(self):
+        unprocessed = {"message": [{"DeleteRequest": {"Key": {}}}]}
+        self.conn.batch_write_item.side_effect = [
+            succeed({"UnprocessedItems": unprocessed}),
+            succeed({}),
+        ]
+        yield self.message.delete_messages(dummy_uaid, ["a", "b", None])
+        eq_(len(self.conn.batch_write_item.call_args_list[0][0][0][
+            "message"]), 2)
+        eq_(self.conn.batch_write_item.call_args_list[1][0][0],
+            unprocessed)
+
+
+class AsyncRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = Mock()
+        router = Router(Table("router", connection=Mock()), SinkMetrics(),
+                        cache_size=10)
+        self.router = AsyncRouter(router, self.conn)
+
+    @inlineCallbacks
+    def test_get_uaid_cached(self):
+        self.conn.get_item.return_value = succeed({"Item": {
+            "uaid": {"S": dummy_uaid}, "node_id": {"S": "node"}}})
+        item = yield self.router.get_uaid(dummy_uaid)
+        eq_(item["node_id"], "node")
+        item = yield self.router.get_uaid(dummy_uaid)
+        eq_(item["node_id"], "node")
+        eq_(self.conn.get_item.call_count, 1)
+
+    @inlineCallbacks
+    def test_get_uaid_not_found(self):
+        self.conn.get_item.return_value = succeed({})
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid(dummy_uaid)
+
+    @inlineCallbacks
+    def test_get_uaid_incomplete(self):
+        self.conn.get_item.return_value = succeed({"Item": {
+            "uaid": {"S": dummy_uaid}}})
+        self.conn.delete_item.return_value = succeed({})
+        with self.assertRaises(ItemNotFound):
+            yield self.router.get_uaid(dummy_uaid)
+        ok_(self.conn.delete_item.called)
+
+    @inlineCallbacks
+    def test_register_user(self):
+        self.conn.update_item.return_value = succeed({"Attributes": {
+            "node_id": {"S": "old"}}})
+        result = yield self.router.register_user(dict(
+            uaid=dummy_uaid, node_id="node", connected_at=10,
+            router_type="webpush"))
+        eq_(result[:2], (True, {"node_id": "old"}))
+
+        self.conn.update_item.side_effect = conditional_failed
+        result = yield self.router.register_user(dict(
+            uaid=dummy_uaid, node_id="node", connected_at=10,
+            router_type="webpush"))
+        eq_(result[:2], (False, {}))
+
+    @inlineCallbacks
+    def test_clear_node(self):
+        self.conn.put_item.side_effect = conditional_failed
+        item = dict(uaid=dummy_uaid, node_id="node", connected_at=10)
+        result = yield self.router.clear_node(item)
+        eq_(result, False)
+        ok_("node_id" in item)
+        ok_("node_id" not in self.conn.put_item.call_args[1]["item"])
+
+    @inlineCallbacks
+    def test_messages_stored(self):
+        self.conn.update_item.return_value = succeed({"Attributes": {
+            "uaid": {"S": dummy_uaid}, "messages_stored_at": {"N": "10"}}})
+        result = yield self.router.mark_messages_stored(dummy_uaid)
+        eq_(result["messages_stored_at"], 10)
+        eq_(self.conn.update_item.call_args[1]["return_values"], "ALL_NEW")
+        self.conn.update_item.side_effect = conditional_failed
+        result = yield self.router.mark_messages_stored(dummy_uaid)
+        eq_(result, None)
+        result = yield self.router.clear_messages_stored(dummy_uaid, 10)
+        eq_(result, False)
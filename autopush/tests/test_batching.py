@@ -0,0 +1,303 @@
+import json
+import uuid
+
+from boto.dynamodb2.exceptions import (
+    ProvisionedThroughputExceededException,
+)
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import CancelledError, succeed, fail
+from twisted.trial import unittest
+
+from autopush.batching import (
+    AckDeleteBatcher,
+    PushBatcher,
+    RouterUpdateBatcher,
+)
+from autopush.metrics import SinkMetrics
+from autopush.scheduler import BACKGROUND
+
+
+dummy_uaid = str(uuid.UUID("abad1dea00000000aabbccdd00000000"))
+dummy_chid = str(uuid.UUID("deadbeef00000000decafbad00000000"))
+
+
+def run_now(func, *args, **kwargs):
+    """db_call stand-in that runs the function immediately"""
+    try:
+        return succeed(func(*args, **kwargs))
+    except Exception as exc:
+        return fail(exc)
+
+
+@patch("autopush.batching.db_call", run_now)
+@patch("autopush.batching.reactor")
+class AckDeleteBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message = Mock()
+        self.message.delete_message_batch.return_value = []
+        self.batcher = AckDeleteBatcher(SinkMetrics(), interval=0.01)
+
+    def test_delete_waits_for_flush(self, mock_reactor):
+        d = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        ok_(mock_reactor.callLater.called)
+        ok_(not d.called)
+        ok_(not self.message.delete_message_batch.called)
+
+        self.batcher.flush()
+        ok_(d.called)
+        self.message.delete_message_batch.assert_called_with(
+            [(dummy_uaid, dummy_chid, "1")])
+
+    def test_single_flush_scheduled(self, mock_reactor):
+        self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        self.batcher.delete(self.message, dummy_uaid, dummy_chid, "2")
+        eq_(len(mock_reactor.callLater.mock_calls), 1)
+
+    def test_duplicates_coalesced(self, mock_reactor):
+        d1 = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        d2 = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        self.batcher.flush()
+        self.message.delete_message_batch.assert_called_once_with(
+            [(dummy_uaid, dummy_chid, "1")])
+        ok_(d1.called)
+        ok_(d2.called)
+
+    def test_full_batch_flushes_immediately(self, mock_reactor):
+        defers = [self.batcher.delete(self.message, dummy_uaid, dummy_chid,
+                                      str(i))
+                  for i in range(30)]
+        eq_(len(self.message.delete_message_batch.mock_calls), 1)
+        args, _ = self.message.delete_message_batch.call_args
+        eq_(len(args[0]), 25)
+        ok_(all(d.called for d in defers[:25]))
+        ok_(not any(d.called for d in defers[25:]))
+
+        self.batcher.flush()
+        ok_(all(d.called for d in defers))
+
+    def test_unprocessed_retried(self, mock_reactor):
+        self.message.delete_message_batch.return_value = [
+            (dummy_uaid, dummy_chid, "2")]
+        d1 = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        d2 = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "2")
+        self.batcher.flush()
+        ok_(d1.called)
+        ok_(not d2.called)
+
+        self.message.delete_message_batch.return_value = []
+        self.batcher.flush()
+        ok_(d2.called)
+        self.message.delete_message_batch.assert_called_with(
+            [(dummy_uaid, dummy_chid, "2")])
+
+    def test_failed_batch_retried(self, mock_reactor):
+        self.message.delete_message_batch.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        d = self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        self.batcher.flush()
+        ok_(not d.called)
+        self.flushLoggedErrors()
+
+        self.message.delete_message_batch.side_effect = None
+        self.message.delete_message_batch.return_value = []
+        self.batcher.flush()
+        ok_(d.called)
+
+    def test_retry_policy(self, mock_reactor):
+        retry = Mock()
+        batcher = AckDeleteBatcher(SinkMetrics(), interval=0.01,
+                                   retry=retry)
+        self.message.delete_message_batch.return_value = [
+            (dummy_uaid, dummy_chid, "1")]
+        d = batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        batcher.flush()
+        ok_(not d.called)
+        eq_(batcher._pending, {})
+        args = retry.retry_later.call_args[0]
+        eq_(args[:2], (self.message.delete_message_batch, 0))
+
+        # Requeued once the policy calls back
+        args[2](*args[3:])
+        batcher.flush()
+        ok_(not d.called)
+        eq_(retry.retry_later.call_args[0][1], 1)
+
+        self.message.delete_message_batch.return_value = []
+        args = retry.retry_later.call_args[0]
+        args[2](*args[3:])
+        batcher.flush()
+        ok_(d.called)
+        eq_(batcher._attempts, {})
+
+    def test_tables_flushed_separately(self, mock_reactor):
+        other = Mock()
+        other.delete_message_batch.return_value = []
+        self.batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        self.batcher.delete(other, dummy_uaid, dummy_chid, "2")
+        self.batcher.flush()
+        self.message.delete_message_batch.assert_called_with(
+            [(dummy_uaid, dummy_chid, "1")])
+        other.delete_message_batch.assert_called_with(
+            [(dummy_uaid, dummy_chid, "2")])
+
+    def test_scheduler(self, mock_reactor):
+        scheduler = Mock()
+        scheduler.call.return_value = succeed([])
+        batcher = AckDeleteBatcher(SinkMetrics(), interval=0.01,
+                                   scheduler=scheduler)
+        d = batcher.delete(self.message, dummy_uaid, dummy_chid, "1")
+        batcher.flush()
+        ok_(d.called)
+        scheduler.call.assert_called_with(
+            BACKGROUND, self.message.delete_message_batch,
+            [(dummy_uaid, dummy_chid, "1")])
+
+
+@patch("autopush.batching.db_call", run_now)
+@patch("autopush.batching.reactor")
+class RouterUpdateBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = Mock()
+        self.router.update_last_connect.return_value = True
+        self.router.update_message_month.return_value = True
+        self.batcher = RouterUpdateBatcher(SinkMetrics(), self.router,
+                                           max_writes=40, interval=0.05)
+
+    def test_write_behind(self, mock_reactor):
+        d = self.batcher.update_last_connect(dummy_uaid)
+        ok_(mock_reactor.callLater.called)
+        ok_(not self.router.update_last_connect.called)
+
+        self.batcher._tick()
+        ok_(d.called)
+        self.router.update_last_connect.assert_called_with(dummy_uaid)
+
+    def test_deduplicated(self, mock_reactor):
+        d1 = self.batcher.update_last_connect(dummy_uaid)
+        d2 = self.batcher.update_last_connect(dummy_uaid)
+        d3 = self.batcher.update_message_month(dummy_uaid, "message_1")
+        d4 = self.batcher.update_last_connect(dummy_uaid)
+        eq_(len(self.batcher), 1)
+        eq_(len(mock_reactor.callLater.mock_calls), 1)
+
+        self.batcher._tick()
+        ok_(not self.router.update_last_connect.called)
+        self.router.update_message_month.assert_called_once_with(
+            dummy_uaid, "message_1")
+        ok_(all(d.called for d in (d1, d2, d3, d4)))
+
+    def test_write_ceiling(self, mock_reactor):
+        for i in range(3):
+            self.batcher.update_last_connect("uaid%s" % i)
+        self.batcher.update_message_month(dummy_uaid, "message_1")
+
+        # 40 writes a second in 0.05 second intervals is 2 a flush
+        self.batcher._tick()
+        ok_(self.router.update_message_month.called)
+        eq_(self.router.update_last_connect.call_count, 1)
+        eq_(len(self.batcher), 2)
+        eq_(len(mock_reactor.callLater.mock_calls), 2)
+
+    def test_flush(self, mock_reactor):
+        defers = [self.batcher.update_last_connect("uaid%s" % i)
+                  for i in range(5)]
+        self.batcher.flush()
+        eq_(self.router.update_last_connect.call_count, 5)
+        ok_(all(d.called for d in defers))
+        ok_(mock_reactor.callLater.return_value.cancel.called)
+
+    def test_failed_requeued(self, mock_reactor):
+        self.router.update_message_month.side_effect = \
+            ProvisionedThroughputExceededException(None, None)
+        d = self.batcher.update_message_month(dummy_uaid, "message_1")
+        self.batcher._tick()
+        ok_(not d.called)
+        eq_(len(self.batcher), 1)
+        self.flushLoggedErrors()
+
+        self.router.update_message_month.side_effect = None
+        self.batcher._tick()
+        ok_(d.called)
+
+    def test_cancelled(self, mock_reactor):
+        d = self.batcher.update_last_connect(dummy_uaid)
+        d.addErrback(lambda fail: fail.trap(CancelledError))
+        d.cancel()
+        self.batcher._tick()
+        ok_(self.router.update_last_connect.called)
+
+
+@patch("autopush.batching.reactor")
+class PushBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.agent = Mock()
+        self.response = Mock(code=200)
+        self.agent.request.return_value = succeed(self.response)
+        self.metrics = Mock()
+        self.batcher = PushBatcher(self.metrics, self.agent, max_batch=3)
+        self.node = "http://node:8081"
+
+    def _sent(self, call):
+        body = call[2]["bodyProducer"]._inputFile.getvalue()
+        return json.loads(body)
+
+    @patch("autopush.batching.readBody")
+    def test_batched_by_node(self, mock_read, mock_reactor):
+        mock_read.return_value = succeed(json.dumps({"results": [200, 404]}))
+        d1 = self.batcher.send(self.node, "a", {"channelID": "1"})
+        d2 = self.batcher.send(self.node, "b", {"channelID": "2"})
+        d3 = self.batcher.send("http://other:8081", "c", {})
+        eq_(len(mock_reactor.callLater.mock_calls), 1)
+        ok_(not self.agent.request.called)
+
+        self.batcher.flush()
+        eq_(self.agent.request.call_count, 2)
+        call = self.agent.request.mock_calls[0]
+        eq_(call[1], ("POST", self.node + "/push"))
+        eq_(self._sent(call), [
+            dict(uaid="a", update={"channelID": "1"}),
+            dict(uaid="b", update={"channelID": "2"}),
+        ])
+        eq_(self.successResultOf(d1).code, 200)
+        eq_(self.successResultOf(d2).code, 404)
+        # Two results for the single notification to the other node
+        self.failureResultOf(d3, ValueError)
+
+    @patch("autopush.batching.readBody")
+    def test_full_batch_sent(self, mock_read, mock_reactor):
+        mock_read.return_value = succeed(
+            json.dumps({"results": [200, 200, 200]}))
+        defers = [self.batcher.send(self.node, str(i), {}) for i in range(3)]
+        eq_(self.agent.request.call_count, 1)
+        for d in defers:
+            eq_(self.successResultOf(d).code, 200)
+        self.metrics.gauge.assert_called_with("router_batch.size", 3)
+
+    @patch("autopush.batching.IgnoreBody")
+    def test_unsupported_falls_back(self, mock_ignore, mock_reactor):
+        self.response.code = 404
+        single = Mock(code=200)
+        self.agent.request.side_effect = [succeed(self.response),
+                                          succeed(single),
+                                          succeed(single)]
+        mock_ignore.ignore.side_effect = succeed
+        d1 = self.batcher.send(self.node, "a", {"channelID": "1"})
+        d2 = self.batcher.send(self.node, "b", {"channelID": "2"})
+        self.batcher.flush()
+        eq_(self.agent.request.call_count, 3)
+        call = self.agent.request.mock_calls[1]
+        eq_(call[1], ("PUT", self.node + "/push/a"))
+        eq_(self._sent(call), {"channelID": "1"})
+        eq_(self.successResultOf(d1), single)
+        eq_(self.successResultOf(d2), single)
+        self.metrics.increment.assert_any_call("router_batch.unsupported")
+
+    def test_error_fails_batch(self, mock_reactor):
+        self.agent.request.return_value = fail(Exception("Refused"))
+        d1 = self.batcher.send(self.node, "a", {})
+        d2 = self.batcher.send(self.node, "b", {})
+        self.batcher.flush()
+        self.failureResultOf(d1, Exception)
+        self.failureResultOf(d2, Exception)
+        self.metrics.increment.assert_called_with("router_batch.error")
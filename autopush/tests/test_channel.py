@@ -0,0 +1,182 @@
+import json
+import struct
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from autopush.channel import (
+    CHECK,
+    CONNECTED_AT,
+    DISCONNECT,
+    HEADER,
+    PUSH,
+    RESULT,
+    STATUS,
+    ChannelClientProtocol,
+    NodeChannels,
+    decode_uaid,
+    http_fallback,
+)
+from autopush.exceptions import ChannelUnavailable
+
+
+node_id = "http://node:8081"
+
+
+def frames(data):
+    """Split the frames written to a channel"""
+    result = []
+    while data:
+        length = struct.unpack(">I", data[:4])[0]
+        frame = data[4:4 + length]
+        request_id, command = HEADER.unpack_from(frame)
+        result.append((request_id, command, frame[HEADER.size:]))
+        data = data[4 + length:]
+    return result
+
+
+def result_frame(request_id, code):
+    frame = HEADER.pack(request_id, RESULT) + STATUS.pack(code)
+    return struct.pack(">I", len(frame)) + frame
+
+
+class ChannelClientProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.channels = Mock()
+        self.proto = ChannelClientProtocol(self.channels, node_id, window=2)
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def test_window(self):
+        results = [self.proto.request(CHECK, "\x01a") for _ in range(3)]
+        sent = frames(self.transport.value())
+        eq_([request_id for request_id, _, _ in sent], [1, 2])
+        eq_(sent[0][1:], (CHECK, "\x01a"))
+
+        # Results can come back out of order
+        self.transport.clear()
+        self.proto.dataReceived(result_frame(2, 404))
+        eq_(self.successResultOf(results[1]).code, 404)
+        ok_(not results[0].called)
+        eq_(frames(self.transport.value()), [(3, CHECK, "\x01a")])
+        self.proto.dataReceived(result_frame(1, 200) + result_frame(3, 202))
+        eq_(self.successResultOf(results[0]).code, 200)
+        eq_(self.successResultOf(results[2]).code, 202)
+
+    def test_unexpected_result(self):
+        self.proto.dataReceived(result_frame(7, 200))
+        ok_(self.transport.disconnecting)
+
+    def test_short_frame(self):
+        self.proto.dataReceived(struct.pack(">I", 1) + "\x00")
+        ok_(self.transport.disconnecting)
+
+    def test_connection_lost(self):
+        sent = [self.proto.request(CHECK, "\x01a") for _ in range(2)]
+        waiting = self.proto.request(CHECK, "\x01a")
+        self.proto.connectionLost(Failure(ConnectionDone()))
+        self.channels._lost.assert_called_with(self.proto)
+        for d in sent:
+            self.failureResultOf(d, ConnectionDone)
+        # Never sent, so it can still go over HTTP
+        self.failureResultOf(waiting, ChannelUnavailable)
+
+
+@patch("autopush.channel.connectProtocol")
+class NodeChannelsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock()
+        self.channels = NodeChannels(self.metrics, 1000, window=10,
+                                     retry_interval=60, clock=self.clock)
+
+    def _connect(self, mock_connect):
+        connected = Deferred()
+        mock_connect.return_value = connected
+        d = self.channels.push(node_id, "abc", {"channelID": "chid"})
+        endpoint, proto = mock_connect.call_args[0]
+        eq_(endpoint._port, 9081)
+        eq_(endpoint._host, "node")
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        connected.callback(proto)
+        return d, proto, transport
+
+    def test_push(self, mock_connect):
+        d, proto, transport = self._connect(mock_connect)
+        request_id, command, body = frames(transport.value())[0]
+        eq_(command, PUSH)
+        uaid, update = decode_uaid(body)
+        eq_(uaid, "abc")
+        eq_(json.loads(update), {"channelID": "chid"})
+        proto.dataReceived(result_frame(request_id, 200))
+        eq_(self.successResultOf(d).code, 200)
+
+        # Later requests reuse the channel
+        transport.clear()
+        self.channels.disconnect(node_id, "abc", 12345)
+        eq_(mock_connect.call_count, 1)
+        _, command, body = frames(transport.value())[0]
+        eq_(command, DISCONNECT)
+        uaid, args = decode_uaid(body)
+        eq_(CONNECTED_AT.unpack(args)[0], 12345)
+
+    def test_requests_during_connect(self, mock_connect):
+        connected = Deferred()
+        mock_connect.return_value = connected
+        self.channels.push(node_id, "a", {})
+        self.channels.check(node_id, "b")
+        eq_(mock_connect.call_count, 1)
+        proto = mock_connect.call_args[0][1]
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        connected.callback(proto)
+        eq_([command for _, command, _ in frames(transport.value())],
+            [PUSH, CHECK])
+
+    def test_unavailable(self, mock_connect):
+        mock_connect.return_value = fail(ConnectionRefusedError())
+        d = self.channels.check(node_id, "abc")
+        self.failureResultOf(d, ChannelUnavailable)
+        self.metrics.increment.assert_called_with("channel.unavailable")
+
+        # Not retried until the interval passes
+        d = self.channels.check(node_id, "abc")
+        self.failureResultOf(d, ChannelUnavailable)
+        eq_(mock_connect.call_count, 1)
+        self.clock.advance(60)
+        self.channels.check(node_id, "abc")
+        eq_(mock_connect.call_count, 2)
+
+    def test_lost(self, mock_connect):
+        d, proto, transport = self._connect(mock_connect)
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        self.metrics.increment.assert_called_with("channel.lost")
+        mock_connect.return_value = Deferred()
+        self.channels.check(node_id, "abc")
+        eq_(mock_connect.call_count, 2)
+
+    def test_https_endpoint(self, mock_connect):
+        endpoint = self.channels._endpoint("https://node")
+        eq_(endpoint._port, 1443)
+
+
+class HttpFallbackTestCase(unittest.TestCase):
+    def test_fallback(self):
+        func = Mock(return_value="sent")
+        d = http_fallback(fail(ChannelUnavailable()), func, "a", "b")
+        eq_(self.successResultOf(d), "sent")
+        func.assert_called_with("a", "b")
+
+    def test_other_errors(self):
+        func = Mock()
+        d = http_fallback(fail(ConnectionDone()), func)
+        self.failureResultOf(d, ConnectionDone)
+        ok_(not func.called)
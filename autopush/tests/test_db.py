@@ -9,9 +9,10 @@ from boto.dynamodb2.exceptions import (
 )
 from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.items import Item
-from mock import Mock
+from mock import Mock, patch
 from moto import mock_dynamodb2
-from nose.tools import eq_
+from nose.tools import eq_, ok_
+from repoze.lru import ExpiringLRUCache
 
 from autopush.db import (
     get_rotating_message_table,
@@ -245,6 +246,45 @@ class MessageTestCase(unittest.TestCase):
         exists, chans = message.all_channels(dummy_uaid)
         assert(chans == set([]))
 
+    def test_has_channel(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics())
+        eq_(message.has_channel(self.uaid, chid), False)
+        message.save_channels(self.uaid, set([chid]))
+        eq_(message.has_channel(self.uaid, chid.replace("-", "")), True)
+        eq_(message.has_channel(self.uaid, str(uuid.uuid4())), False)
+        eq_(message.has_channel(self.uaid, "invalid"), False)
+
+    def test_has_channel_cached(self):
+        chid = str(uuid.uuid4())
+        chid2 = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics(),
+                          channel_cache=ExpiringLRUCache(10))
+        message.save_channels(self.uaid, set([chid]))
+        ok_(message.has_channel(self.uaid, chid))
+
+        # Positive lookups are answered from the cache
+        with patch.object(m, "get_item") as get_item:
+            ok_(message.has_channel(self.uaid, chid))
+            ok_(not get_item.called)
+
+        # A channel missing from the cached set is read again
+        Message(m, SinkMetrics()).save_channels(self.uaid,
+                                                set([chid, chid2]))
+        ok_(message.has_channel(self.uaid, chid2))
+
+    def test_has_channel_cache_invalidated(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics(),
+                          channel_cache=ExpiringLRUCache(10))
+        message.save_channels(self.uaid, set([chid]))
+        ok_(message.has_channel(self.uaid, chid))
+        message.save_channels(self.uaid, set([]))
+        ok_(not message.has_channel(self.uaid, chid))
+
     def test_message_storage(self):
         chid = str(uuid.uuid4())
         chid2 = str(uuid.uuid4())
@@ -272,6 +312,19 @@ class MessageTestCase(unittest.TestCase):
         all_messages = list(message.fetch_messages(self.uaid))
         eq_(len(all_messages), 0)
 
+    def test_store_messages(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics())
+        ttl = int(time.time())+100
+        message.store_messages(self.uaid, [
+            dict(channel_id=chid, message_id=str(i), ttl=ttl,
+                 data="data%s" % i, headers={}) for i in range(30)
+        ])
+        all_messages = list(message.fetch_messages(self.uaid, limit=50))
+        eq_(len(all_messages), 30)
+        ok_(all(x["updateid"] for x in all_messages))
+
     def test_delete_user(self):
         chid = str(uuid.uuid4())
         chid2 = str(uuid.uuid4())
@@ -323,6 +376,41 @@ class MessageTestCase(unittest.TestCase):
         all_messages = list(message.fetch_messages(self.uaid, limit=100))
         eq_(len(all_messages), 0)
 
+    def test_message_delete_batch(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics())
+        ttl = int(time.time())+100
+        time1, time2 = self._nstime(), self._nstime()+1
+        message.store_message(self.uaid, chid, time1, ttl, "data1", {})
+        message.store_message(self.uaid, chid, time2, ttl, "data2", {})
+        eq_(len(message.fetch_messages(self.uaid)), 2)
+
+        unprocessed = message.delete_message_batch([
+            (self.uaid, chid, time1),
+            (self.uaid, chid, time2),
+        ])
+        eq_(unprocessed, [])
+        eq_(len(message.fetch_messages(self.uaid)), 0)
+
+    def test_message_delete_batch_unprocessed(self):
+        chid = str(uuid.uuid4())
+        m = get_rotating_message_table()
+        message = Message(m, SinkMetrics())
+        encoded = message.encode(dict(
+            uaid=self.uaid, chidmessageid="%s:%s" % (chid, "asdf")))
+        message.table.connection = Mock()
+        message.table.connection.batch_write_item.return_value = {
+            "UnprocessedItems": {m.table_name: [
+                {"DeleteRequest": {"Key": encoded}}
+            ]}
+        }
+        unprocessed = message.delete_message_batch([
+            (self.uaid, chid, "asdf"),
+            (self.uaid, chid, "fdsa"),
+        ])
+        eq_(unprocessed, [(self.uaid, chid, "asdf")])
+
     def test_message_delete_fail_condition(self):
         m = get_rotating_message_table()
         message = Message(m, SinkMetrics())
@@ -487,7 +575,9 @@ class RouterTestCase(unittest.TestCase):
         router.table.connection.update_item.side_effect = raise_condition
         router_data = dict(uaid=dummy_uaid, node_id="asdf", connected_at=1234)
         result = router.register_user(router_data)
-        eq_(result, (False, {}, router_data))
+        eq_(result, (False, {}, dict(node_id="asdf", connected_at=1234)))
+        # The caller's data is left intact for retries
+        eq_(router_data["uaid"], dummy_uaid)
 
     def test_node_clear(self):
         r = get_router_table()
@@ -513,6 +603,36 @@ class RouterTestCase(unittest.TestCase):
         eq_(user["connected_at"], 1234)
         eq_(user["router_key"], "webpush")
 
+    def test_messages_stored(self):
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+        uaid = str(uuid.uuid4())
+        router.register_user(dict(uaid=uaid, node_id="asdf",
+                                  connected_at=1234, router_type="webpush"))
+        item = router.mark_messages_stored(uaid)
+        eq_(item["node_id"], "asdf")
+        stored_at = item["messages_stored_at"]
+        ok_(stored_at > 0)
+        eq_(router.get_uaid(uaid)["messages_stored_at"], stored_at)
+        ok_(router.clear_messages_stored(uaid, stored_at))
+        eq_(router.get_uaid(uaid)["messages_stored_at"], 0)
+
+    def test_messages_stored_fail(self):
+        r = get_router_table()
+        router = Router(r, SinkMetrics())
+
+        def raise_condition(*args, **kwargs):
+            raise ConditionalCheckFailedException(None, None)
+
+        router.table.connection = Mock()
+        router.table.connection.update_item.side_effect = raise_condition
+        eq_(router.mark_messages_stored(dummy_uaid), None)
+        eq_(router.clear_messages_stored(dummy_uaid, 10), False)
+        kwargs = router.table.connection.update_item.call_args[1]
+        eq_(kwargs["condition_expression"],
+            "messages_stored_at = :stored_at")
+        eq_(router.clear_messages_stored(dummy_uaid, None), False)
+
     def test_node_clear_fail(self):
         r = get_router_table()
         router = Router(r, SinkMetrics())
@@ -538,3 +658,45 @@ class RouterTestCase(unittest.TestCase):
         # Deleting already deleted record should return false.
         result = router.drop_user(uaid)
         eq_(result, False)
+
+    def test_cached_uaid(self):
+        uaid = str(uuid.uuid4())
+        r = get_router_table()
+        router = Router(r, SinkMetrics(), cache_size=10)
+        router.register_user(dict(uaid=uaid, node_id="me",
+                                  connected_at=1234))
+        eq_(router.get_uaid(uaid)["node_id"], "me")
+
+        # Served from the cache without touching the table
+        router.table = Mock()
+        user = router.get_uaid(uaid)
+        eq_(user["node_id"], "me")
+        ok_(not router.table.get_item.called)
+
+        # Callers get a copy they can modify
+        del user["node_id"]
+        eq_(router.get_uaid(uaid)["node_id"], "me")
+
+        # Bypassing the cache does a consistent read
+        router.table.get_item.return_value = Item(r, dict(uaid=uaid))
+        self.assertRaises(ItemNotFound, router.get_uaid, uaid,
+                          use_cache=False)
+        router.table.get_item.assert_called_with(consistent=True, uaid=uaid)
+
+    def test_cached_uaid_invalidated(self):
+        uaid = str(uuid.uuid4())
+        r = get_router_table()
+        router = Router(r, SinkMetrics(), cache_size=10)
+        router.register_user(dict(uaid=uaid, node_id="me",
+                                  connected_at=1234))
+        user = router.get_uaid(uaid)
+
+        router.clear_node(user)
+        eq_(router.get_uaid(uaid).get("node_id"), None)
+
+        router.register_user(dict(uaid=uaid, node_id="you",
+                                  connected_at=1235))
+        eq_(router.get_uaid(uaid)["node_id"], "you")
+
+        router.drop_user(uaid)
+        self.assertRaises(ItemNotFound, router.get_uaid, uaid)
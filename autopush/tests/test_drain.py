@@ -0,0 +1,79 @@
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.drain import ConnectionDrainer
+
+
+class ConnectionDrainerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.settings = Mock()
+        self.settings.clients = {}
+        self.drainer = ConnectionDrainer(self.settings, rate=2,
+                                         clock=self.clock)
+
+    def _add_client(self, uaid):
+        client = Mock(STATE_OPEN=3, state=3)
+
+        def close():
+            client.state = 4
+        client.sendClose.side_effect = close
+        self.settings.clients[uaid] = client
+        return client
+
+    def _disconnect_closed(self):
+        for uaid, client in self.settings.clients.items():
+            if client.state != client.STATE_OPEN:
+                del self.settings.clients[uaid]
+
+    def test_paced(self):
+        clients = [self._add_client(str(i)) for i in range(5)]
+        port = Mock()
+        self.drainer.ports.append(port)
+        done = []
+        self.drainer.start().addCallback(done.append)
+        ok_(self.drainer.draining)
+        ok_(port.stopListening.called)
+
+        # Two clients closed within each second
+        self.clock.advance(1)
+        eq_(sum(client.sendClose.called for client in clients), 2)
+        self._disconnect_closed()
+        self.clock.advance(1)
+        eq_(sum(client.sendClose.called for client in clients), 4)
+        self._disconnect_closed()
+        # A client connecting during the drain is closed too
+        late = self._add_client("late")
+        self.clock.advance(1)
+        self._disconnect_closed()
+        self.clock.advance(1)
+        ok_(late.sendClose.called)
+        self._disconnect_closed()
+        ok_(not done)
+
+        self.clock.advance(1)
+        eq_(done, [None])
+        eq_(self.clock.getDelayedCalls(), [])
+        for client in clients:
+            eq_(client.sendClose.call_count, 1)
+
+    def test_already_closing(self):
+        client = self._add_client("a")
+        client.state = 4
+        self.drainer.start()
+        self.clock.advance(1)
+        ok_(not client.sendClose.called)
+        del self.settings.clients["a"]
+        self.clock.advance(1)
+
+    def test_start_twice(self):
+        port = Mock()
+        self.drainer.ports.append(port)
+        first = self.drainer.start()
+        second = self.drainer.start()
+        eq_(port.stopListening.call_count, 1)
+        self.clock.advance(0)
+        ok_(first.called)
+        ok_(second.called)
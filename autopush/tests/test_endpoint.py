@@ -270,6 +270,29 @@ class EndpointTestCase(unittest.TestCase):
         self.finish_deferred.addCallback(handle_finish)
         return self.finish_deferred
 
+    def test_route_context(self):
+        fresult = dict(router_type="test")
+        frouter = Mock(spec=Router)
+        frouter.route_notification = Mock()
+        frouter.route_notification.return_value = RouterResponse()
+        self.endpoint.uaid = dummy_uaid
+        self.endpoint.chid = dummy_chid
+        self.request_mock.headers["encryption"] = "stuff"
+        self.request_mock.headers["content-encoding"] = "aes128"
+        self.endpoint.ap_settings.routers["test"] = frouter
+        # No router item cache, so the lookup was a consistent read
+        self.router_mock.cache = None
+        self.endpoint._uaid_lookup_results(fresult)
+
+        def handle_finish(value):
+            context = frouter.route_notification.call_args[1]["context"]
+            eq_(context.uaid, dummy_uaid)
+            ok_(context.record is fresult)
+            ok_(context.consistent)
+
+        self.finish_deferred.addCallback(handle_finish)
+        return self.finish_deferred
+
     def test_webpush_missing_ttl(self):
         del(self.request_mock.headers['ttl'])
         frouter = Mock(spec=Router)
@@ -296,7 +319,7 @@ class EndpointTestCase(unittest.TestCase):
             router_data=dict(),
         )
 
-        def raise_error(*args):
+        def raise_error(*args, **kwargs):
             raise RouterException(
                 "Missing TTL Header",
                 status_code=400,
@@ -1081,7 +1104,7 @@ class EndpointTestCase(unittest.TestCase):
             router_data=dict(),
         )
 
-        def raise_error(*args):
+        def raise_error(*args, **kwargs):
             raise RouterException(
                 "Provisioned throughput error",
                 status_code=503,
@@ -6,11 +6,13 @@ from boto.dynamodb2.exceptions import (
 from cyclone.web import Application
 from mock import Mock
 from moto import mock_dynamodb2
+from nose.tools import ok_
 from twisted.internet.defer import Deferred
 from twisted.trial import unittest
 
 from autopush import __version__
 from autopush.health import (
+    DrainHandler,
     HealthHandler,
     MissingTableException,
     StatusHandler,
@@ -55,6 +57,14 @@ class HealthTestCase(unittest.TestCase):
             "router": {"status": "OK"}
         })
 
+    def test_memory_backend(self):
+        self.settings.db_backend = "memory"
+        return self._assert_reply({
+            "status": "OK",
+            "version": __version__,
+            "clients": 0,
+        })
+
     def test_aws_error(self):
         def raise_error(*args, **kwargs):
             raise InternalServerError(None, None)
@@ -112,6 +122,18 @@ class HealthTestCase(unittest.TestCase):
             "router": {"status": "OK"}
         }, Exception)
 
+    def test_draining(self):
+        self.settings.db_backend = "memory"
+        self.settings.drainer.draining = True
+        self.finish_deferred.addCallback(
+            lambda _: self.status_mock.assert_called_with(503))
+        return self._assert_reply({
+            "status": "NOT OK",
+            "version": __version__,
+            "clients": 0,
+            "draining": True,
+        })
+
     def _assert_reply(self, reply, exception=None):
         def handle_finish(result):
             if exception:
@@ -147,5 +169,42 @@ class StatusTestCase(unittest.TestCase):
         self.status.get()
         self.write_mock.assert_called_with({
             "status": "OK",
-            "version": __version__
+            "version": __version__,
+            "connection_state_bytes": 0,
+        })
+
+    def test_status_connection_state(self):
+        client = Mock()
+        client.ps.footprint.return_value = 100
+        self.settings.clients["uaid"] = client
+        self.status.get()
+        self.assertEqual(
+            self.write_mock.call_args[0][0]["connection_state_bytes"], 100)
+
+
+class DrainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_dynamodb2 = mock_dynamodb2()
+        self.mock_dynamodb2.start()
+
+        self.settings = DrainHandler.ap_settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.settings.drainer = Mock()
+        self.drain = DrainHandler(Application(), Mock())
+        self.status_mock = self.drain.set_status = Mock()
+        self.write_mock = self.drain.write = Mock()
+
+    def tearDown(self):
+        self.mock_dynamodb2.stop()
+
+    def test_drain(self):
+        self.settings.clients["uaid"] = Mock()
+        self.drain.put()
+        ok_(self.settings.drainer.start.called)
+        self.status_mock.assert_called_with(202)
+        self.write_mock.assert_called_with({
+            "status": "draining",
+            "clients": 1,
         })
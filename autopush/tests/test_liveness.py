@@ -0,0 +1,67 @@
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.liveness import NodeDirectory
+
+
+node_id = "http://node:8081"
+
+
+class NodeDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock()
+        self.agent = Mock()
+        self.nodes = NodeDirectory(self.metrics, self.agent,
+                                   probe_interval=10, clock=self.clock)
+
+    def _respond(self, code):
+        response = Mock(code=code)
+        response.deliverBody.side_effect = \
+            lambda proto: proto.deferred.callback(response)
+        return succeed(response)
+
+    def test_dead_until_probed(self):
+        ok_(self.nodes.alive(node_id))
+        self.nodes.mark_dead(node_id)
+        self.metrics.increment.assert_called_with("node_directory.dead")
+        ok_(not self.nodes.alive(node_id))
+        ok_(not self.agent.request.called)
+
+        # Probed once the interval passed, and readmitted
+        self.clock.advance(10)
+        self.agent.request.return_value = self._respond(200)
+        ok_(not self.nodes.alive(node_id))
+        self.agent.request.assert_called_with("GET", node_id + "/status")
+        self.metrics.increment.assert_called_with("node_directory.readmit")
+        ok_(self.nodes.alive(node_id))
+
+    def test_single_probe(self):
+        self.nodes.mark_dead(node_id)
+        self.clock.advance(10)
+        self.agent.request.return_value = Deferred()
+        self.nodes.alive(node_id)
+        self.nodes.alive(node_id)
+        eq_(self.agent.request.call_count, 1)
+
+    def test_probe_failed(self):
+        self.nodes.mark_dead(node_id)
+        self.clock.advance(10)
+        self.agent.request.return_value = fail(ConnectError())
+        ok_(not self.nodes.alive(node_id))
+        # Still dead, and not probed again until the next interval
+        ok_(not self.nodes.alive(node_id))
+        eq_(self.agent.request.call_count, 1)
+        self.clock.advance(10)
+        self.agent.request.return_value = self._respond(503)
+        self.nodes.alive(node_id)
+        eq_(self.agent.request.call_count, 2)
+        ok_(not self.nodes.alive(node_id))
+        # Counted once, when it was first found dead
+        dead = [call for call in self.metrics.increment.mock_calls
+                if call[1] == ("node_directory.dead",)]
+        eq_(len(dead), 1)
@@ -3,15 +3,17 @@ import datetime
 
 from mock import Mock, patch
 from moto import mock_dynamodb2, mock_s3
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 from twisted.trial import unittest as trialtest
 
+from autopush.asyncdb import AsyncMessage, AsyncRouter, AsyncStorage
 from autopush.main import (
     connection_main,
     endpoint_main,
     make_settings,
     skip_request_logging,
 )
+from autopush.memory import MemoryMessage, MemoryRouter, MemoryStorage
 from autopush.senderids import SenderIDs
 from autopush.utils import (
     resolve_ip,
@@ -60,6 +62,19 @@ class SettingsTestCase(unittest.TestCase):
         settings = AutopushSettings()
         eq_(len(settings.message_tables), 3)
 
+    def test_db_async(self):
+        settings = AutopushSettings(db_async=True)
+        ok_(isinstance(settings.storage.async_db, AsyncStorage))
+        ok_(isinstance(settings.router.async_db, AsyncRouter))
+        ok_(isinstance(settings.message.async_db, AsyncMessage))
+
+    def test_memory_backend(self):
+        settings = AutopushSettings(db_backend="memory")
+        ok_(isinstance(settings.storage, MemoryStorage))
+        ok_(isinstance(settings.router, MemoryRouter))
+        ok_(isinstance(settings.message, MemoryMessage))
+        eq_(settings.message.table.table_name, settings.current_msg_month)
+
 
 class SettingsAsyncTestCase(trialtest.TestCase):
     def test_update_rotating_tables(self):
@@ -133,6 +148,7 @@ class ConnectionMainTestCase(unittest.TestCase):
         patchers = [
             "autopush.main.task",
             "autopush.main.reactor",
+            "autopush.main.signal",
             "autopush.settings.TwistedMetrics",
         ]
         self.mocks = {}
@@ -157,6 +173,11 @@ class ConnectionMainTestCase(unittest.TestCase):
             "--router_ssl_key=keys/server.key",
         ], False)
 
+    def test_channel_offset_collides(self):
+        # Worker 0's channel port would be worker 1's router port
+        with self.assertRaises(SystemExit):
+            connection_main(["--workers=4", "--channel_offset=1"], False)
+
     def test_skip_logging(self):
         # Should skip setting up logging on the handler
         mock_handler = Mock()
@@ -185,6 +206,15 @@ class EndpointMainTestCase(unittest.TestCase):
         hostname = "hostname"
         statsd_host = "statsd_host"
         statsd_port = "statsd_port"
+        db_backend = "dynamodb"
+        db_async = False
+        db_threads = 50
+        db_retry_budget = 10.0
+        channel_offset = 0
+        channel_window = 100
+        http_pool_size = 10
+        http_pool_idle_timeout = 240
+        http_pool_max_connections = 0
         router_tablename = "none"
         storage_tablename = "None"
         storage_read_throughput = 0
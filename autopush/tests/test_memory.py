@@ -0,0 +1,207 @@
+import unittest
+import uuid
+
+from boto.dynamodb2.exceptions import ItemNotFound
+from nose.tools import eq_, ok_
+
+from autopush.db import has_connected_this_month
+from autopush.memory import (
+    get_memory_table,
+    MemoryMessage,
+    MemoryRouter,
+    MemoryStorage,
+    MemoryTable,
+)
+from autopush.metrics import SinkMetrics
+
+
+class MemoryTableTestCase(unittest.TestCase):
+    def test_get_memory_table(self):
+        name = "table_%s" % uuid.uuid4()
+        table = get_memory_table(name)
+        eq_(table.table_name, name)
+        ok_(get_memory_table(name) is table)
+
+    def test_query(self):
+        table = MemoryTable("test")
+        table.put("a", " ", dict(chids=set(["x"])))
+        table.put("a", "c", dict(data=None, ttl=0))
+        table.put("a", "b", dict(data=""))
+        eq_(table.query("a"), [{}, {"ttl": 0}])
+        eq_(len(table.query("a", after="")), 3)
+        ok_(table.delete("a", " "))
+        ok_(not table.delete("a", " "))
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage(MemoryTable("storage"), SinkMetrics())
+        self.uaid = str(uuid.uuid4())
+        self.chid = str(uuid.uuid4())
+
+    def test_save_notification(self):
+        ok_(self.storage.save_notification(self.uaid, self.chid, 10))
+        ok_(not self.storage.save_notification(self.uaid, self.chid, 8))
+        ok_(self.storage.save_notification(self.uaid, self.chid, 12))
+        notifs = self.storage.fetch_notifications(self.uaid)
+        eq_(len(notifs), 1)
+        eq_(notifs[0]["chid"], self.chid)
+        eq_(notifs[0]["version"], 12)
+
+    def test_delete_notification(self):
+        self.storage.save_notification(self.uaid, self.chid, 10)
+        self.storage.delete_notification(self.uaid, self.chid, 8)
+        eq_(len(self.storage.fetch_notifications(self.uaid)), 1)
+        self.storage.delete_notification(self.uaid, self.chid, 10)
+        eq_(self.storage.fetch_notifications(self.uaid), [])
+        self.storage.save_notification(self.uaid, self.chid, 10)
+        self.storage.delete_notification(self.uaid, self.chid)
+        eq_(self.storage.fetch_notifications(self.uaid), [])
+
+
+class MemoryMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message = MemoryMessage(MemoryTable("message"), SinkMetrics())
+        self.uaid = str(uuid.uuid4())
+        self.chid = str(uuid.uuid4())
+
+    def test_channels(self):
+        chid2 = str(uuid.uuid4())
+        eq_(self.message.all_channels(self.uaid), (False, set([])))
+        self.message.register_channel(self.uaid, self.chid)
+        self.message.register_channel(self.uaid, chid2)
+        eq_(self.message.all_channels(self.uaid),
+            (True, set([self.chid, chid2])))
+        ok_(self.message.has_channel(self.uaid, self.chid.replace("-", "")))
+        ok_(not self.message.has_channel(self.uaid, "invalid"))
+
+        ok_(self.message.unregister_channel(self.uaid, chid2))
+        ok_(not self.message.unregister_channel(self.uaid, chid2))
+        eq_(self.message.all_channels(self.uaid), (True, set([self.chid])))
+
+        self.message.save_channels(self.uaid, set([]))
+        eq_(self.message.all_channels(self.uaid), (True, set([])))
+
+    def test_store_and_fetch(self):
+        self.message.register_channel(self.uaid, self.chid)
+        for i in range(3):
+            self.message.store_message(self.uaid, self.chid, "m%s" % i, 60,
+                                       data="abc", headers={"a": "b"})
+        messages = self.message.fetch_messages(self.uaid, limit=2)
+        eq_([x["chidmessageid"] for x in messages],
+            ["%s:m0" % self.chid, "%s:m1" % self.chid])
+        eq_(messages[0]["data"], "abc")
+        eq_(messages[0]["headers"], {"a": "b"})
+        eq_(len(self.message.fetch_messages(self.uaid)), 3)
+
+    def test_store_messages(self):
+        self.message.store_messages(self.uaid, [
+            dict(channel_id=self.chid, message_id="m%s" % i, ttl=60)
+            for i in range(3)
+        ])
+        eq_(len(self.message.fetch_messages(self.uaid)), 3)
+
+    def test_update_message(self):
+        ok_(not self.message.update_message(self.uaid, self.chid, "m", 60))
+        self.message.store_message(self.uaid, self.chid, "m", 60,
+                                   data="abc", headers={"a": "b"})
+        updateid = self.message.fetch_messages(self.uaid)[0]["updateid"]
+        ok_(self.message.update_message(self.uaid, self.chid, "m", 30))
+        item = self.message.fetch_messages(self.uaid)[0]
+        eq_(item["ttl"], 30)
+        ok_("data" not in item and "headers" not in item)
+        ok_(item["updateid"] != updateid)
+
+        # Deletes are conditional on the updateid
+        ok_(not self.message.delete_message(self.uaid, self.chid, "m",
+                                            updateid))
+        ok_(self.message.delete_message(self.uaid, self.chid, "m",
+                                        item["updateid"]))
+        eq_(self.message.fetch_messages(self.uaid), [])
+
+    def test_deletes(self):
+        chid2 = str(uuid.uuid4())
+        self.message.register_channel(self.uaid, self.chid)
+        self.message.store_message(self.uaid, self.chid, "m1", 60)
+        self.message.store_message(self.uaid, self.chid, "m2", 60)
+        self.message.store_message(self.uaid, chid2, "m3", 60)
+
+        eq_(self.message.delete_message_batch(
+            [(self.uaid, self.chid, "m1")]), [])
+        ok_(self.message.delete_messages_for_channel(self.uaid, self.chid))
+        ok_(not self.message.delete_messages_for_channel(self.uaid,
+                                                         self.chid))
+        eq_(len(self.message.fetch_messages(self.uaid)), 1)
+
+        self.message.delete_user(self.uaid)
+        eq_(self.message.fetch_messages(self.uaid), [])
+        eq_(self.message.all_channels(self.uaid), (False, set([])))
+
+
+class MemoryRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = MemoryRouter(MemoryTable("router"), SinkMetrics())
+        self.uaid = str(uuid.uuid4())
+
+    def _register(self, **kwargs):
+        data = dict(uaid=self.uaid, node_id="node", connected_at=10,
+                    router_type="webpush")
+        data.update(kwargs)
+        return self.router.register_user(data)
+
+    def test_register_user(self):
+        with self.assertRaises(ItemNotFound):
+            self.router.get_uaid(self.uaid)
+        eq_(self._register()[:2], (True, {}))
+        eq_(self.router.get_uaid(self.uaid)["node_id"], "node")
+
+        # Older or equal connections and other router types are refused
+        ok_(not self._register(connected_at=10)[0])
+        ok_(not self._register(connected_at=20, router_type="gcm")[0])
+
+        result = self._register(node_id="node2", connected_at=20)
+        ok_(result[0])
+        eq_(result[1]["node_id"], "node")
+        eq_(self.router.get_uaid(self.uaid)["node_id"], "node2")
+
+    def test_clear_node(self):
+        self._register()
+        item = self.router.get_uaid(self.uaid)
+        stale = dict(item, connected_at=5)
+        ok_(not self.router.clear_node(stale))
+        ok_(self.router.clear_node(item))
+        ok_("node_id" not in self.router.get_uaid(self.uaid))
+
+        # Any newer connection may register once the node is cleared
+        ok_(self._register(connected_at=1)[0])
+
+    def test_update_message_month(self):
+        self._register()
+        self.router.update_message_month(self.uaid, "message_2016_1")
+        item = self.router.get_uaid(self.uaid)
+        eq_(item["current_month"], "message_2016_1")
+        ok_(has_connected_this_month(item))
+
+    def test_messages_stored(self):
+        ok_(not self.router.mark_messages_stored(self.uaid))
+        self._register()
+        ok_(self.router.clear_messages_stored(self.uaid, None))
+        stored_at = self.router.mark_messages_stored(
+            self.uaid)["messages_stored_at"]
+        ok_(stored_at > 0)
+        eq_(self.router.get_uaid(self.uaid)["messages_stored_at"], stored_at)
+        ok_(not self.router.clear_messages_stored(self.uaid, None))
+        ok_(self.router.clear_messages_stored(self.uaid, stored_at))
+        eq_(self.router.get_uaid(self.uaid)["messages_stored_at"], 0)
+
+    def test_drop_user(self):
+        ok_(not self.router.drop_user(self.uaid))
+        self._register()
+        ok_(self.router.drop_user(self.uaid))
+
+    def test_incomplete_uaid(self):
+        self.router.update_last_connect(self.uaid)
+        self.router.table.put(self.uaid, None, dict(uaid=self.uaid))
+        with self.assertRaises(ItemNotFound):
+            self.router.get_uaid(self.uaid)
+        ok_(not self.router.drop_user(self.uaid))
@@ -0,0 +1,113 @@
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet.defer import CancelledError, fail, succeed
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from autopush.pool import NodeConnectionPool
+
+
+key = ("http", "node", 8081)
+tags = ["destination:node:8081"]
+
+
+class FakeEndpoint(object):
+    def __init__(self):
+        self.protocols = []
+
+    def connect(self, factory):
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        self.protocols.append(proto)
+        return succeed(proto)
+
+
+class NodeConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Mock()
+        self.pool = NodeConnectionPool(self.clock, self.metrics,
+                                       max_idle=5, idle_timeout=30,
+                                       max_connections=1)
+        self.pool.retryAutomatically = False
+        self.endpoint = FakeEndpoint()
+
+    def _finish(self, conn):
+        """Return a connection to the pool, as a finished response does"""
+        self.pool._putConnection(key, conn)
+
+    def test_hit_and_miss(self):
+        conn = self.successResultOf(
+            self.pool.getConnection(key, self.endpoint))
+        self.metrics.increment.assert_any_call("http_pool.miss", tags=tags)
+        self.metrics.increment.assert_any_call("http_pool.connect",
+                                               tags=tags)
+        self._finish(conn)
+        self.metrics.increment.reset_mock()
+
+        eq_(self.successResultOf(
+            self.pool.getConnection(key, self.endpoint)), conn)
+        self.metrics.increment.assert_called_once_with(
+            "http_pool.hit", tags=tags)
+        eq_(len(self.endpoint.protocols), 1)
+
+    def test_idle_timeout(self):
+        conn = self.successResultOf(
+            self.pool.getConnection(key, self.endpoint))
+        self._finish(conn)
+        self.clock.advance(30)
+        ok_(conn.transport.disconnecting)
+
+    def test_limit_queues(self):
+        conn = self.successResultOf(
+            self.pool.getConnection(key, self.endpoint))
+        d = self.pool.getConnection(key, self.endpoint)
+        ok_(not d.called)
+        self.metrics.increment.assert_called_with("http_pool.queued",
+                                                  tags=tags)
+
+        self.clock.advance(2)
+        self._finish(conn)
+        # Handed over outside of the finishing response
+        ok_(not d.called)
+        self.clock.advance(0)
+        eq_(self.successResultOf(d), conn)
+        self.metrics.timing.assert_called_with("http_pool.wait", 2,
+                                               tags=tags)
+        eq_(len(self.endpoint.protocols), 1)
+        eq_(self.pool._waiting, {})
+
+    def test_lost_connection_replaced(self):
+        conn = self.successResultOf(
+            self.pool.getConnection(key, self.endpoint))
+        d = self.pool.getConnection(key, self.endpoint)
+        conn.connectionLost(Failure(ConnectionDone()))
+        self.metrics.increment.assert_any_call("http_pool.disconnect",
+                                               tags=tags)
+        new_conn = self.successResultOf(d)
+        ok_(new_conn is not conn)
+        eq_(self.pool._open, {key: 1})
+
+    def test_connect_failed(self):
+        endpoint = Mock()
+        endpoint.connect.return_value = fail(ConnectionRefusedError())
+        d = self.pool.getConnection(key, endpoint)
+        self.failureResultOf(d, ConnectionRefusedError)
+        eq_(self.pool._open, {})
+
+    def test_cancel_waiting(self):
+        self.pool.getConnection(key, self.endpoint)
+        d = self.pool.getConnection(key, self.endpoint)
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        eq_(self.pool._waiting, {})
+
+    def test_no_limit(self):
+        self.pool.max_connections = 0
+        for _ in range(3):
+            self.pool.getConnection(key, self.endpoint)
+        eq_(len(self.endpoint.protocols), 3)
+        eq_(self.pool._open, {key: 3})
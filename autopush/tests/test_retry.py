@@ -0,0 +1,168 @@
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from boto.dynamodb2.table import Table
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.trial import unittest
+
+from autopush.db import Router
+from autopush.metrics import SinkMetrics
+from autopush.retry import (
+    AIMDLimit,
+    RetryBudget,
+    RetryPolicy,
+    backoff,
+)
+
+
+def throttled():
+    return fail(ProvisionedThroughputExceededException(400, "Bad Request"))
+
+
+class BackoffTestCase(unittest.TestCase):
+    def test_backoff(self):
+        for attempt in range(10):
+            delay = backoff(attempt, 0.1, 2.0)
+            ok_(0 <= delay <= min(2.0, 0.1 * 2 ** attempt))
+
+    def test_large_attempt(self):
+        ok_(0 <= backoff(5000, 0.1, 2.0) <= 2.0)
+
+
+class RetryBudgetTestCase(unittest.TestCase):
+    @patch("autopush.retry.time.time")
+    def test_refill(self, mock_time):
+        mock_time.return_value = 100.0
+        budget = RetryBudget(rate=1.0, burst=2)
+        ok_(budget.acquire())
+        ok_(budget.acquire())
+        ok_(not budget.acquire())
+
+        mock_time.return_value = 101.0
+        ok_(budget.acquire())
+        ok_(not budget.acquire())
+
+        mock_time.return_value = 200.0
+        eq_(sum(budget.acquire() for _ in range(5)), 2)
+
+
+class AIMDLimitTestCase(unittest.TestCase):
+    @patch("autopush.retry.time.time")
+    def test_limit(self, mock_time):
+        mock_time.return_value = 100.0
+        limit = AIMDLimit(8, minimum=1)
+        limit.throttled()
+        eq_(limit.limit, 4)
+        # Within the cooldown
+        limit.throttled()
+        eq_(limit.limit, 4)
+
+        for _ in range(4):
+            limit.succeeded()
+        ok_(4.9 < limit.limit < 5)
+
+        for _ in range(100):
+            limit.succeeded()
+        eq_(limit.limit, 8)
+
+    def test_available(self):
+        limit = AIMDLimit(2)
+        ok_(limit.available())
+        limit.active = 2
+        ok_(not limit.available())
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock(spec=SinkMetrics)
+        self.policy = RetryPolicy(self.metrics, max_concurrency=2,
+                                  max_attempts=3, base_delay=0, max_delay=0)
+        self.router = Router(Table("router", connection=Mock()),
+                             SinkMetrics())
+        patcher = patch("autopush.retry.reactor")
+        self.mock_reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_reactor.callLater.side_effect = \
+            lambda delay, func, *args: func(*args)
+
+    def test_untracked(self):
+        run = Mock(return_value=succeed(True))
+        d = self.policy.call(lambda: None, run)
+        eq_(d.result, True)
+        eq_(self.policy.tables, {})
+
+    def test_retries_throttled(self):
+        run = Mock(side_effect=[throttled(), succeed("ok")])
+        d = self.policy.call(self.router.get_uaid, run)
+        eq_(d.result, "ok")
+        eq_(run.call_count, 2)
+        self.metrics.increment.assert_called_with("db_retry.retry",
+                                                  tags=["table:router"])
+
+    def test_max_attempts(self):
+        run = Mock(side_effect=lambda: throttled())
+        d = self.policy.call(self.router.get_uaid, run)
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        eq_(run.call_count, 3)
+        self.metrics.increment.assert_called_with("db_retry.exhausted",
+                                                  tags=["table:router"])
+        return d
+
+    def test_budget_exhausted(self):
+        self.policy.table_for(self.router.get_uaid).budget.tokens = 0
+        self.policy.table_for(self.router.get_uaid).budget.rate = 0
+        run = Mock(side_effect=lambda: throttled())
+        d = self.policy.call(self.router.get_uaid, run)
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        eq_(run.call_count, 1)
+        return d
+
+    def test_retry_later(self):
+        retry = Mock()
+        self.policy.max_delay = 7
+        self.policy.retry_later(self.router.get_uaid, 3, retry, "a")
+        retry.assert_called_with("a")
+        self.metrics.increment.assert_called_with("db_retry.retry",
+                                                  tags=["table:router"])
+
+        budget = self.policy.table_for(self.router.get_uaid).budget
+        budget.tokens = 0
+        budget.rate = 0
+        self.policy.retry_later(self.router.get_uaid, 3, retry)
+        # Waits for the budget to refill
+        eq_(self.mock_reactor.callLater.call_args[0][0], 7)
+        self.metrics.increment.assert_called_with("db_retry.deferred",
+                                                  tags=["table:router"])
+
+    def test_other_errors_not_retried(self):
+        run = Mock(side_effect=lambda: fail(ValueError("bad")))
+        d = self.policy.call(self.router.get_uaid, run)
+        self.assertFailure(d, ValueError)
+        eq_(run.call_count, 1)
+        return d
+
+    def test_concurrency_limit(self):
+        calls = []
+
+        def run():
+            calls.append(Deferred())
+            return calls[-1]
+        results = [self.policy.call(self.router.get_uaid, run, rank=rank)
+                   for rank in (1, 1, 1, 0)]
+        eq_(len(calls), 2)
+
+        # The waiting call with the lowest rank starts first
+        calls[0].callback("first")
+        eq_(results[0].result, "first")
+        eq_(len(calls), 3)
+        calls[2].callback("ranked")
+        eq_(results[3].result, "ranked")
+        ok_(not results[2].called)
+
+    def test_throttle_lowers_limit(self):
+        table = self.policy.table_for(self.router.get_uaid)
+        run = Mock(side_effect=lambda: throttled())
+        d = self.policy.call(self.router.get_uaid, run)
+        self.assertFailure(d, ProvisionedThroughputExceededException)
+        eq_(table.limit.limit, 1)
+        return d
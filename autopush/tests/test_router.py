@@ -7,23 +7,29 @@ from mock import Mock, PropertyMock, patch
 from moto import mock_dynamodb2, mock_s3
 from nose.tools import eq_, ok_
 from twisted.trial import unittest
+from twisted.internet.defer import Deferred, fail, succeed
 from twisted.internet.error import ConnectError, ConnectionRefusedError
 
 import apns
 import gcmclient
 
+from autopush.channel import ChannelResult
 from autopush.db import (
     Router,
     Storage,
     Message,
     ProvisionedThroughputExceededException,
-    ItemNotFound,
     create_rotating_message_table,
 )
 from autopush.endpoint import Notification
+from autopush.exceptions import ChannelUnavailable
 from autopush.router import APNSRouter, GCMRouter, SimpleRouter, WebPushRouter
-from autopush.router.simple import dead_cache
-from autopush.router.interface import RouterException, RouterResponse, IRouter
+from autopush.router.interface import (
+    IRouter,
+    RouteContext,
+    RouterException,
+    RouterResponse,
+)
 from autopush.settings import AutopushSettings
 
 
@@ -450,9 +456,6 @@ class SimplePushRouterTestCase(unittest.TestCase):
         settings.agent = self.agent_mock
         self.router.metrics = Mock()
 
-    def tearDown(self):
-        dead_cache.clear()
-
     def _raise_connect_error(self):
         raise ConnectError()
 
@@ -462,9 +465,6 @@ class SimplePushRouterTestCase(unittest.TestCase):
     def _raise_db_error(self):
         raise ProvisionedThroughputExceededException(None, None)
 
-    def _raise_item_error(self):
-        raise ItemNotFound()
-
     def test_register(self):
         r = self.router.register(None, {})
         eq_(r, {})
@@ -481,12 +481,73 @@ class SimplePushRouterTestCase(unittest.TestCase):
         d.addBoth(verify_deliver)
         return d
 
+    def test_route_to_connected_batched(self):
+        batcher = self.router.ap_settings.push_batcher = Mock()
+        batcher.send.return_value = Deferred()
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        d = self.router.route_notification(self.notif, router_data)
+        ok_(not self.agent_mock.request.called)
+        eq_(batcher.send.call_args[0][:2], ("http://somewhere", dummy_uaid))
+        batcher.send.return_value.callback(Mock(code=200))
+
+        def verify_deliver(result):
+            ok_(isinstance(result, RouterResponse))
+            eq_(result.status_code, 200)
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_route_over_channel(self):
+        channels = self.router.ap_settings.node_channels = Mock()
+        channels.push.return_value = succeed(ChannelResult(200))
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            ok_(not self.agent_mock.request.called)
+            eq_(channels.push.call_args[0][:2],
+                ("http://somewhere", dummy_uaid))
+            eq_(result.status_code, 200)
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_route_channel_unavailable(self):
+        channels = self.router.ap_settings.node_channels = Mock()
+        channels.push.return_value = fail(ChannelUnavailable())
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.code = 200
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            ok_(self.agent_mock.request.called)
+            eq_(result.status_code, 200)
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_route_to_dead_node_saved(self):
+        self.router.ap_settings.node_directory.mark_dead("http://somewhere")
+        self.storage_mock.save_notification.return_value = True
+        router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
+        self.router_mock.mark_messages_stored.return_value = router_data
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            ok_(isinstance(result, RouterResponse))
+            eq_(result.status_code, 202)
+            ok_(not self.agent_mock.request.called)
+            # Dead for another client's request, the node may hold it
+            ok_(not self.router_mock.clear_node.called)
+            self.router.metrics.increment.assert_any_call(
+                "updates.client.host_dead")
+        d.addBoth(verify_deliver)
+        return d
+
     def test_route_connection_fail_saved(self):
         self.agent_mock.request.side_effect = MockAssist(
             [self._raise_connection_refused_error])
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
         self.router_mock.clear_node.return_value = None
-        self.router_mock.get_uaid.return_value = {}
+        self.router_mock.mark_messages_stored.return_value = {}
         self.storage_mock.save_notification.return_value = True
         d = self.router.route_notification(self.notif, router_data)
 
@@ -527,25 +588,72 @@ class SimplePushRouterTestCase(unittest.TestCase):
         d.addBoth(verify_deliver)
         return d
 
-    def test_route_with_no_node_saves_and_lookup_fails(self):
+    def test_route_with_no_node_saves_and_mark_fails(self):
         self.storage_mock.save_notification.return_value = True
-        self.router_mock.get_uaid.side_effect = MockAssist(
+        self.router_mock.mark_messages_stored.side_effect = MockAssist(
             [self._raise_db_error]
         )
+        self.router_mock.get_uaid.return_value = dict(
+            node_id="http://somewhere", uaid=dummy_uaid)
+        self.agent_mock.request.return_value = response_mock = Mock()
+        response_mock.addCallback.return_value = response_mock
+        response_mock.code = 200
+        retry = self.router.ap_settings.db_retry.retry_later = Mock()
         router_data = dict(uaid=dummy_uaid)
         d = self.router.route_notification(self.notif, router_data)
 
         def verify_deliver(result):
+            # The node read instead is checked, and the flag retried
             ok_(isinstance(result, RouterResponse))
-            eq_(result.status_code, 202)
+            eq_(result.status_code, 200)
+            ok_(self.router.log.info.called)
+            eq_(retry.call_args[0][1:], (0, self.router._mark_stored,
+                                         dummy_uaid, 1))
         d.addBoth(verify_deliver)
         return d
 
-    def test_route_with_no_node_saves_and_lookup_fails_with_item_error(self):
+    def test_route_with_no_node_saves_and_mark_and_read_fail(self):
         self.storage_mock.save_notification.return_value = True
+        self.router_mock.mark_messages_stored.side_effect = MockAssist(
+            [self._raise_db_error]
+        )
         self.router_mock.get_uaid.side_effect = MockAssist(
-            [self._raise_item_error]
+            [self._raise_db_error]
+        )
+        retry = self.router.ap_settings.db_retry.retry_later = Mock()
+        router_data = dict(uaid=dummy_uaid)
+        d = self.router.route_notification(self.notif, router_data)
+
+        def verify_deliver(result):
+            # Already stored, so the sender mustn't retry
+            ok_(isinstance(result, RouterResponse))
+            eq_(result.status_code, 202)
+            ok_(retry.called)
+        d.addBoth(verify_deliver)
+        return d
+
+    def test_mark_stored_retried_until_written(self):
+        self.router_mock.mark_messages_stored.side_effect = MockAssist(
+            [self._raise_db_error, dict(uaid=dummy_uaid)]
         )
+        retry = self.router.ap_settings.db_retry.retry_later = Mock()
+        d = self.router._mark_stored(dummy_uaid, 1)
+
+        def verify(result):
+            eq_(retry.call_args[0][1:], (1, self.router._mark_stored,
+                                         dummy_uaid, 2))
+            return self.router._mark_stored(dummy_uaid, 2)
+
+        def verify_written(result):
+            eq_(retry.call_count, 1)
+            eq_(result, dict(uaid=dummy_uaid))
+        d.addCallback(verify)
+        d.addCallback(verify_written)
+        return d
+
+    def test_route_with_no_node_saves_and_user_deleted(self):
+        self.storage_mock.save_notification.return_value = True
+        self.router_mock.mark_messages_stored.return_value = None
         router_data = dict(uaid=dummy_uaid)
         d = self.router.route_notification(self.notif, router_data)
 
@@ -560,7 +668,7 @@ class SimplePushRouterTestCase(unittest.TestCase):
         self.agent_mock.request.return_value = response_mock = Mock()
         response_mock.code = 202
         self.storage_mock.save_notification.return_value = True
-        self.router_mock.get_uaid.return_value = dict()
+        self.router_mock.mark_messages_stored.return_value = dict()
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
         d = self.router.route_notification(self.notif, router_data)
 
@@ -575,26 +683,28 @@ class SimplePushRouterTestCase(unittest.TestCase):
         response_mock.code = 202
         self.storage_mock.save_notification.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
-        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
 
         d = self.router.route_notification(self.notif, router_data)
 
         def verify_deliver(result):
             ok_(isinstance(result, RouterResponse))
             eq_(result.status_code, 202)
-            assert(self.router_mock.get_uaid.called)
+            # The record written stands in for a re-read
+            ok_(not self.router_mock.get_uaid.called)
+            self.router_mock.mark_messages_stored.assert_called_with(
+                dummy_uaid)
         d.addBoth(verify_deliver)
         return d
 
     def test_route_to_busy_node_saves_looks_up_and_send_check_fails(self):
-        import autopush.router.simple as simple
         response_mock = Mock()
         self.agent_mock.request.side_effect = MockAssist(
             [response_mock, self._raise_connection_refused_error])
         response_mock.code = 202
         self.storage_mock.save_notification.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
-        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
 
         d = self.router.route_notification(self.notif, router_data)
 
@@ -602,20 +712,19 @@ class SimplePushRouterTestCase(unittest.TestCase):
             ok_(isinstance(result, RouterResponse))
             eq_(result.status_code, 202)
             assert(self.router_mock.clear_node.called)
-            nk = simple.node_key(router_data["node_id"])
-            eq_(simple.dead_cache.get(nk), True)
+            ok_(not self.router.ap_settings.node_directory.alive(
+                router_data["node_id"]))
         d.addBoth(verify_deliver)
         return d
 
     def test_route_busy_node_saves_looks_up_and_send_check_fails_and_db(self):
-        import autopush.router.simple as simple
         response_mock = Mock()
         self.agent_mock.request.side_effect = MockAssist(
             [response_mock, self._raise_connect_error])
         response_mock.code = 202
         self.storage_mock.save_notification.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
-        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
         self.router_mock.clear_node.side_effect = MockAssist(
             [self._raise_db_error]
         )
@@ -626,8 +735,8 @@ class SimplePushRouterTestCase(unittest.TestCase):
             ok_(isinstance(result, RouterResponse))
             eq_(result.status_code, 202)
             assert(self.router_mock.clear_node.called)
-            nk = simple.node_key(router_data["node_id"])
-            eq_(simple.dead_cache.get(nk), True)
+            ok_(not self.router.ap_settings.node_directory.alive(
+                router_data["node_id"]))
         d.addBoth(verify_deliver)
         return d
 
@@ -638,7 +747,7 @@ class SimplePushRouterTestCase(unittest.TestCase):
             side_effect=MockAssist([202, 200]))
         self.storage_mock.save_notification.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
-        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
 
         d = self.router.route_notification(self.notif, router_data)
 
@@ -658,7 +767,7 @@ class SimplePushRouterTestCase(unittest.TestCase):
                     'mobilenetwork': {'mcc': 'hammer'}}
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            udp=udp_data)
-        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
         self.router.conf = {'server': 'http://example.com',
                             'idle': 1, 'cert': 'test.pem'}
 
@@ -709,10 +818,11 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.settings.current_msg_month)
         self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
         self.router.message_id = uuid.uuid4().hex
 
         d = self.router.route_notification(self.notif, router_data)
@@ -728,7 +838,53 @@ class WebPushRouterTestCase(unittest.TestCase):
                 "router.broadcast.save_hit"
             )
             ok_("Location" in result.headers)
+            self.router_mock.mark_messages_stored.assert_called_with(
+                dummy_uaid)
+
+        d.addCallback(verify_deliver)
+        return d
 
+    def test_route_with_consistent_record(self):
+        self.message_mock.store_message.return_value = True
+        self.message_mock.has_channel.return_value = True
+        router_data = dict(uaid=dummy_uaid,
+                           current_month=self.settings.current_msg_month)
+        self.router_mock.mark_messages_stored.return_value = router_data
+        context = RouteContext(self.settings, dummy_uaid, router_data,
+                               consistent=True)
+
+        d = self.router.route_notification(self.notif, router_data,
+                                           context=context)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 201)
+            # Neither the preflight check nor the node lookup read the
+            # record again
+            ok_(not self.router_mock.get_uaid.called)
+            eq_(self.router_mock.mark_messages_stored.call_count, 1)
+        d.addCallback(verify_deliver)
+        return d
+
+    def test_route_with_cached_record(self):
+        self.message_mock.store_message.return_value = True
+        self.message_mock.has_channel.return_value = True
+        cached = dict(uaid=dummy_uaid, current_month="message_old")
+        router_data = dict(uaid=dummy_uaid,
+                           current_month=self.settings.current_msg_month)
+        self.router_mock.get_uaid.return_value = router_data
+        self.router_mock.mark_messages_stored.return_value = router_data
+        context = RouteContext(self.settings, dummy_uaid, cached)
+
+        d = self.router.route_notification(self.notif, cached,
+                                           context=context)
+
+        def verify_deliver(result):
+            eq_(result.status_code, 201)
+            # The cached record's stale month was read again, once
+            self.router_mock.get_uaid.assert_called_once_with(
+                dummy_uaid, use_cache=False)
+            ok_(self.message_mock.store_message.called)
+            ok_(context.consistent)
         d.addCallback(verify_deliver)
         return d
 
@@ -740,7 +896,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [dummy_chid])
+        self.message_mock.has_channel.return_value = True
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid,
                            current_month=self.settings.current_msg_month)
         self.router_mock.get_uaid.return_value = router_data
@@ -763,7 +919,7 @@ class WebPushRouterTestCase(unittest.TestCase):
         type(response_mock).code = PropertyMock(
             side_effect=MockAssist([202, 200]))
         self.message_mock.store_message.return_value = True
-        self.message_mock.all_channels.return_value = (True, [])
+        self.message_mock.has_channel.return_value = False
         router_data = dict(node_id="http://somewhere", uaid=dummy_uaid)
         self.router_mock.get_uaid.return_value = router_data
         self.router.message_id = uuid.uuid4().hex
@@ -0,0 +1,129 @@
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from boto.dynamodb2.table import Table
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.trial import unittest
+
+from autopush.db import Message
+from autopush.metrics import SinkMetrics
+from autopush.retry import RetryPolicy
+from autopush.scheduler import (
+    BACKGROUND,
+    DELIVERY,
+    INTERACTIVE,
+    DBScheduler,
+)
+
+
+class DBSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Mock(spec=SinkMetrics)
+        self.scheduler = DBScheduler(self.metrics, capacity=10)
+        patcher = patch("autopush.scheduler.deferToThread")
+        self.mock_defer = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+        def defer(func, *args, **kwargs):
+            d = Deferred()
+            self.calls.append(d)
+            return d
+        self.mock_defer.side_effect = defer
+
+    def test_limits(self):
+        eq_([cls.workers for cls in self.scheduler.classes], [4, 2, 1])
+        eq_(self.scheduler.by_name[BACKGROUND].maximum, 5)
+
+    def test_queued_over_workers(self):
+        results = [self.scheduler.call(BACKGROUND, lambda: None)
+                   for _ in range(3)]
+        eq_(len(self.calls), 1)
+        eq_(len(self.scheduler.by_name[BACKGROUND].queue), 2)
+
+        self.calls[0].callback("done")
+        eq_(results[0].result, "done")
+        eq_(len(self.calls), 2)
+        ok_(not results[1].called)
+
+    def test_classes_independent(self):
+        self.scheduler.call(BACKGROUND, lambda: None)
+        self.scheduler.call(BACKGROUND, lambda: None)
+        self.scheduler.call(INTERACTIVE, lambda: None)
+        eq_(len(self.calls), 2)
+
+    def test_failure_frees_worker(self):
+        d1 = self.scheduler.call(BACKGROUND, lambda: None)
+        d2 = self.scheduler.call(BACKGROUND, lambda: None)
+        self.calls[0].errback(Exception("failed"))
+        self.assertFailure(d1, Exception)
+        eq_(len(self.calls), 2)
+        ok_(not d2.called)
+
+    def test_adjust_grows_waiting_class(self):
+        cls = self.scheduler.by_name[DELIVERY]
+        cls.max_wait = 1.0
+        self.scheduler.adjust()
+        eq_(cls.workers, 3)
+        eq_(cls.max_wait, 0.0)
+
+    def test_adjust_shrinks_idle_class(self):
+        cls = self.scheduler.by_name[DELIVERY]
+        cls.workers = 5
+        self.scheduler.adjust()
+        eq_(cls.workers, 4)
+
+    def test_adjust_capacity(self):
+        for cls in self.scheduler.classes:
+            cls.max_wait = 1.0
+            cls.workers = cls.maximum
+        self.scheduler.adjust()
+        workers = dict((cls.name, cls.workers)
+                       for cls in self.scheduler.classes)
+        eq_(sum(workers.values()), 10)
+        eq_(workers[BACKGROUND], 1)
+        eq_(workers[DELIVERY], 2)
+        eq_(workers[INTERACTIVE], 7)
+
+    def test_adjust_dispatches_and_reports(self):
+        for _ in range(3):
+            self.scheduler.call(BACKGROUND, lambda: None)
+        self.scheduler.by_name[BACKGROUND].max_wait = 1.0
+        self.scheduler.adjust()
+        eq_(len(self.calls), 2)
+        self.metrics.gauge.assert_any_call("db_scheduler.background.depth",
+                                           2)
+        self.metrics.gauge.assert_any_call(
+            "db_scheduler.background.workers", 2)
+
+    @inlineCallbacks
+    def test_async_twin(self):
+        message = Message(Table("message", connection=Mock()),
+                          SinkMetrics())
+        message.async_db = Mock()
+        message.async_db.fetch_messages.return_value = succeed(["msg"])
+        result = yield self.scheduler.call(DELIVERY, message.fetch_messages,
+                                           "uaid")
+        eq_(result, ["msg"])
+        ok_(not self.mock_defer.called)
+
+    def test_start_stop(self):
+        self.scheduler.start()
+        ok_(self.scheduler._adjust_loop.running)
+        self.scheduler.stop()
+        ok_(not self.scheduler._adjust_loop.running)
+
+    @patch("autopush.retry.reactor")
+    def test_retry_throttled(self, mock_reactor):
+        mock_reactor.callLater.side_effect = \
+            lambda delay, func, *args: func(*args)
+        retry = RetryPolicy(SinkMetrics(), base_delay=0, max_delay=0)
+        scheduler = DBScheduler(self.metrics, capacity=10, retry=retry)
+        message = Message(Table("message", connection=Mock()),
+                          SinkMetrics())
+        d = scheduler.call(DELIVERY, message.fetch_messages, "uaid")
+        self.calls[0].errback(
+            ProvisionedThroughputExceededException(400, "Bad Request"))
+        eq_(len(self.calls), 2)
+        self.calls[1].callback(["msg"])
+        eq_(d.result, ["msg"])
@@ -0,0 +1,110 @@
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from autopush.timerwheel import TimerWheel
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(resolution=1.0, clock=self.clock)
+
+    def test_batched(self):
+        calls = [Mock() for _ in range(3)]
+        self.wheel.callLater(1.2, calls[0], "a")
+        self.wheel.callLater(1.7, calls[1], b="b")
+        self.wheel.callLater(5, calls[2])
+        eq_(len(self.wheel), 3)
+        # A single reactor timer for the wheel
+        eq_(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1.5)
+        ok_(not calls[0].called)
+        self.clock.advance(0.5)
+        calls[0].assert_called_with("a")
+        calls[1].assert_called_with(b="b")
+        ok_(not calls[2].called)
+
+        self.clock.advance(3)
+        ok_(calls[2].called)
+        eq_(len(self.wheel), 0)
+        eq_(self.clock.getDelayedCalls(), [])
+
+    def test_short_delay(self):
+        func = Mock()
+        call = self.wheel.callLater(0.1, func)
+        eq_(len(self.wheel), 0)
+        eq_(self.clock.getDelayedCalls(), [call])
+        self.clock.advance(0.1)
+        ok_(func.called)
+
+    def test_cancel(self):
+        func = Mock()
+        call = self.wheel.callLater(2, func)
+        ok_(call.active())
+        call.cancel()
+        ok_(not call.active())
+        eq_(len(self.wheel), 0)
+        eq_(self.clock.getDelayedCalls(), [])
+        self.assertRaises(AlreadyCancelled, call.cancel)
+        self.assertRaises(AlreadyCancelled, call.reset, 1)
+
+        call = self.wheel.callLater(2, func)
+        self.clock.advance(2)
+        ok_(func.called)
+        self.assertRaises(AlreadyCalled, call.cancel)
+
+    def test_reset(self):
+        func = Mock()
+        call = self.wheel.callLater(2, func)
+        self.clock.advance(1)
+        call.reset(3)
+        eq_(call.getTime(), 4)
+        self.clock.advance(2)
+        ok_(not func.called)
+        call.delay(2)
+        eq_(call.getTime(), 6)
+        self.clock.advance(3)
+        ok_(func.called)
+
+    def test_schedule_while_firing(self):
+        later = Mock()
+
+        def first():
+            self.wheel.callLater(1, later)
+        self.wheel.callLater(1, first)
+        self.clock.advance(1)
+        ok_(not later.called)
+        eq_(len(self.wheel), 1)
+        self.clock.advance(1)
+        ok_(later.called)
+
+    def test_late_tick(self):
+        calls = [Mock(), Mock()]
+        self.wheel.callLater(1, calls[0])
+        self.wheel.callLater(50, calls[1])
+        # The reactor ran late, every bucket due fires
+        self.clock.rightNow = 100
+        self.clock.advance(0)
+        ok_(calls[0].called)
+        ok_(calls[1].called)
+
+    def test_error(self):
+        func = Mock()
+        self.wheel.callLater(1, Mock(side_effect=Exception("boom")))
+        self.wheel.callLater(1, func)
+        self.clock.advance(1)
+        ok_(func.called)
+        eq_(len(self.flushLoggedErrors()), 1)
+
+    def test_delayed_calls(self):
+        call = self.wheel.callLater(2, Mock())
+        short = self.wheel.callLater(0.5, Mock())
+        calls = self.wheel.getDelayedCalls()
+        ok_(call in calls)
+        ok_(short in calls)
+        call.cancel()
+        short.cancel()
@@ -1,5 +1,6 @@
 import json
 import datetime
+import struct
 import time
 import uuid
 from hashlib import sha256
@@ -14,25 +15,50 @@ from moto import mock_dynamodb2
 from nose.tools import (eq_, ok_)
 from txstatsd.metrics.metrics import Metrics
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, fail, succeed
 from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
+from twisted.web.client import ResponseDone
 
 import autopush.db as db
 from autopush.db import (
     create_rotating_message_table,
 )
+from autopush.admission import HelloAdmission
+from autopush.exceptions import AdmissionRejected
 from autopush.settings import AutopushSettings
+from autopush.timerwheel import TimerWheel
 from autopush.websocket import (
     PushState,
     PushServerProtocol,
+    BulkRouterHandler,
+    ChannelServerProtocol,
     RouterHandler,
     Notification,
     NotificationHandler,
     WebSocketServerProtocol,
+    check_notifications,
     ms_time,
+    state_footprint,
+    PendingAcks,
+    NOTIFICATION_POLL_INTERVAL,
+    FORWARDED_HEADER,
+)
+from autopush.channel import (
+    CHECK,
+    CONNECTED_AT,
+    DISCONNECT,
+    HEADER,
+    PUSH,
+    RESULT,
+    STATUS,
+    encode_uaid,
 )
 from autopush.utils import base64url_encode
+from autopush.workers import UAIDIndex
 
 from .test_router import MockAssist
 
@@ -60,6 +86,7 @@ class WebsocketTestCase(unittest.TestCase):
             hostname="localhost",
             statsd_host=None,
             env="test",
+            timer_resolution=0,
         )
         self.proto.ap_settings = settings
         self.proto.sendMessage = self.send_mock = Mock()
@@ -180,13 +207,58 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.onConnect(req)
         eq_(self.proto.ps._user_agent, "Me")
 
+    def test_draining(self):
+        from autobahn.websocket.types import ConnectionDeny
+        self.proto.ap_settings.drainer.draining = True
+        d = self.proto.onConnect(Mock())
+        failure = self.failureResultOf(d, ConnectionDeny)
+        eq_(failure.value.code, 503)
+
     def test_base_tags(self):
         req = Mock()
         req.headers = {'user-agent': "tester"}
         req.host = "example.com:8080"
         ps = PushState(settings=self.proto.ap_settings, request=req)
-        eq_(ps._base_tags, ['user_agent:tester',
-                            'host:example.com:8080'])
+        eq_(ps._base_tags, ('user_agent:tester',
+                            'host:example.com:8080'))
+
+    def test_timers_on_wheel(self):
+        clock = Clock()
+        self.proto.ap_settings.timers = wheel = TimerWheel(clock=clock)
+        self._connect()
+        self.proto.timeoutConnection = Mock()
+        self.proto.setTimeout(5)
+        eq_(len(wheel), 1)
+        self.proto.resetTimeout()
+        eq_(len(wheel), 1)
+        clock.advance(5)
+        ok_(self.proto.timeoutConnection.called)
+        eq_(clock.getDelayedCalls(), [])
+
+    def test_shared_tags(self):
+        req = Mock()
+        req.headers = {'user-agent': "tester"}
+        req.host = "example.com:8080"
+        ps = PushState(settings=self.proto.ap_settings, request=req)
+        req.headers = {'user-agent': "".join(["tes", "ter"])}
+        ps2 = PushState(settings=self.proto.ap_settings, request=req)
+        ok_(ps2._user_agent is ps._user_agent)
+        ok_(ps2._base_tags is ps._base_tags)
+
+    def test_footprint(self):
+        self._connect()
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+        idle = self.proto.ps.footprint()
+        ok_(idle > 0)
+        self.proto.ps.direct_updates.add(
+            Notification(channel_id="chid", data=None, headers={},
+                         version="1", ttl=60, timestamp=0))
+        ok_(self.proto.ps.footprint() > idle)
+
+        eq_(state_footprint({}), 0)
+        eq_(state_footprint({"uaid": self.proto}),
+            self.proto.ps.footprint())
 
     def test_reporter(self):
         from autopush.websocket import periodic_reporter
@@ -280,13 +352,21 @@ class WebsocketTestCase(unittest.TestCase):
 
         # Stick a mock on
         notif_mock = Mock()
-        self.proto.ps._callbacks.append(notif_mock)
+        self.proto._add_callback(notif_mock)
         self.proto.onClose(True, None, None)
         eq_(len(self.proto.ap_settings.clients), 0)
         eq_(len(list(notif_mock.mock_calls)), 1)
         name, _, _ = notif_mock.mock_calls[0]
         eq_(name, "cancel")
 
+    def test_mark_messages_stored_retried(self):
+        self._connect()
+        self.proto.ps.uaid = uaid = str(uuid.uuid4())
+        self.proto.force_retry = Mock()
+        self.proto._mark_messages_stored(None)
+        self.proto.force_retry.assert_called_with(
+            self.proto.ap_settings.router.mark_messages_stored, uaid)
+
     def test_close_with_delivery_cleanup(self):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
@@ -294,11 +374,13 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         # Stick an un-acked direct notification in
-        self.proto.ps.direct_updates[chid] = 12
+        self.proto.ps.direct_updates = {chid: 12}
 
         # Apply some mocks
         self.proto.ap_settings.storage.save_notification = Mock()
         self.proto.ap_settings.router.get_uaid = mock_get = Mock()
+        self.proto.ap_settings.router.mark_messages_stored = mock_mark = \
+            Mock()
         self.proto.ap_settings.agent = mock_agent = Mock()
         mock_get.return_value = dict(node_id="localhost:2000")
 
@@ -312,6 +394,7 @@ class WebsocketTestCase(unittest.TestCase):
                 reactor.callLater(0.1, wait_for_agent_call)
                 return
 
+            mock_mark.assert_called_with(self.proto.ps.uaid)
             self.flushLoggedErrors()
             d.callback(True)
         reactor.callLater(0.1, wait_for_agent_call)
@@ -325,16 +408,19 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         # Stick an un-acked direct notification in
-        self.proto.ps.direct_updates[chid] = [
-            Notification(channel_id=chid, version=str(uuid.uuid4()),
-                         headers={}, data="blah", ttl=200,
-                         timestamp=0)
-        ]
+        self.proto.ps.direct_updates = PendingAcks()
+        for version, ttl in (("1", 200), ("2", 200), ("3", 0)):
+            self.proto.ps.direct_updates.add(
+                Notification(channel_id=chid, version=version,
+                             headers={}, data="blah", ttl=ttl,
+                             timestamp=0)
+            )
 
         # Apply some mocks
-        self.proto.ap_settings.message.store_message = Mock()
+        self.proto.ps.message.store_messages = mock_store = Mock()
         self.proto.ap_settings.router.get_uaid = mock_get = Mock()
         self.proto.ap_settings.agent = mock_agent = Mock()
+        self.proto.ps.metrics = mock_metrics = Mock()
         mock_get.return_value = dict(node_id="localhost:2000")
 
         # Close the connection
@@ -347,6 +433,14 @@ class WebsocketTestCase(unittest.TestCase):
                 reactor.callLater(0.1, wait_for_agent_call)
                 return
 
+            # Expired messages aren't stored, the rest are written together
+            eq_(mock_store.call_count, 1)
+            uaid, messages = mock_store.call_args[0]
+            eq_(uaid, self.proto.ps.uaid)
+            eq_(sorted(x["message_id"] for x in messages), ["1", "2"])
+            eq_(mock_get.call_count, 1)
+            mock_metrics.increment.assert_any_call(
+                "client.disconnect.rescued", count=2, tags=None)
             self.flushLoggedErrors()
             d.callback(True)
         reactor.callLater(0.1, wait_for_agent_call)
@@ -359,7 +453,7 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         # Stick an un-acked direct notification in
-        self.proto.ps.direct_updates[chid] = 12
+        self.proto.ps.direct_updates = {chid: 12}
 
         # Apply some mocks
         self.proto.ap_settings.storage.save_notification = Mock()
@@ -389,7 +483,7 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         # Stick an un-acked direct notification in
-        self.proto.ps.direct_updates[chid] = 12
+        self.proto.ps.direct_updates = {chid: 12}
 
         # Apply some mocks
         self.proto.ap_settings.storage.save_notification = Mock()
@@ -458,6 +552,16 @@ class WebsocketTestCase(unittest.TestCase):
 
         return self._check_response(check_result)
 
+    def test_message_month_written_behind(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        updates = self.proto.ap_settings.router_updates = Mock()
+        updates.update_message_month.return_value = succeed(True)
+        self.proto._update_router_for_message_month(None)
+        updates.update_message_month.assert_called_with(
+            self.proto.ps.uaid, self.proto.ps.message_month)
+        ok_(self.transport_mock.resumeProducing.called)
+
     def test_hello_tomorrow(self):
         orig_uaid = "deadbeef12345678decafbad12345678"
         # router.register_user returns (registered, previous
@@ -559,6 +663,192 @@ class WebsocketTestCase(unittest.TestCase):
             db.TRACK_DB_CALLS = False
         return self._check_response(check_result)
 
+    def test_hello_skip_storage(self):
+        db.TRACK_DB_CALLS = True
+        db.DB_CALLS = []
+        self._connect()
+        self.proto.ap_settings.hello_skip_storage = True
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                channelIDs=[]))
+
+        def check_result(msg):
+            # New users have nothing stored, so storage isn't queried
+            eq_(db.DB_CALLS, ['register_user'])
+            eq_(msg["status"], 200)
+            eq_(self.proto.ap_settings.pending_hellos, {})
+            db.DB_CALLS = []
+            db.TRACK_DB_CALLS = False
+        return self._check_response(check_result)
+
+    def test_hello_checked_while_registering(self):
+        self._connect()
+        settings = self.proto.ap_settings
+        settings.hello_skip_storage = True
+        self.proto.ps.uaid = uaid = uuid.uuid4().hex
+        self.proto.ps.messages_stored_at = 0
+        settings.pending_hellos[uaid] = self.proto
+
+        eq_(check_notifications(settings, uaid)[0], 404)
+        self.proto.process_notifications = Mock()
+        self.proto.process_hello_notifications()
+        ok_(self.proto.process_notifications.called)
+
+    def test_hello_prefetch(self):
+        self._connect()
+        self.proto.ap_settings.hello_prefetch = True
+        uaid = uuid.uuid4().hex
+        router = self.proto.ap_settings.router
+        router.register_user(dict(
+            uaid=uaid, connected_at=ms_time(), router_type="webpush",
+            current_month=self.proto.ap_settings.current_msg_month))
+        router.clear_messages_stored(uaid, None)
+        calls = []
+        register_user = router.register_user
+
+        def register(*args, **kwargs):
+            calls.append("register_user")
+            return register_user(*args, **kwargs)
+
+        def fetch(*args, **kwargs):
+            calls.append("fetch_messages")
+            return []
+        router.register_user = Mock(side_effect=register)
+        self.proto.ps.message.fetch_messages = Mock(side_effect=fetch)
+
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                uaid=uaid, channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 200)
+            eq_(sorted(calls), ["fetch_messages", "register_user"])
+            eq_(self.proto.ps._prefetch, None)
+        return self._check_response(check_result)
+
+    def test_prefetch_discarded(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        self.proto.ps.messages_stored_at = 0
+        d = Deferred()
+        self.proto.ps._prefetch = (uuid.uuid4().hex,
+                                   self.proto.ps.message_month, d)
+        eq_(self.proto._claim_prefetch(), None)
+        ok_(d.called)
+        eq_(self.proto.ps._prefetch, None)
+
+        d = Deferred()
+        self.proto.ps._prefetch = (self.proto.ps.uaid, "message_2000_1", d)
+        eq_(self.proto._claim_prefetch(), None)
+        ok_(d.called)
+
+        # Stored at some point, possibly after the prefetch read
+        for stored_at in (None, 10):
+            self.proto.ps.messages_stored_at = stored_at
+            d = Deferred()
+            self.proto.ps._prefetch = (self.proto.ps.uaid,
+                                       self.proto.ps.message_month, d)
+            eq_(self.proto._claim_prefetch(), None)
+            ok_(d.called)
+
+        self.proto.ps.messages_stored_at = 0
+        d = Deferred()
+        self.proto.ps._prefetch = (self.proto.ps.uaid,
+                                   self.proto.ps.message_month, d)
+        ok_(self.proto._claim_prefetch() is d)
+
+    def test_prefetch_dropped_on_hello_error(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        fetch = Deferred()
+        self.proto._fetch_notifications = Mock(return_value=fetch)
+        self.proto._prefetch_notifications()
+
+        self.proto.err_hello(Failure(Exception("oops")))
+        ok_(fetch.called)
+        eq_(self.proto.ps._prefetch, None)
+
+    def test_prefetch_throttled_unclaimed(self):
+        self._connect()
+        self.proto.ps.uaid = uuid.uuid4().hex
+        self.proto._fetch_notifications = Mock(return_value=fail(
+            ProvisionedThroughputExceededException(None, None)))
+        self.proto._prefetch_notifications()
+        eq_(self.proto.ps._prefetch, None)
+        eq_(self.proto._claim_prefetch(), None)
+
+    def test_hello_prefetch_stored_during_register(self):
+        self._connect()
+        self.proto.ap_settings.hello_prefetch = True
+        uaid = uuid.uuid4().hex
+        router = self.proto.ap_settings.router
+        router.register_user(dict(
+            uaid=uaid, connected_at=ms_time(), router_type="webpush",
+            current_month=self.proto.ap_settings.current_msg_month))
+        router.clear_messages_stored(uaid, None)
+        register_user = router.register_user
+        fetches = []
+
+        def register(*args, **kwargs):
+            # An endpoint stores a message after the prefetch read, and
+            # finds no node to notify before this registration is written
+            router.mark_messages_stored(uaid)
+            return register_user(*args, **kwargs)
+
+        def fetch(*args, **kwargs):
+            fetches.append(args)
+            return []
+        router.register_user = Mock(side_effect=register)
+        router.clear_messages_stored = Mock(return_value=True)
+        self.proto.ps.message.fetch_messages = Mock(side_effect=fetch)
+
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                uaid=uaid, channelIDs=[]))
+
+        d = Deferred()
+
+        def check_fetched():
+            if len(fetches) < 2:
+                return reactor.callLater(0.1, check_fetched)
+            self.proto.ps.metrics.increment.assert_any_call(
+                "updates.client.prefetch_discarded",
+                tags=self.proto.base_tags)
+            d.callback(True)
+        check_fetched()
+        return d
+
+    def test_hello_messages_stored(self):
+        self._connect()
+        self.proto.ap_settings.hello_skip_storage = True
+        uaid = uuid.uuid4().hex
+        router = self.proto.ap_settings.router
+        router.register_user(dict(
+            uaid=uaid, connected_at=ms_time(), router_type="webpush",
+            current_month=self.proto.ap_settings.current_msg_month))
+        router.mark_messages_stored(uaid)
+        stored_at = router.get_uaid(uaid)["messages_stored_at"]
+        self.proto.ps.message.fetch_messages = Mock(return_value=[])
+        self.proto.ps.message.all_channels = Mock(return_value=(True, []))
+        router.clear_messages_stored = Mock(return_value=True)
+
+        self._send_message(dict(messageType="hello", use_webpush=True,
+                                uaid=uaid, channelIDs=[]))
+
+        d = Deferred()
+
+        def check_cleared():
+            if not router.clear_messages_stored.called:
+                return reactor.callLater(0.1, check_cleared)
+            ok_(self.proto.ps.message.fetch_messages.called)
+            router.clear_messages_stored.assert_called_with(uaid,
+                                                            stored_at)
+            eq_(self.proto.ps.messages_stored_at, 0)
+            d.callback(True)
+
+        def check_result(msg):
+            eq_(msg["status"], 200)
+            check_cleared()
+        self._check_response(check_result)
+        return d
+
     def test_hello_with_webpush(self):
         self._connect()
         self._send_message(dict(messageType="hello", use_webpush=True,
@@ -567,7 +857,7 @@ class WebsocketTestCase(unittest.TestCase):
         def check_result(msg):
             eq_(msg["status"], 200)
             assert("use_webpush" in msg)
-        eq_(self.proto.base_tags, ['use_webpush:True'])
+        eq_(self.proto.base_tags, ('use_webpush:True',))
         return self._check_response(check_result)
 
     def test_hello_with_uaid(self):
@@ -638,6 +928,36 @@ class WebsocketTestCase(unittest.TestCase):
 
         return self._check_response(check_result)
 
+    def test_hello_admitted(self):
+        self._connect()
+        admission = self.proto.ap_settings.hello_admission = HelloAdmission(
+            self.proto.ps.metrics, max_concurrency=2)
+
+        self._send_message(dict(messageType="hello", channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 200)
+            eq_(admission.limit.active, 0)
+
+        return self._check_response(check_result)
+
+    def test_hello_rejected(self):
+        self._connect()
+        admission = self.proto.ap_settings.hello_admission = Mock()
+        admission.call = Mock(return_value=fail(
+            AdmissionRejected("Hello queue timeout")))
+
+        self._send_message(dict(messageType="hello", channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 503)
+            eq_(msg["reason"], "error - overloaded")
+            self.close_mock.assert_called_with(code=4013,
+                                               reason="Try Again Later")
+            ok_(self.proto.transport.resumeProducing.called)
+
+        return self._check_response(check_result)
+
     def test_hello_check_collision(self):
         self._connect()
 
@@ -751,6 +1071,22 @@ class WebsocketTestCase(unittest.TestCase):
                          "mnc": "banana", "netid": "gorp"}})
         return self._check_response(check_result)
 
+    def test_hello_worker_index(self):
+        index = self.proto.ap_settings.uaid_index = UAIDIndex(2, slots=8)
+        index.claim(0)
+        self._connect()
+        self._send_message(dict(messageType="hello", channelIDs=[]))
+
+        def check_result(msg):
+            eq_(msg["status"], 200)
+            index.worker = 1
+            eq_(index.find(msg["uaid"]), 0)
+            index.worker = 0
+            self.proto.onClose(True, None, None)
+            index.worker = 1
+            eq_(index.find(msg["uaid"]), None)
+        return self._check_response(check_result)
+
     def test_bad_hello_udp(self):
         self._connect()
         self._send_message(dict(messageType="hello", channelIDs=[],
@@ -1104,9 +1440,20 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
         self._connect()
         self.proto.ps.use_webpush = True
+        self.proto.ps.direct_updates = PendingAcks()
+        self.proto.ps.updates_sent = PendingAcks()
+        for version in ("a", "b"):
+            self.proto.ps.updates_sent.add(
+                Notification(channel_id=chid, data="bleh", headers={},
+                             version=version, ttl=200, timestamp=0))
+        self.proto.ps.updates_sent.add(
+            Notification(channel_id="other", data="bleh", headers={},
+                         version="a", ttl=200, timestamp=0))
         self.proto.force_retry = Mock()
         self.proto.process_unregister(dict(channelID=chid))
         assert self.proto.force_retry.called
+        eq_(len(self.proto.ps.updates_sent), 1)
+        eq_(self.proto.ps.updates_sent.get(chid, "a"), None)
 
     def test_ws_unregister(self):
         self._connect()
@@ -1203,6 +1550,8 @@ class WebsocketTestCase(unittest.TestCase):
     def test_notification(self):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.updates_sent = {}
+        self.proto.ps.direct_updates = {}
         chid = str(uuid.uuid4())
 
         # Send ourself a notification
@@ -1231,7 +1580,7 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.uaid = str(uuid.uuid4())
 
         chid = str(uuid.uuid4())
-        self.proto.ps.direct_updates[chid] = []
+        self.proto.ps.direct_updates = PendingAcks()
 
         # Send ourself a notification
         payload = {"channelID": chid, "version": 10, "data": "bleh",
@@ -1248,7 +1597,8 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.uaid = str(uuid.uuid4())
 
         chid = str(uuid.uuid4())
-        self.proto.ps.updates_sent[chid] = 14
+        self.proto.ps.updates_sent = {chid: 14}
+        self.proto.ps.direct_updates = {}
 
         # Send ourself a notification
         payload = {"channelID": chid, "version": 10}
@@ -1300,16 +1650,17 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         self.proto.ps.use_webpush = True
-        self.proto.ps.direct_updates[chid] = [
+        self.proto.ps.direct_updates = PendingAcks()
+        self.proto.ps.direct_updates.add(
             Notification(version="bleh", headers={}, data="meh",
                          channel_id=chid, ttl=200, timestamp=0)
-        ]
+        )
 
         self.proto.ack_update(dict(
             channelID=chid,
             version="bleh:asdjfilajsdilfj"
         ))
-        eq_(self.proto.ps.direct_updates[chid], [])
+        eq_(len(self.proto.ps.direct_updates), 0)
         eq_(len(self.proto.log.info.mock_calls), 1)
         args, kwargs = self.proto.log.info.call_args
         eq_(args[0], "Ack")
@@ -1320,13 +1671,15 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         chid = str(uuid.uuid4())
         self.proto.ps.use_webpush = True
-        self.proto.ps.direct_updates[chid] = []
-        self.proto.ps.updates_sent[chid] = [
+        self.proto.ps.direct_updates = PendingAcks()
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto.ps.updates_sent.add(
             Notification(version="bleh", headers={}, data="meh",
                          channel_id=chid, ttl=200, timestamp=0)
-        ]
+        )
 
         mock_defer = Mock()
+        self.proto.ap_settings.ack_batcher = None
         self.proto.force_retry = Mock(return_value=mock_defer)
         self.proto.ack_update(dict(
             channelID=chid,
@@ -1341,6 +1694,34 @@ class WebsocketTestCase(unittest.TestCase):
         eq_(kwargs["router_key"], "webpush")
         eq_(kwargs["message_source"], "stored")
 
+    def test_ack_with_webpush_from_storage_batched(self):
+        self._connect()
+        chid = str(uuid.uuid4())
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.direct_updates = PendingAcks()
+        notif = Notification(version="bleh", headers={}, data="meh",
+                             channel_id=chid, ttl=200, timestamp=0)
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto.ps.updates_sent.add(notif)
+
+        batcher = self.proto.ap_settings.ack_batcher = Mock()
+        batcher.delete.return_value = delete_d = Deferred()
+        self.proto.force_retry = Mock()
+        d = self.proto.ack_update(dict(
+            channelID=chid,
+            version="bleh:jialsdjfilasjdf",
+            code=200
+        ))
+        ok_(not self.proto.force_retry.called)
+        batcher.delete.assert_called_with(self.proto.ps.message,
+                                          self.proto.ps.uaid, chid, "bleh")
+        # Not removed until the batched delete has run
+        eq_(list(self.proto.ps.updates_sent), [notif])
+        delete_d.callback(True)
+        eq_(len(self.proto.ps.updates_sent), 0)
+        return d
+
     def test_nack(self):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
@@ -1365,25 +1746,23 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
         notif = Notification(version="bleh", headers={}, data="meh",
                              channel_id=chid, ttl=200, timestamp=0)
-        self.proto.ps.updates_sent[chid] = [notif]
-        self.proto._handle_webpush_update_remove(None, chid, notif)
-        eq_(self.proto.ps.updates_sent[chid], [])
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto.ps.updates_sent.add(notif)
+        self.proto._handle_webpush_update_remove(None, chid, "bleh")
+        eq_(len(self.proto.ps.updates_sent), 0)
 
     def test_ack_remove_not_set(self):
         self._connect()
         chid = str(uuid.uuid4())
-        notif = Notification(version="bleh", headers={}, data="meh",
-                             channel_id=chid, ttl=200, timestamp=0)
-        self.proto.ps.updates_sent[chid] = None
-        self.proto._handle_webpush_update_remove(None, chid, notif)
+        del self.proto.ps.updates_sent
+        self.proto._handle_webpush_update_remove(None, chid, "bleh")
 
     def test_ack_remove_missing(self):
         self._connect()
         chid = str(uuid.uuid4())
-        notif = Notification(version="bleh", headers={}, data="meh",
-                             channel_id=chid, ttl=200, timestamp=0)
-        self.proto.ps.updates_sent[chid] = []
-        self.proto._handle_webpush_update_remove(None, chid, notif)
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto._handle_webpush_update_remove(None, chid, "bleh")
+        eq_(len(self.proto.ps.updates_sent), 0)
 
     def test_ack_fails_first_time(self):
         self._connect()
@@ -1402,7 +1781,8 @@ class WebsocketTestCase(unittest.TestCase):
         chid = str(uuid.uuid4())
 
         # stick a notification to ack in
-        self.proto.ps.updates_sent[chid] = 12
+        self.proto.ps.updates_sent = {chid: 12}
+        self.proto.ps.direct_updates = {}
 
         # Send our ack
         self._send_message(dict(messageType="ack",
@@ -1538,13 +1918,15 @@ class WebsocketTestCase(unittest.TestCase):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
         self.proto.ps.use_webpush = True
-        self.proto.ps.updates_sent["chid"] = [
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto.ps.updates_sent.add(
             Notification(channel_id="chid", data="bleh", headers={},
                          version="now", ttl=200, timestamp=0)
-        ]
-        self.proto.deferToLater = Mock()
-        self.proto.process_notifications()
-        assert self.proto.deferToLater.called
+        )
+        with patch("autopush.websocket.reactor") as mr:
+            self.proto.process_notifications()
+            ok_(mr.callLater.called)
+        ok_(self.proto.ps._wake_pending)
         eq_(self.proto.ps._notification_fetch, None)
 
     def test_process_notif_doesnt_run_when_paused(self):
@@ -1570,14 +1952,113 @@ class WebsocketTestCase(unittest.TestCase):
             self.proto.finish_notifications(None)
             ok_(mr.callLater.mock_calls > 0)
 
+    def test_process_notif_woken_on_resume(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.pauseProducing()
+        self.proto.process_notifications()
+        ok_(self.proto.ps._wake_pending)
+        timer = self.proto.ps._wake_timer
+        ok_(timer is not None)
+
+        # A second check while waiting doesn't add another timer
+        self.proto.process_notifications()
+        eq_(self.proto.ps._wake_timer, timer)
+
+        self.proto.process_notifications = Mock()
+        self.proto.ps.resumeProducing()
+        ok_(self.proto.process_notifications.called)
+        eq_(self.proto.ps._wake_pending, False)
+        eq_(self.proto.ps._wake_timer, None)
+        ok_(not timer.active())
+
+    def test_outbound_queue(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.direct_updates = PendingAcks()
+        self.proto.ap_settings.outbound_queue_size = 2
+        self.proto.ps.pauseProducing()
+
+        def update(version):
+            return dict(channelID="chid", version=version, data="abc",
+                        headers={}, ttl=60, timestamp=0)
+        ok_(self.proto.queue_notifications(update("1")))
+        ok_(self.proto.queue_notifications(update("2")))
+        # Full by count
+        eq_(self.proto.queue_notifications(update("3")), False)
+        ok_(not self.send_mock.called)
+        # Queued notifications are rescued if the client drops
+        eq_(len(self.proto.ps.direct_updates), 2)
+
+        # Sent in order once output resumes, until paused again
+        self.send_mock.side_effect = lambda *args: \
+            self.proto.ps.pauseProducing()
+        self.proto.ps.resumeProducing()
+        eq_(len(self.send_mock.mock_calls), 1)
+        self.send_mock.side_effect = None
+        self.proto.ps.resumeProducing()
+        versions = [json.loads(call[1][0])["version"]
+                    for call in self.send_mock.mock_calls]
+        eq_(versions, ["1:", "2:"])
+        eq_(self.proto.ps._outbound, None)
+        eq_(self.proto.ps._outbound_bytes, 0)
+
+    def test_outbound_queue_bytes(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.direct_updates = {}
+        self.proto.ps.updates_sent = {}
+        self.proto.ap_settings.outbound_queue_bytes = 100
+        self.proto.ps.pauseProducing()
+        eq_(self.proto.queue_notifications(dict(
+            channelID="chid", version=10, data="x" * 100)), False)
+        eq_(self.proto.ps._outbound, None)
+        eq_(self.proto.ps.direct_updates, {})
+        ok_(self.proto.queue_notifications(dict(
+            channelID="chid", version=11)))
+        eq_(self.proto.ps.direct_updates, {"chid": 11})
+
+    def test_process_notif_woken_on_ack(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps.updates_sent = PendingAcks()
+        self.proto.ps.updates_sent.add(
+            Notification(channel_id="chid", data="bleh", headers={},
+                         version="now", ttl=200, timestamp=0)
+        )
+        self.proto.process_notifications()
+        ok_(self.proto.ps._wake_pending)
+
+        self.proto.ps.updates_sent.remove("chid", "now")
+        self.proto.process_notifications = Mock()
+        self.proto.check_missed_notifications(None)
+        ok_(self.proto.process_notifications.called)
+        eq_(self.proto.ps._wake_pending, False)
+
+    def test_process_notif_safety_net(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.pauseProducing()
+        with patch("autopush.websocket.reactor") as mr:
+            self.proto.process_notifications()
+            eq_(mr.callLater.call_args[0][0], NOTIFICATION_POLL_INTERVAL)
+            fire = mr.callLater.call_args[0][1]
+        self.proto.process_notifications = Mock()
+        fire()
+        ok_(self.proto.process_notifications.called)
+        eq_(self.proto.ps._wake_pending, False)
+        eq_(self.proto.ps._wake_timer, None)
+
     def test_notif_finished_with_webpush(self):
         self._connect()
         self.proto.ps.uaid = str(uuid.uuid4())
         self.proto.ps.use_webpush = True
-        self.proto.deferToLater = Mock()
+        self.proto.process_notifications = Mock()
         self.proto.ps._check_notifications = True
         self.proto.finish_notifications(None)
-        assert self.proto.deferToLater.called
+        ok_(self.proto.process_notifications.called)
 
     def test_notif_finished_with_webpush_with_notifications(self):
         self._connect()
@@ -1585,7 +2066,7 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.use_webpush = True
         self.proto.ps._check_notifications = True
         self.proto.process_notifications = Mock()
-        self.proto.ps.updates_sent["asdf"] = []
+        self.proto.ps.updates_sent = PendingAcks()
 
         self.proto.finish_webpush_notifications([
             dict(chidmessageid="asdf:fdsa", headers={}, data="bleh", ttl=100,
@@ -1599,8 +2080,9 @@ class WebsocketTestCase(unittest.TestCase):
         self.proto.ps.use_webpush = True
         self.proto.ps._check_notifications = True
         self.proto.process_notifications = Mock()
-        self.proto.ps.updates_sent["asdf"] = []
+        self.proto.ps.updates_sent = PendingAcks()
 
+        self.proto.ap_settings.ack_batcher = None
         self.proto.force_retry = Mock()
         self.proto.finish_webpush_notifications([
             dict(chidmessageid="asdf:fdsa", headers={}, data="bleh", ttl=10,
@@ -1609,6 +2091,25 @@ class WebsocketTestCase(unittest.TestCase):
         assert self.proto.force_retry.called
         assert not self.send_mock.called
 
+    def test_notif_finished_with_webpush_with_old_notifications_batched(self):
+        self._connect()
+        self.proto.ps.uaid = str(uuid.uuid4())
+        self.proto.ps.use_webpush = True
+        self.proto.ps._check_notifications = True
+        self.proto.process_notifications = Mock()
+        self.proto.ps.updates_sent = PendingAcks()
+
+        batcher = self.proto.ap_settings.ack_batcher = Mock()
+        self.proto.force_retry = Mock()
+        self.proto.finish_webpush_notifications([
+            dict(chidmessageid="asdf:fdsa", headers={}, data="bleh", ttl=10,
+                 timestamp=0, updateid=uuid.uuid4().hex)
+        ])
+        batcher.delete.assert_called_with(self.proto.ps.message,
+                                          self.proto.ps.uaid, "asdf", "fdsa")
+        assert not self.proto.force_retry.called
+        assert not self.send_mock.called
+
     def test_notification_results(self):
         # Populate the database for ourself
         uaid = str(uuid.uuid4())
@@ -1621,14 +2122,14 @@ class WebsocketTestCase(unittest.TestCase):
         storage.save_notification(uaid, chid3, 9)
 
         self._connect()
+        self._send_message(dict(messageType="hello", channelIDs=[],
+                                uaid=uaid))
+
         # Indicate we saw a newer direct version of chid2, and an older direct
-        # version of chid3
+        # version of chid3, before the notification check runs
         self.proto.ps.direct_updates[chid2] = 9
         self.proto.ps.direct_updates[chid3] = 8
 
-        self._send_message(dict(messageType="hello", channelIDs=[],
-                                uaid=uaid))
-
         d = Deferred()
 
         def check_notifs(msg):
@@ -1759,6 +2260,31 @@ class WebsocketTestCase(unittest.TestCase):
         return d
 
 
+class PendingAcksTestCase(unittest.TestCase):
+    def _notif(self, chid, version):
+        return Notification(channel_id=chid, version=version, data=None,
+                            headers={}, ttl=60, timestamp=0)
+
+    def test_add_remove(self):
+        acks = PendingAcks()
+        eq_(len(acks), 0)
+        acks.add(self._notif("a", "1"))
+        acks.add(self._notif("a", "2"))
+        # Resending a version replaces it
+        notif = self._notif("a", "1")
+        acks.add(notif)
+        eq_(len(acks), 2)
+        eq_(acks.get("a", "1"), notif)
+
+        eq_(acks.remove("a", "1"), notif)
+        eq_(acks.remove("a", "1"), None)
+        eq_(acks.remove("b", "1"), None)
+        eq_([x.version for x in acks], ["2"])
+        acks.remove("a", "2")
+        eq_(len(acks), 0)
+        ok_(not acks)
+
+
 class RouterHandlerTestCase(unittest.TestCase):
     def setUp(self):
         twisted.internet.base.DelayedCall.debug = True
@@ -1796,12 +2322,176 @@ class RouterHandlerTestCase(unittest.TestCase):
         uaid = str(uuid.uuid4())
         self.mock_request.body = "{}"
         self.ap_settings.clients[uaid] = client_mock = Mock()
-        client_mock.accept_notification = False
+        client_mock.queue_notifications.return_value = False
         self.handler.put(uaid)
         eq_(len(self.write_mock.mock_calls), 1)
         eq_(len(self.status_mock.mock_calls), 1)
         eq_(self.status_mock.call_args, ((503,),))
 
+    def test_client_connected_but_paused(self):
+        uaid = str(uuid.uuid4())
+        self.mock_request.body = '{"channelID": "chid"}'
+        self.ap_settings.clients[uaid] = client_mock = Mock()
+        client_mock.paused = True
+        client_mock.queue_notifications.return_value = True
+        self.handler.put(uaid)
+        client_mock.queue_notifications.assert_called_with(
+            {"channelID": "chid"})
+        ok_(not client_mock.send_notifications.called)
+        eq_(len(self.status_mock.mock_calls), 0)
+        self.write_mock.assert_called_with("Client accepted for delivery")
+
+    def _other_worker(self, uaid):
+        index = self.ap_settings.uaid_index = UAIDIndex(2, slots=8)
+        index.claim(1)
+        index.add(uaid)
+        index.worker = 0
+        self.ap_settings.worker_urls = ["http://localhost:8081",
+                                        "http://localhost:8082"]
+        self.ap_settings.agent = Mock()
+        self.mock_request.method = "PUT"
+        self.mock_request.uri = "/push/" + uaid
+        self.mock_request.headers = {}
+
+    @patch("autopush.websocket.readBody", return_value=succeed("accepted"))
+    def test_client_on_other_worker(self, mock_read):
+        uaid = uuid.uuid4().hex
+        self._other_worker(uaid)
+        self.mock_request.body = "{}"
+        self.ap_settings.agent.request.return_value = succeed(Mock(code=200))
+        d = self.handler.put(uaid)
+
+        def check(result):
+            method, url, headers, body = \
+                self.ap_settings.agent.request.call_args[0]
+            eq_(url, "http://localhost:8082/push/" + uaid)
+            eq_(headers.getRawHeaders(FORWARDED_HEADER), ["0"])
+            self.status_mock.assert_called_with(200)
+            self.write_mock.assert_called_with("accepted")
+        return d.addCallback(check)
+
+    def test_client_on_other_worker_unreachable(self):
+        uaid = uuid.uuid4().hex
+        self._other_worker(uaid)
+        self.mock_request.body = "{}"
+        self.ap_settings.agent.request.return_value = fail(ConnectError())
+        d = self.handler.put(uaid)
+
+        def check(result):
+            self.status_mock.assert_called_with(404)
+            self.flushLoggedErrors(ConnectError)
+        return d.addCallback(check)
+
+    def test_forwarded_not_forwarded_again(self):
+        uaid = uuid.uuid4().hex
+        self._other_worker(uaid)
+        self.mock_request.headers = {FORWARDED_HEADER: "1"}
+        self.mock_request.body = "{}"
+        self.handler.put(uaid)
+        ok_(not self.ap_settings.agent.request.called)
+        self.status_mock.assert_called_with(404)
+
+    def test_invalid_body(self):
+        self.mock_request.body = "{"
+        self.handler.put(uuid.uuid4().hex)
+        self.status_mock.assert_called_with(400)
+
+
+class BulkRouterHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ap_settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.ap_settings.metrics = Mock(spec=Metrics)
+        h = BulkRouterHandler
+        h.ap_settings = self.ap_settings
+        self.mock_request = Mock()
+        self.handler = h(Application(), self.mock_request)
+        self.handler.write = self.write_mock = Mock()
+
+    def test_results(self):
+        connected, busy, missing = [str(uuid.uuid4()) for _ in range(3)]
+        self.ap_settings.clients[connected] = client_mock = Mock()
+        client_mock.paused = False
+        self.ap_settings.clients[busy] = busy_mock = Mock()
+        busy_mock.paused = True
+        busy_mock.queue_notifications.return_value = False
+        self.mock_request.body = json.dumps([
+            dict(uaid=connected, update={"channelID": "a"}),
+            dict(uaid=busy, update={"channelID": "b"}),
+            dict(uaid=missing, update={"channelID": "c"}),
+        ])
+        self.handler.post()
+        client_mock.send_notifications.assert_called_with(
+            {"channelID": "a"})
+        self.write_mock.assert_called_with({"results": [200, 503, 404]})
+        self.ap_settings.metrics.increment.assert_any_call(
+            "updates.router.bulk")
+
+    def test_invalid_batch(self):
+        self.handler.set_status = status_mock = Mock()
+        for body in ["[", "{}", '[{"uaid": "abc"}]']:
+            self.mock_request.body = body
+            self.handler.post()
+            status_mock.assert_called_with(400)
+        ok_(not self.ap_settings.metrics.increment.called)
+
+    def _other_worker(self, uaid):
+        index = self.ap_settings.uaid_index = UAIDIndex(2, slots=8)
+        index.claim(1)
+        index.add(uaid)
+        index.worker = 0
+        self.ap_settings.worker_urls = ["http://localhost:8081",
+                                        "http://localhost:8082"]
+        self.ap_settings.agent = Mock()
+        self.mock_request.uri = "/push"
+        self.mock_request.headers = {}
+
+    @patch("autopush.websocket.readBody",
+           return_value=succeed(json.dumps({"results": [200]})))
+    def test_client_on_other_worker(self, mock_read):
+        other, missing = uuid.uuid4().hex, uuid.uuid4().hex
+        self._other_worker(other)
+        self.mock_request.body = json.dumps([
+            dict(uaid=missing, update={"channelID": "a"}),
+            dict(uaid=other, update={"channelID": "b"}),
+        ])
+        self.ap_settings.agent.request.return_value = succeed(Mock(code=200))
+        d = self.handler.post()
+
+        def check(result):
+            method, url, headers, body = \
+                self.ap_settings.agent.request.call_args[0]
+            eq_(method, "POST")
+            eq_(url, "http://localhost:8082/push")
+            eq_(headers.getRawHeaders(FORWARDED_HEADER), ["0"])
+            eq_(json.loads(body._inputFile.getvalue()),
+                [dict(uaid=other, update={"channelID": "b"})])
+            self.write_mock.assert_called_with({"results": [404, 200]})
+        return d.addCallback(check)
+
+    def test_client_on_other_worker_unreachable(self):
+        uaid = uuid.uuid4().hex
+        self._other_worker(uaid)
+        self.mock_request.body = json.dumps([dict(uaid=uaid, update={})])
+        self.ap_settings.agent.request.return_value = fail(ConnectError())
+        d = self.handler.post()
+
+        def check(result):
+            self.write_mock.assert_called_with({"results": [404]})
+            self.flushLoggedErrors(ConnectError)
+        return d.addCallback(check)
+
+    def test_forwarded_not_forwarded_again(self):
+        uaid = uuid.uuid4().hex
+        self._other_worker(uaid)
+        self.mock_request.headers = {FORWARDED_HEADER: "1"}
+        self.mock_request.body = json.dumps([dict(uaid=uaid, update={})])
+        self.handler.post()
+        ok_(not self.ap_settings.agent.request.called)
+        self.write_mock.assert_called_with({"results": [404]})
+
 
 class NotificationHandlerTestCase(unittest.TestCase):
     def setUp(self):
@@ -1833,10 +2523,12 @@ class NotificationHandlerTestCase(unittest.TestCase):
         self.mock_request.body = "{}"
         self.ap_settings.clients[uaid] = client_mock = Mock()
         client_mock.paused = True
-        client_mock._check_notifications = False
+        client_mock.ps._check_notifications = False
         self.handler.put(uaid)
         eq_(len(self.write_mock.mock_calls), 1)
-        eq_(client_mock._check_notifications, True)
+        eq_(client_mock.ps._check_notifications, True)
+        ok_(client_mock._defer_notifications.called)
+        ok_(not client_mock.process_notifications.called)
         eq_(self.status_mock.call_args, ((202,),))
 
     def test_not_connected(self):
@@ -1855,3 +2547,98 @@ class NotificationHandlerTestCase(unittest.TestCase):
         mock_client.sendClose = Mock()
         self.handler.delete(uaid, "", now)
         assert(mock_client.sendClose.called)
+
+
+class ChannelServerProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ap_settings = AutopushSettings(
+            hostname="localhost",
+            statsd_host=None,
+        )
+        self.ap_settings.metrics = Mock(spec=Metrics)
+        self.proto = ChannelServerProtocol()
+        self.proto.ap_settings = self.ap_settings
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def _request(self, request_id, command, body):
+        frame = HEADER.pack(request_id, command) + body
+        self.proto.dataReceived(struct.pack(">I", len(frame)) + frame)
+
+    def _results(self):
+        data = self.transport.value()
+        results = []
+        while data:
+            length = struct.unpack(">I", data[:4])[0]
+            request_id, command = HEADER.unpack_from(data, 4)
+            eq_(command, RESULT)
+            results.append((request_id, STATUS.unpack_from(
+                data, 4 + HEADER.size)[0]))
+            data = data[4 + length:]
+        return results
+
+    def test_push(self):
+        uaid = uuid.uuid4().hex
+        self.ap_settings.clients[uaid] = client_mock = Mock()
+        client_mock.paused = False
+        self._request(1, PUSH, encode_uaid(uaid) + '{"channelID": "chid"}')
+        self._request(2, PUSH, encode_uaid(uuid.uuid4().hex) + "{}")
+        client_mock.send_notifications.assert_called_with(
+            {"channelID": "chid"})
+        eq_(self._results(), [(1, 200), (2, 404)])
+
+    def test_check(self):
+        uaid = uuid.uuid4().hex
+        self.ap_settings.clients[uaid] = client_mock = Mock()
+        client_mock.paused = True
+        self._request(3, CHECK, encode_uaid(uaid))
+        ok_(client_mock._defer_notifications.called)
+        eq_(self._results(), [(3, 202)])
+
+    def test_disconnect(self):
+        uaid = uuid.uuid4().hex
+        self.ap_settings.clients[uaid] = client_mock = Mock()
+        client_mock.ps.connected_at = 10
+        self._request(4, DISCONNECT, encode_uaid(uaid) + CONNECTED_AT.pack(9))
+        ok_(not client_mock.sendClose.called)
+        self._request(5, DISCONNECT,
+                      encode_uaid(uaid) + CONNECTED_AT.pack(10))
+        ok_(client_mock.sendClose.called)
+        eq_(self._results(), [(4, 200), (5, 200)])
+
+    def test_invalid_request(self):
+        self._request(1, PUSH, encode_uaid("abc") + "{invalid")
+        ok_(self.transport.disconnecting)
+        eq_(self._results(), [])
+
+    def test_unknown_command(self):
+        self._request(1, 42, encode_uaid("abc"))
+        ok_(self.transport.disconnecting)
+
+    def test_client_on_other_worker(self):
+        uaid = uuid.uuid4().hex
+        index = self.ap_settings.uaid_index = UAIDIndex(2, slots=8)
+        index.claim(1)
+        index.add(uaid)
+        index.worker = 0
+        self.ap_settings.worker_urls = ["http://localhost:8081",
+                                        "http://localhost:8082"]
+        self.ap_settings.agent = Mock()
+        response = Mock(code=202)
+        self.ap_settings.agent.request.return_value = succeed(response)
+
+        def deliver(protocol):
+            protocol.connectionLost(Failure(ResponseDone()))
+        response.deliverBody.side_effect = deliver
+        self._request(6, CHECK, encode_uaid(uaid))
+        method, url, headers, body = \
+            self.ap_settings.agent.request.call_args[0]
+        eq_(method, "PUT")
+        eq_(url, "http://localhost:8082/notif/" + uaid)
+        eq_(headers.getRawHeaders(FORWARDED_HEADER), ["0"])
+        eq_(self._results(), [(6, 202)])
+
+        self.ap_settings.agent.request.return_value = fail(ConnectError())
+        self._request(7, CHECK, encode_uaid(uaid))
+        eq_(self._results(), [(6, 202), (7, 404)])
+        self.flushLoggedErrors(ConnectError)
@@ -0,0 +1,124 @@
+import signal
+import socket
+import uuid
+
+from mock import patch
+from nose.tools import eq_, ok_
+from twisted.trial import unittest
+
+from autopush.workers import UAIDIndex, reuseport_socket, spawn_workers
+
+
+class UAIDIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = UAIDIndex(3, slots=8)
+        self.index.claim(1)
+
+    def test_find(self):
+        uaid = uuid.uuid4().hex
+        ok_(self.index.add(uaid))
+        ok_(self.index.add(uaid))
+        # A worker doesn't find its own clients
+        eq_(self.index.find(uaid), None)
+        self.index.worker = 2
+        eq_(self.index.find(uaid), 1)
+        eq_(self.index.find(str(uuid.UUID(uaid))), 1)
+        eq_(self.index.find(uuid.uuid4().hex), None)
+
+        self.index.worker = 1
+        self.index.remove(uaid)
+        self.index.worker = 2
+        eq_(self.index.find(uaid), None)
+
+    def test_claim_clears(self):
+        uaid = uuid.uuid4().hex
+        self.index.add(uaid)
+        self.index.claim(1)
+        self.index.worker = 0
+        eq_(self.index.find(uaid), None)
+
+    def test_full(self):
+        uaids = [uuid.uuid4().hex for _ in range(6)]
+        for uaid in uaids:
+            self.index.add(uaid)
+        eq_(self.index.add(uuid.uuid4().hex), False)
+        # A table of live UAIDs isn't rebuilt on every add
+        with patch.object(self.index, "_compact") as mock_compact:
+            eq_(self.index.add(uuid.uuid4().hex), False)
+        ok_(not mock_compact.called)
+        self.index.worker = 0
+        for uaid in uaids:
+            eq_(self.index.find(uaid), 1)
+
+    def test_compact_keeps_live(self):
+        uaids = [uuid.uuid4().hex for _ in range(6)]
+        for uaid in uaids:
+            self.index.add(uaid)
+        self.index.remove(uaids.pop())
+        uaids.append(uuid.uuid4().hex)
+        ok_(self.index.add(uaids[-1]))
+        eq_(self.index._deleted, 0)
+        self.index.worker = 0
+        for uaid in uaids:
+            eq_(self.index.find(uaid), 1)
+
+    def test_compact(self):
+        # Deletions are dropped once they fill the table
+        for _ in range(10):
+            uaid = uuid.uuid4().hex
+            ok_(self.index.add(uaid))
+            self.index.remove(uaid)
+        kept = uuid.uuid4().hex
+        self.index.add(kept)
+        for _ in range(10):
+            uaid = uuid.uuid4().hex
+            ok_(self.index.add(uaid))
+            self.index.remove(uaid)
+        self.index.worker = 0
+        eq_(self.index.find(kept), 1)
+
+
+class ReuseportTestCase(unittest.TestCase):
+    def test_shared_port(self):
+        first = reuseport_socket(0, "127.0.0.1")
+        port = first.getsockname()[1]
+        second = reuseport_socket(port, "127.0.0.1")
+        eq_(second.getsockname()[1], port)
+        eq_(first.getsockopt(socket.SOL_SOCKET, 15), 1)
+        first.close()
+        second.close()
+
+
+class SpawnWorkersTestCase(unittest.TestCase):
+    @patch("autopush.workers.os")
+    def test_worker(self, mock_os):
+        mock_os.fork.side_effect = [100, 0]
+        eq_(spawn_workers(3), 1)
+
+    @patch("autopush.workers.signal.signal")
+    @patch("autopush.workers.os")
+    def test_supervisor(self, mock_os, mock_signal):
+        mock_os.fork.side_effect = [100, 101, 102]
+        # A crashed worker is restarted, workers that exit cleanly aren't
+        mock_os.wait.side_effect = [(100, 1), (101, 0), (102, 0)]
+        eq_(spawn_workers(2), None)
+        eq_(mock_os.fork.call_count, 3)
+
+        forward = mock_signal.call_args_list[0][0][1]
+        forward(signal.SIGUSR1, None)
+        eq_(mock_os.kill.call_count, 0)
+
+    @patch("autopush.workers.signal.signal")
+    @patch("autopush.workers.os")
+    def test_supervisor_stopping(self, mock_os, mock_signal):
+        mock_os.fork.side_effect = [100, 101]
+
+        def wait():
+            forward = mock_signal.call_args_list[0][0][1]
+            forward(signal.SIGTERM, None)
+            mock_os.wait.side_effect = [(101, 1)]
+            return 100, 1
+        mock_os.wait.side_effect = wait
+        eq_(spawn_workers(2), None)
+        eq_(mock_os.fork.call_count, 2)
+        mock_os.kill.assert_any_call(101, signal.SIGTERM)
@@ -0,0 +1,191 @@
+"""Coarse timers shared by all the connections of a node
+
+Every connection keeps several timers, for its hello and idle timeouts and
+held notification checks. Scheduling each of them on the reactor keeps a heap
+entry per timer. :class:`TimerWheel` instead files timers into buckets of
+``resolution`` seconds, and fires each due bucket in a batch from a single
+reactor timer.
+
+"""
+import math
+
+from twisted.internet import reactor
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.internet.interfaces import IDelayedCall, IReactorTime
+from twisted.logger import Logger
+from twisted.python import failure
+from zope.interface import implements
+
+
+class WheelCall(object):
+    """A timer of a :class:`TimerWheel`, with the interface of the reactor's
+    delayed calls"""
+    implements(IDelayedCall)
+
+    __slots__ = ['wheel', 'tick', 'func', 'args', 'kwargs', 'called',
+                 'cancelled']
+
+    def __init__(self, wheel, tick, func, args, kwargs):
+        self.wheel = wheel
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+
+    def getTime(self):
+        return self.tick * self.wheel.resolution
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+        self.func = self.args = self.kwargs = None
+
+    def reset(self, secondsFromNow):
+        """Move the timer to fire ``secondsFromNow`` seconds from now"""
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.wheel._move(self, self.wheel._tick_for(secondsFromNow))
+
+    def delay(self, secondsLater):
+        """Move the timer to fire ``secondsLater`` seconds later"""
+        self.reset(self.getTime() - self.wheel.seconds() + secondsLater)
+
+
+class TimerWheel(object):
+    """Timers filed by due time into buckets of ``resolution`` seconds
+
+    Timers fire up to ``resolution`` seconds late. Adding, moving and
+    cancelling a timer only touches its bucket. The wheel keeps a single
+    reactor timer, for the next bucket, while it holds any timers.
+
+    Delays shorter than the resolution are scheduled on the reactor
+    directly. The wheel provides ``IReactorTime``, so it can stand in for
+    the reactor of libraries that schedule their timers through one.
+
+    """
+    implements(IReactorTime)
+    log = Logger()
+
+    def __init__(self, resolution=1.0, clock=None):
+        """Create a new TimerWheel
+
+        :param resolution: Seconds covered by each bucket.
+        :param clock: ``IReactorTime`` provider the wheel runs on, the
+                      reactor by default.
+
+        """
+        self.resolution = resolution
+        self.clock = clock or reactor
+        # Tick -> set of WheelCall
+        self._buckets = {}
+        self._count = 0
+        self._last_tick = 0
+        self._next = None
+
+    def __len__(self):
+        return self._count
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        """Call ``func`` after ``delay`` seconds, rounded up to the wheel's
+        resolution
+
+        :returns: An ``IDelayedCall`` provider.
+
+        """
+        if delay < self.resolution:
+            return self.clock.callLater(delay, func, *args, **kwargs)
+        if not self._count:
+            self._last_tick = self._current_tick()
+        call = WheelCall(self, self._tick_for(delay), func, args, kwargs)
+        self._insert(call)
+        return call
+
+    def getDelayedCalls(self):
+        calls = [call for bucket in self._buckets.itervalues()
+                 for call in bucket]
+        return calls + list(self.clock.getDelayedCalls())
+
+    def _current_tick(self):
+        return int(self.clock.seconds() / self.resolution)
+
+    def _tick_for(self, delay):
+        """The tick a timer due in ``delay`` seconds fires on, never one
+        already fired"""
+        tick = int(math.ceil((self.clock.seconds() + delay) /
+                             self.resolution))
+        return max(tick, self._last_tick + 1)
+
+    def _insert(self, call):
+        bucket = self._buckets.get(call.tick)
+        if bucket is None:
+            bucket = self._buckets[call.tick] = set()
+        bucket.add(call)
+        self._count += 1
+        if self._next is None:
+            self._schedule()
+
+    def _remove(self, call):
+        bucket = self._buckets.get(call.tick)
+        if bucket is None or call not in bucket:
+            return
+        bucket.remove(call)
+        if not bucket:
+            del self._buckets[call.tick]
+        self._count -= 1
+        if not self._count and self._next is not None:
+            self._next.cancel()
+            self._next = None
+
+    def _move(self, call, tick):
+        if tick == call.tick:
+            return
+        self._remove(call)
+        call.tick = tick
+        self._insert(call)
+
+    def _schedule(self):
+        """Schedule the reactor timer for the next tick"""
+        delay = (self._last_tick + 1) * self.resolution - self.clock.seconds()
+        self._next = self.clock.callLater(max(0, delay), self._advance)
+
+    def _advance(self):
+        """Fire the timers of every bucket due"""
+        self._next = None
+        now = self._current_tick()
+        if now - self._last_tick > len(self._buckets):
+            due = sorted(tick for tick in self._buckets if tick <= now)
+        else:
+            due = xrange(self._last_tick + 1, now + 1)
+        self._last_tick = max(self._last_tick, now)
+        for tick in due:
+            bucket = self._buckets.pop(tick, None)
+            if not bucket:
+                continue
+            self._count -= len(bucket)
+            for call in bucket:
+                self._fire(call)
+        if self._count and self._next is None:
+            self._schedule()
+
+    def _fire(self, call):
+        call.called = True
+        func, args, kwargs = call.func, call.args, call.kwargs
+        call.func = call.args = call.kwargs = None
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            self.log.failure("Timer failed", failure.Failure())
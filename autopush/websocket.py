@@ -28,30 +28,41 @@ not be publicly exposed.
     Immediately drop a client of this `uaid` if its connection time matches the
     `connected_at` provided.
 
+Nodes with a ``channel_offset`` also take these requests over the binary
+channel of :mod:`autopush.channel`.
+
 """
+import itertools
 import json
 import random
+import struct
+import sys
 import time
 import uuid
-from collections import defaultdict, namedtuple
+from collections import deque
 from functools import wraps
+from StringIO import StringIO
 
 import cyclone.web
 from autobahn.twisted.websocket import WebSocketServerProtocol
+from autobahn.websocket.types import ConnectionDeny
 from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from repoze.lru import LRUCache
 from twisted.internet import reactor
 from twisted.internet.defer import (
     Deferred,
     DeferredList,
-    CancelledError
+    CancelledError,
+    fail,
 )
 from twisted.web._newclient import ResponseNeverReceived
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
 from twisted.internet.error import (
     ConnectError, ConnectionRefusedError, UserError,
     ConnectionLost, ConnectionDone
 )
 from twisted.internet.interfaces import IProducer
-from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 from twisted.protocols import policies
 from twisted.python import failure
@@ -59,15 +70,46 @@ from zope.interface import implements
 from twisted.web.resource import Resource
 
 from autopush import __version__
+from autopush.channel import (
+    CHECK,
+    CONNECTED_AT,
+    DISCONNECT,
+    PUSH,
+    RESULT,
+    STATUS,
+    ChannelProtocol,
+    decode_uaid,
+    http_fallback,
+)
 from autopush.db import (
     has_connected_this_month,
     hasher,
     generate_last_connect
 )
+from autopush.exceptions import AdmissionRejected
 from autopush.protocol import IgnoreBody
+from autopush.scheduler import BACKGROUND, DELIVERY, INTERACTIVE
 from autopush.utils import validate_uaid, ErrorLogger
 from autopush.noseplugin import track_object
 
+# Seconds a deferred notification check waits for the event meant to wake
+# it before running anyway
+NOTIFICATION_POLL_INTERVAL = 10
+
+# Header marking an internal routing request forwarded by another worker of
+# the node, so it isn't forwarded again
+FORWARDED_HEADER = "X-Autopush-Worker"
+
+# Close code telling a client whose hello wasn't admitted to back off before
+# reconnecting, the private use counterpart of 1013 Try Again Later
+CLOSE_TRY_AGAIN_LATER = 4013
+
+log = Logger()
+
+# User agents and tag tuples shared by connections, so connections from
+# the same user agent don't each hold a copy
+_shared_values = LRUCache(10000)
+
 
 def extract_code(data):
     """Extracts and converts a code key if found in data dict"""
@@ -84,6 +126,24 @@ def ms_time():
     return int(time.time() * 1000)
 
 
+def share(value):
+    """Return an equal value shared with other connections, or ``value``
+    if there is none yet"""
+    shared = _shared_values.get(value)
+    if shared is None:
+        _shared_values.put(value, value)
+        return value
+    return shared
+
+
+def state_footprint(clients, sample=100):
+    """Return the average bytes of connection state held per client,
+    measured over up to ``sample`` of the connected clients"""
+    sizes = [client.ps.footprint()
+             for client in itertools.islice(clients.itervalues(), sample)]
+    return sum(sizes) / len(sizes) if sizes else 0
+
+
 def periodic_reporter(settings):
     """Twisted Task function that runs every few seconds to emit general
     metrics regarding twisted and client counts"""
@@ -108,10 +168,88 @@ def log_exception(func):
     return wrapper
 
 
-class Notification(namedtuple(
-                   "Notification",
-                   "channel_id data headers version ttl timestamp")):
+class Notification(object):
     """Parsed notification from the request"""
+    __slots__ = ['channel_id', 'data', 'headers', 'version', 'ttl',
+                 'timestamp']
+
+    def __init__(self, channel_id, data, headers, version, ttl, timestamp):
+        self.channel_id = channel_id
+        self.data = data
+        self.headers = headers
+        self.version = version
+        self.ttl = ttl
+        self.timestamp = timestamp
+
+
+class PendingAcks(object):
+    """Webpush notifications sent to a client that it hasn't ack'd
+
+    Indexed by channel ID and version so an ack is found and removed
+    without scanning the other notifications of its channel, and counted
+    so checking for outstanding notifications doesn't scan them at all.
+
+    """
+    __slots__ = ['_channels', 'outstanding']
+
+    def __init__(self):
+        # Channel ID -> {version: Notification}, allocated on first add
+        self._channels = None
+        self.outstanding = 0
+
+    def __len__(self):
+        return self.outstanding
+
+    def __iter__(self):
+        if not self._channels:
+            return
+        for versions in self._channels.itervalues():
+            for notif in versions.itervalues():
+                yield notif
+
+    def footprint(self):
+        """Bytes held by the index and its records, not counting the
+        notification payloads"""
+        size = sys.getsizeof(self)
+        if self._channels is not None:
+            size += sys.getsizeof(self._channels)
+            for versions in self._channels.itervalues():
+                size += sys.getsizeof(versions) + sum(
+                    sys.getsizeof(x) for x in versions.itervalues())
+        return size
+
+    def add(self, notif):
+        """Track a sent notification, replacing one of the same version"""
+        if self._channels is None:
+            self._channels = {}
+        versions = self._channels.setdefault(notif.channel_id, {})
+        if notif.version not in versions:
+            self.outstanding += 1
+        versions[notif.version] = notif
+
+    def get(self, channel_id, version):
+        """Return the pending notification of a channel ID and version,
+        or None"""
+        versions = self._channels and self._channels.get(channel_id)
+        return versions.get(version) if versions else None
+
+    def remove(self, channel_id, version):
+        """Stop tracking a notification, returns it or None if it wasn't
+        pending"""
+        versions = self._channels and self._channels.get(channel_id)
+        if not versions or version not in versions:
+            return None
+        notif = versions.pop(version)
+        self.outstanding -= 1
+        if not versions:
+            del self._channels[channel_id]
+        return notif
+
+    def discard_channel(self, channel_id):
+        """Stop tracking all the notifications of a channel"""
+        versions = self._channels and self._channels.pop(channel_id, None)
+        if versions:
+            self.outstanding -= len(versions)
 
 
 class PushState(object):
@@ -128,6 +266,7 @@ class PushState(object):
         'uaid_hash',
         'last_ping',
         'check_storage',
+        'messages_stored_at',
         'use_webpush',
         'router_type',
         'wake_data',
@@ -143,7 +282,15 @@ class PushState(object):
         '_check_notifications',
         '_more_notifications',
         '_notification_fetch',
+        '_wake',
+        '_wake_pending',
+        '_wake_timer',
+        '_flush',
+        '_outbound',
+        '_outbound_bytes',
+        '_prefetch',
         '_register',
+        '_stored_during_hello',
         'updates_sent',
         'direct_updates',
 
@@ -154,7 +301,8 @@ class PushState(object):
     ]
 
     def __init__(self, settings, request):
-        self._callbacks = []
+        # Outstanding deferreds, allocated when the first is tracked
+        self._callbacks = None
         self.settings = settings
         host = ""
 
@@ -164,11 +312,14 @@ class PushState(object):
             host = request.host
         else:
             self._user_agent = None
-        self._base_tags = []
         if self._user_agent:
-            self._base_tags.append("user_agent:%s" % self._user_agent)
+            self._user_agent = share(self._user_agent)
+        tags = []
+        if self._user_agent:
+            tags.append("user_agent:%s" % self._user_agent)
         if host:
-            self._base_tags.append("host:%s" % host)
+            tags.append("host:%s" % host)
+        self._base_tags = share(tuple(tags))
 
         self._should_stop = False
         self._paused = False
@@ -179,6 +330,8 @@ class PushState(object):
         self.uaid_hash = ""
         self.last_ping = 0
         self.check_storage = False
+        # The router record's stored messages flag, None when unknown
+        self.messages_stored_at = None
         self.use_webpush = False
         self.router_type = None
         self.wake_data = None
@@ -191,16 +344,31 @@ class PushState(object):
 
         self._check_notifications = False
         self._more_notifications = False
+        # Whether storage was checked for while the hello was registering
+        self._stored_during_hello = False
 
         # Hanger for common actions we defer
         self._notification_fetch = None
+        # Callable run on resumeProducing while a notification check waits
+        self._wake = None
+        self._wake_pending = False
+        self._wake_timer = None
+        # Callable run on resumeProducing to send queued notifications
+        self._flush = None
+        # Encoded notifications accepted while paused, allocated when the
+        # first is queued
+        self._outbound = None
+        self._outbound_bytes = 0
+        # (uaid, message_month, Deferred) of a fetch started with hello
+        self._prefetch = None
         self._register = None
 
-        # Reflects Notification's sent that haven't been ack'd
-        self.updates_sent = {}
+        # Reflects Notification's sent that haven't been ack'd, allocated
+        # by hello once the protocol is known
+        self.updates_sent = None
 
         # Track Notification's we don't need to delete separately
-        self.direct_updates = {}
+        self.direct_updates = None
 
     @property
     def message(self):
@@ -211,13 +379,40 @@ class PushState(object):
     def user_agent(self):
         return self._user_agent or "None"
 
+    def footprint(self):
+        """Approximate bytes of memory held by this connection's state
+
+        Shared values such as the settings and tags aren't counted.
+
+        """
+        size = sys.getsizeof(self)
+        if self._callbacks is not None:
+            size += sys.getsizeof(self._callbacks)
+        for pending in (self.updates_sent, self.direct_updates):
+            if isinstance(pending, PendingAcks):
+                size += pending.footprint()
+            elif pending is not None:
+                size += sys.getsizeof(pending)
+        if self._outbound is not None:
+            size += sys.getsizeof(self._outbound) + self._outbound_bytes
+        return size
+
     def pauseProducing(self):
         """IProducer implementation tracking if we should pause output"""
         self._paused = True
 
     def resumeProducing(self):
-        """IProducer implementation tracking when we should resume output"""
+        """IProducer implementation tracking when we should resume output
+
+        Sends the notifications queued while paused, then wakes a
+        notification check that was waiting for output to resume.
+
+        """
         self._paused = False
+        if self._outbound and self._flush is not None:
+            self._flush()
+        if not self._paused and self._wake_pending and self._wake is not None:
+            self._wake()
 
     def stopProducing(self):
         """IProducer implementation tracking when we should stop"""
@@ -234,17 +429,52 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
     # Defer helpers
     def deferToThread(self, func, *args, **kwargs):
-        """deferToThread helper that tracks defers outstanding"""
-        d = deferToThread(func, *args, **kwargs)
-        self.ps._callbacks.append(d)
+        """Interactive :meth:`db_call`"""
+        return self.db_call(INTERACTIVE, func, *args, **kwargs)
+
+    def db_call(self, priority, func, *args, **kwargs):
+        """Schedule a blocking call with the
+        :class:`~autopush.scheduler.DBScheduler`, tracking the defer
+        outstanding"""
+        d = self.ap_settings.db_scheduler.call(priority, func, *args,
+                                               **kwargs)
+        return self._track_defer(d)
+
+    def _track_defer(self, d):
+        """Track a deferred as outstanding until it fires, so it's cancelled
+        if the client drops"""
+        self._add_callback(d)
 
         def f(result):
-            if d in self.ps._callbacks:
-                self.ps._callbacks.remove(d)
+            self._remove_callback(d)
             return result
         d.addBoth(f)
         return d
 
+    def _add_callback(self, d):
+        if self.ps._callbacks is None:
+            self.ps._callbacks = []
+        self.ps._callbacks.append(d)
+
+    def _remove_callback(self, d):
+        callbacks = self.ps._callbacks
+        if callbacks and d in callbacks:
+            callbacks.remove(d)
+            if not callbacks:
+                self.ps._callbacks = None
+
+    def callLater(self, when, func, *args, **kwargs):
+        """Schedule a connection timeout on the node's shared timers
+
+        Used by :class:`~twisted.protocols.policies.TimeoutMixin` for the
+        hello and idle timeouts, and for held notification checks.
+
+        """
+        timers = self.ap_settings.timers
+        if timers is None:
+            timers = reactor
+        return timers.callLater(when, func, *args, **kwargs)
+
     def deferToLater(self, when, func, *args, **kwargs):
         """deferToLater helper that tracks defers outstanding"""
         def cancel(d):
@@ -252,11 +482,10 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         d = Deferred(canceller=cancel)
         d._cancelled = False
-        self.ps._callbacks.append(d)
+        self._add_callback(d)
 
         def f():
-            if d in self.ps._callbacks:
-                self.ps._callbacks.remove(d)
+            self._remove_callback(d)
 
             # Don't run if the deferred was cancelled already
             if d._cancelled:
@@ -273,21 +502,30 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         fail.trap(CancelledError)
 
     def force_retry(self, func, *args, **kwargs):
-        """Forcefully retry a function in a thread until it doesn't error
+        """Forcefully retry a function until it doesn't error
 
-        Note that this does not use ``self.deferToThread``, so this will
-        continue to retry even if the client drops.
+        Note that this does not use ``self.db_call``, so this will
+        continue to retry even if the client drops. The calls are scheduled
+        as background work, and retried through the
+        :class:`~autopush.retry.RetryPolicy` so a throttled table isn't
+        hammered.
 
         """
-        def wrapper(result, *w_args, **w_kwargs):
-            if isinstance(result, failure.Failure):
-                # This is an exception, log it
-                self.log_failure(result)
+        scheduler = self.ap_settings.db_scheduler
+        attempts = [0]
+
+        def run(d):
+            scheduler.call(BACKGROUND, func, *args, **kwargs).chainDeferred(d)
 
-            d = deferToThread(func, *args, **kwargs)
+        def wrapper(result):
+            # This is an exception, log it
+            self.log_failure(result)
+            d = Deferred()
             d.addErrback(wrapper)
+            self.ap_settings.db_retry.retry_later(func, attempts[0], run, d)
+            attempts[0] += 1
             return d
-        d = deferToThread(func, *args, **kwargs)
+        d = scheduler.call(BACKGROUND, func, *args, **kwargs)
         d.addErrback(wrapper)
         return d
 
@@ -348,11 +586,17 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
     def onConnect(self, request):
         """autobahn onConnect handler for when a connection has started"""
         track_object(self, msg="onConnect Start")
+        if self.ap_settings.drainer.draining:
+            # Returned, log_exception would swallow a raised denial
+            return fail(ConnectionDeny(ConnectionDeny.SERVICE_UNAVAILABLE,
+                                       u"Server draining"))
         self.ps = PushState(settings=self.ap_settings, request=request)
 
         # Setup ourself to handle producing the data
         self.transport.bufferSize = 2 * 1024
         self.transport.registerProducer(self.ps, True)
+        self.ps._wake = self._wake_notifications
+        self.ps._flush = self._flush_outbound
 
         if self.ap_settings.hello_timeout > 0:
             self.setTimeout(self.ap_settings.hello_timeout)
@@ -444,6 +688,9 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             self._shutdown_ran = True
             self.ps._should_stop = True
             self.ps._check_notifications = False
+            self.ps._wake = None
+            self.ps._flush = None
+            self._cancel_wake_timer()
         except AttributeError:  # pragma: nocover
             # Sometimes in odd production cases, onClose will be called without
             # onConnect being called to set this up.
@@ -463,49 +710,74 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
                                tags=self.base_tags)
 
         # Cleanup our client entry
+        if self.ps.uaid:
+            self._forget_pending_hello()
         if self.ps.uaid and self.ap_settings.clients.get(self.ps.uaid) == self:
             del self.ap_settings.clients[self.ps.uaid]
+            if self.ap_settings.uaid_index is not None:
+                self.ap_settings.uaid_index.remove(self.ps.uaid)
 
         # Cancel any outstanding deferreds that weren't already called
-        for d in self.ps._callbacks:
+        for d in self.ps._callbacks or ():
             if not d.called:
                 d.cancel()
 
         # Attempt to deliver any notifications not originating from storage
         if self.ps.direct_updates:
-            defers = []
             if self.ps.use_webpush:
-                for notifs in self.ps.direct_updates.values():
-                    notifs = filter(lambda x: x.ttl != 0, notifs)
-                    defers.extend(map(self._save_webpush_notif, notifs))
+                notifs = [x for x in self.ps.direct_updates if x.ttl != 0]
+                defers = [self._save_webpush_notifs(notifs)] if notifs else []
             else:
-                for chid, version in self.ps.direct_updates.items():
-                    defers.append(self._save_simple_notif(chid, version))
-
-            # Tag on the notifier once everything has been stored
+                notifs = self.ps.direct_updates.items()
+                defers = [self._save_simple_notif(chid, version)
+                          for chid, version in notifs]
+            if notifs:
+                self.ps.metrics.increment("client.disconnect.rescue",
+                                          tags=self.base_tags)
+                self.ps.metrics.increment("client.disconnect.rescued",
+                                          count=len(notifs),
+                                          tags=self.base_tags)
+
+            # Flag the stored messages, then tag on the notifier once
+            # everything has been stored
             dl = DeferredList(defers)
+            if defers:
+                dl.addBoth(self._mark_messages_stored)
             dl.addBoth(self._lookup_node)
 
         # Delete and remove remaining dicts and lists
         del self.ps.direct_updates
         del self.ps.updates_sent
 
-    def _save_webpush_notif(self, notif):
-        """Save a direct_update webpush style notification"""
-        return deferToThread(
-            self.ps.message.store_message,
-            uaid=self.ps.uaid,
-            channel_id=notif.channel_id,
-            data=notif.data,
-            headers=notif.headers,
-            message_id=notif.version,
-            ttl=notif.ttl,
-            timestamp=notif.timestamp,
+    def _mark_messages_stored(self, result):
+        """Flag the router record as having stored messages
+
+        Retried until written, a hello skips fetching storage for a record
+        without the flag.
+
+        """
+        return self.force_retry(self.ap_settings.router.mark_messages_stored,
+                                self.ps.uaid)
+
+    def _save_webpush_notifs(self, notifs):
+        """Save direct_update webpush style notifications with batched
+        writes"""
+        return self.ap_settings.db_scheduler.call(
+            DELIVERY,
+            self.ps.message.store_messages,
+            self.ps.uaid,
+            [dict(channel_id=notif.channel_id,
+                  data=notif.data,
+                  headers=notif.headers,
+                  message_id=notif.version,
+                  ttl=notif.ttl,
+                  timestamp=notif.timestamp) for notif in notifs],
         ).addErrback(self.log_failure)
 
     def _save_simple_notif(self, channel_id, version):
         """Save a simplepush notification"""
-        return deferToThread(
+        return self.ap_settings.db_scheduler.call(
+            DELIVERY,
             self.ap_settings.storage.save_notification,
             uaid=self.ps.uaid,
             chid=channel_id,
@@ -516,7 +788,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         """Looks up the node to send a notify for it to check storage if
         connected"""
         # Locate the node that has this client connected
-        d = deferToThread(
+        d = self.ap_settings.db_scheduler.call(
+            DELIVERY,
             self.ap_settings.router.get_uaid,
             self.ps.uaid
         )
@@ -541,12 +814,20 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return
 
         # Send the notify to the node
+        channels = self.ap_settings.node_channels
+        if channels is not None:
+            d = http_fallback(channels.check(node_id, self.ps.uaid),
+                              self._check_node, node_id)
+        else:
+            d = self._check_node(node_id)
+        d.addErrback(self.log_failure, extra="Failed to notify node")
+
+    def _check_node(self, node_id):
         url = node_id + "/notif/" + self.ps.uaid
-        d = self.ap_settings.agent.request(
+        return self.ap_settings.agent.request(
             "PUT",
             url.encode("utf8"),
         ).addCallback(IgnoreBody.ignore)
-        d.addErrback(self.log_failure, extra="Failed to notify node")
 
     def returnError(self, messageType, reason, statusCode, close=True):
         """Return an error to a client, and optionally shut down the connection
@@ -568,6 +849,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         """
         failure.trap(ProvisionedThroughputExceededException)
+        self._discard_prefetch()
         self.transport.pauseProducing()
         d = self.deferToLater(random.randrange(4, 9), self.err_finish_overload,
                               message_type)
@@ -600,13 +882,16 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         uaid = data.get("uaid")
         self.ps.use_webpush = data.get("use_webpush", False)
-        self.ps._base_tags.append("use_webpush:%s" %
-                                  self.ps.use_webpush)
+        self.ps._base_tags = share(self.ps._base_tags + (
+            "use_webpush:%s" % self.ps.use_webpush,))
         self.ps.router_type = "webpush" if self.ps.use_webpush\
                               else "simplepush"
         if self.ps.use_webpush:
-            self.ps.updates_sent = defaultdict(lambda: [])
-            self.ps.direct_updates = defaultdict(lambda: [])
+            self.ps.updates_sent = PendingAcks()
+            self.ps.direct_updates = PendingAcks()
+        else:
+            self.ps.updates_sent = {}
+            self.ps.direct_updates = {}
 
         existing_user, uaid = validate_uaid(uaid)
         self.ps.uaid = uaid
@@ -626,16 +911,28 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         self.transport.pauseProducing()
 
-        d = self._register_user(existing_user)
+        if existing_user and self.ap_settings.hello_prefetch:
+            self._prefetch_notifications()
+        admission = self.ap_settings.hello_admission
+        if admission is None:
+            d = self._register_user(existing_user)
+        else:
+            d = self._track_defer(
+                admission.call(self._register_user, existing_user))
         d.addCallback(self._copy_new_data)
         d.addCallback(self._check_collision)
         d.addErrback(self.trap_cancel)
+        d.addErrback(self.err_hello_rejected)
         d.addErrback(self.err_overload, "hello")
         d.addErrback(self.err_hello)
         self.ps._register = d
         return d
 
     def _register_user(self, existing_user=True):
+        if self._uses_stored_flag():
+            # Notification checks for the client find it here until it's
+            # registered
+            self.ap_settings.pending_hellos[self.ps.uaid] = self
         user_item = dict(
             uaid=self.ps.uaid,
             node_id=self.ap_settings.router_url,
@@ -647,6 +944,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         # users
         if not existing_user:
             user_item["last_connect"] = generate_last_connect()
+            # New users have nothing stored yet
+            user_item["messages_stored_at"] = 0
             if self.ps.use_webpush:
                 user_item["current_month"] = self.ps.message_month
 
@@ -657,8 +956,20 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         return self.deferToThread(self.ap_settings.router.register_user,
                                   user_item)
 
+    def err_hello_rejected(self, failure):
+        """errBack for hellos the admission control didn't admit, closes the
+        connection telling the client to back off"""
+        failure.trap(AdmissionRejected)
+        self._discard_prefetch()
+        self.transport.resumeProducing()
+        self.ps.metrics.increment("client.hello.rejected",
+                                  tags=self.base_tags)
+        self.returnError("hello", "error - overloaded", 503, close=False)
+        self.sendClose(code=CLOSE_TRY_AGAIN_LATER, reason="Try Again Later")
+
     def err_hello(self, failure):
         """errBack for hello failures"""
+        self._discard_prefetch()
         self.transport.resumeProducing()
         self.log_failure(failure)
         self.returnError("hello", "error", 503)
@@ -671,6 +982,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             previous["last_connect"] = data["last_connect"]
         if "current_month" in data:
             previous["current_month"] = data["current_month"]
+        if "messages_stored_at" in data:
+            previous["messages_stored_at"] = data["messages_stored_at"]
         return result
 
     def _check_collision(self, result):
@@ -691,6 +1004,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return self._check_other_nodes(result)
 
         # If registration fails, try resetting the UAID.
+        self._forget_pending_hello()
         self.ps.uaid = uuid.uuid4().hex
         d = self._register_user(existing_user=False)
         d.addCallback(self._copy_new_data)
@@ -724,11 +1038,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             node_id = previous["node_id"]
             last_connect = previous.get("connected_at")
             if last_connect and node_id != self.ap_settings.router_url:
-                url = "%s/notif/%s/%s" % (node_id, self.ps.uaid, last_connect)
-                d = self.ap_settings.agent.request(
-                    "DELETE",
-                    url.encode("utf8"),
-                )
+                channels = self.ap_settings.node_channels
+                if channels is not None:
+                    d = http_fallback(
+                        channels.disconnect(node_id, self.ps.uaid,
+                                            last_connect),
+                        self._disconnect_node, node_id, last_connect)
+                else:
+                    d = self._disconnect_node(node_id, last_connect)
                 d.addErrback(lambda f: f.trap(ConnectError,
                                               ConnectionRefusedError,
                                               UserError,
@@ -743,13 +1060,24 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         timeout = self.ap_settings.wake_timeout if self.ps.wake_data else None
         self.setTimeout(timeout)
 
+        self.ps.messages_stored_at = previous.get("messages_stored_at")
         self.finish_hello(previous)
 
+    def _disconnect_node(self, node_id, last_connect):
+        url = "%s/notif/%s/%s" % (node_id, self.ps.uaid, last_connect)
+        return self.ap_settings.agent.request(
+            "DELETE",
+            url.encode("utf8"),
+        )
+
     def _update_last_connect(self, previous):
         """Update last_connect given old router values if needed"""
         if has_connected_this_month(previous):
             return
 
+        if self.ap_settings.router_updates is not None:
+            self.ap_settings.router_updates.update_last_connect(self.ps.uaid)
+            return
         self.force_retry(self.ap_settings.router.update_last_connect,
                          self.ps.uaid)
 
@@ -766,10 +1094,17 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             msg["ping"] = self.autoPingInterval
 
         msg['env'] = self.ap_settings.env
-        self.ap_settings.clients[self.ps.uaid] = self
+        self._register_client()
         self.sendJSON(msg)
         self.ps.metrics.increment("updates.client.hello", tags=self.base_tags)
-        self.process_notifications()
+        self.process_hello_notifications()
+
+    def _register_client(self):
+        """Make this connection the node's client for its UAID"""
+        self._forget_pending_hello()
+        self.ap_settings.clients[self.ps.uaid] = self
+        if self.ap_settings.uaid_index is not None:
+            self.ap_settings.uaid_index.add(self.ps.uaid)
 
     def _check_message_table_rotation(self, previous):
         """Check for webpush users if we need to rotate the message table"""
@@ -781,6 +1116,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         if cur_month != self.ps.message_month:
             if cur_month not in self.ps.settings.message_tables:
                 # This UAID has expired. Force client to reregister.
+                self._forget_pending_hello()
                 self.ps.uaid = uuid.uuid4().hex
                 self._finish_webpush_hello()
                 return
@@ -797,27 +1133,131 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             msg["ping"] = self.autoPingInterval
         msg["use_webpush"] = True
         msg['env'] = self.ap_settings.env
-        self.ap_settings.clients[self.ps.uaid] = self
+        self._register_client()
         self.sendJSON(msg)
         self.ps.metrics.increment("updates.client.hello", tags=self.base_tags)
+        self.process_hello_notifications()
+
+    def _prefetch_notifications(self):
+        """Start fetching notifications for the claimed UAID while it's
+        still being registered"""
+        d = self._fetch_notifications()
+        self.ps._prefetch = prefetch = (self.ps.uaid, self.ps.message_month,
+                                        d)
+
+        def failed(failure):
+            if self.ps._prefetch is not prefetch:
+                # Claimed, the notification check handles it
+                return failure
+            # Dropped unclaimed, the hello fetches storage itself instead
+            self.ps._prefetch = None
+            if not failure.check(CancelledError,
+                                 ProvisionedThroughputExceededException):
+                self.log_failure(failure)
+        d.addErrback(failed)
+
+    def _claim_prefetch(self):
+        """Return the prefetch deferred if it was made for the registered
+        UAID and message month, and the router record shows nothing was
+        stored, otherwise discard it
+
+        A message stored after the prefetch read, but routed before the
+        registration recorded this node, is only flagged on the record.
+        When the record is flagged, there's no telling whether that
+        happened before or after the prefetch read, so storage is fetched
+        again.
+
+        """
+        if self.ps._prefetch is None:
+            return None
+        uaid, month, d = self.ps._prefetch
+        self.ps._prefetch = None
+        if (uaid == self.ps.uaid and month == self.ps.message_month and
+                self.ps.messages_stored_at == 0 and
+                not self.ps._stored_during_hello):
+            return d
+        self.ps.metrics.increment("updates.client.prefetch_discarded",
+                                  tags=self.base_tags)
+        d.addBoth(lambda result: None)
+        d.cancel()
+        return None
+
+    def _discard_prefetch(self):
+        """Cancel the prefetch of a failed hello, if any"""
+        if self.ps._prefetch is not None:
+            self.ps._prefetch[-1].cancel()
+
+    def _uses_stored_flag(self):
+        """Whether hellos rely on the router record's stored messages flag,
+        which is then also cleared once storage is drained"""
+        return (self.ap_settings.hello_skip_storage or
+                self.ap_settings.hello_prefetch)
+
+    def _forget_pending_hello(self):
+        """Stop tracking the hello of this connection's UAID as pending"""
+        pending = self.ap_settings.pending_hellos
+        if pending.get(self.ps.uaid) is self:
+            del pending[self.ps.uaid]
+
+    def process_hello_notifications(self):
+        """Check storage after a hello, unless the router record shows
+        nothing was stored for this client"""
+        prefetch = self._claim_prefetch()
+        if prefetch is not None:
+            return self.process_notifications(prefetch)
+        if (self.ap_settings.hello_skip_storage and
+                self.ps.messages_stored_at == 0 and
+                not self.ps._stored_during_hello):
+            self.ps.metrics.increment("updates.client.storage_skipped",
+                                      tags=self.base_tags)
+            self.ps._check_notifications = False
+            self.ps._more_notifications = True
+            return self.finish_notifications([])
         self.process_notifications()
 
-    def process_notifications(self):
-        """Run a notification check against storage"""
-        # Bail immediately if we are closed.
-        if self.ps._should_stop:
+    def _clear_messages_stored(self):
+        """Clear the router record's stored messages flag once storage
+        has been drained"""
+        if not self._uses_stored_flag() or self.ps.messages_stored_at == 0:
             return
+        d = self.db_call(BACKGROUND,
+                         self.ap_settings.router.clear_messages_stored,
+                         self.ps.uaid, self.ps.messages_stored_at)
+
+        def cleared(result):
+            if result:
+                self.ps.messages_stored_at = 0
+        d.addCallback(cleared)
+        d.addErrback(self.trap_cancel)
+        d.addErrback(self.log_failure)
 
-        # Are we paused? Try again later.
-        if self.paused:
-            d = self.deferToLater(1, self.process_notifications)
-            d.addErrback(self.trap_cancel)
+    def _fetch_notifications(self):
+        """Query storage for the client's notifications"""
+        if self.ps.use_webpush:
+            return self.db_call(DELIVERY, self.ps.message.fetch_messages,
+                                self.ps.uaid)
+        return self.db_call(DELIVERY,
+                            self.ap_settings.storage.fetch_notifications,
+                            self.ps.uaid)
+
+    def process_notifications(self, fetch=None):
+        """Run a notification check against storage
+
+        :param fetch: Optional deferred of a storage query already started,
+                      used instead of starting a new one.
+
+        """
+        # Bail immediately if we are closed.
+        if self.ps._should_stop:
             return
 
-        # Webpush with any outstanding storage-based must all be cleared
-        if self.ps.use_webpush and any(self.ps.updates_sent.values()):
-            d = self.deferToLater(1, self.process_notifications)
-            d.addErrback(self.trap_cancel)
+        # Are we paused, or does webpush have outstanding storage-based
+        # notifications that must all be cleared? Wait until they are.
+        if self.paused or (self.ps.use_webpush and self.ps.updates_sent):
+            if fetch is not None:
+                fetch.addBoth(lambda result: None)
+                fetch.cancel()
+            self._defer_notifications()
             return
 
         # Are we already running?
@@ -828,18 +1268,47 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         self.ps._check_notifications = False
         self.ps._more_notifications = True
 
-        if self.ps.use_webpush:
-            d = self.deferToThread(self.ps.message.fetch_messages,
-                                   self.ps.uaid)
-        else:
-            d = self.deferToThread(
-                self.ap_settings.storage.fetch_notifications, self.ps.uaid)
+        d = fetch if fetch is not None else self._fetch_notifications()
         d.addCallback(self.finish_notifications)
         d.addErrback(self.trap_cancel)
         d.addErrback(self.err_overload, "notif")
         d.addErrback(self.error_notifications)
         self.ps._notification_fetch = d
 
+    def _defer_notifications(self):
+        """Hold a notification check until output resumes or the
+        outstanding acks are deleted
+
+        Either event calls :meth:`_wake_notifications`, the check is also
+        retried after :data:`NOTIFICATION_POLL_INTERVAL` seconds in case
+        neither comes.
+
+        """
+        if self.ps._wake_pending:
+            return
+        self.ps._wake_pending = True
+        self.ps._wake_timer = self.callLater(NOTIFICATION_POLL_INTERVAL,
+                                             self._poll_notifications)
+
+    @log_exception
+    def _poll_notifications(self):
+        """Run a held notification check that no event woke"""
+        self.ps._wake_timer = None
+        self.ps.metrics.increment("updates.client.poll_wake",
+                                  tags=self.base_tags)
+        self._wake_notifications()
+
+    def _cancel_wake_timer(self):
+        timer, self.ps._wake_timer = self.ps._wake_timer, None
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def _wake_notifications(self):
+        """Run a notification check now, replacing any held one"""
+        self.ps._wake_pending = False
+        self._cancel_wake_timer()
+        self.process_notifications()
+
     def error_notifications(self, fail):
         """errBack for notification check failing"""
         # If we error'd out on this important check, we drop the connection
@@ -850,10 +1319,9 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         """callback for processing notifications from storage"""
         self.ps._notification_fetch = None
 
-        # Are we paused, try again later
+        # Are we paused, check again once output resumes
         if self.paused:
-            d = self.deferToLater(1, self.process_notifications)
-            d.addErrback(self.trap_cancel)
+            self._defer_notifications()
             return
 
         # Process notifications differently based on webpush style or not
@@ -878,22 +1346,21 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         if updates:
             msg = {"messageType": "notification", "updates": updates}
             self.sendJSON(msg)
+        elif not notifs:
+            self._clear_messages_stored()
 
         # Were we told to check notifications again?
         if self.ps._check_notifications:
-            self.ps._check_notifications = False
-            d = self.deferToLater(1, self.process_notifications)
-            d.addErrback(self.trap_cancel)
+            self.process_notifications()
 
     def finish_webpush_notifications(self, notifs):
         """webpush notification processor"""
         if not notifs:
             # No more notifications, we can stop.
             self.ps._more_notifications = False
+            self._clear_messages_stored()
             if self.ps._check_notifications:
-                self.ps._check_notifications = False
-                d = self.deferToLater(1, self.process_notifications)
-                d.addErrback(self.trap_cancel)
+                self.process_notifications()
                 return
 
             # Not told to check for notifications, do we need to now rotate
@@ -912,9 +1379,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
             # If the TTL is too old, don't deliver and fire a delete off
             if not notif["ttl"] or now >= (notif["ttl"]+notif["timestamp"]):
-                self.force_retry(
-                    self.ps.message.delete_message, self.ps.uaid,
-                    chid, version, updateid=notif["updateid"])
+                self._delete_message(chid, version, notif["updateid"])
                 continue
 
             data = notif.get("data")
@@ -926,7 +1391,7 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             if data:
                 msg["data"] = data
                 msg["headers"] = notif["headers"]
-            self.ps.updates_sent[chid].append(
+            self.ps.updates_sent.add(
                 Notification(channel_id=chid, version=version,
                              data=notif["data"], headers=notif.get("headers"),
                              ttl=notif["ttl"], timestamp=notif["timestamp"])
@@ -937,7 +1402,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         """Function to fire off a message table copy of channels + update the
         router current_month entry"""
         self.transport.pauseProducing()
-        d = self.deferToThread(self.ps.message.all_channels, self.ps.uaid)
+        d = self.db_call(DELIVERY, self.ps.message.all_channels,
+                         self.ps.uaid)
         d.addCallback(self._register_rotated_channels)
         d.addErrback(self.trap_cancel)
         d.addErrback(self.err_overload, "notif")
@@ -956,8 +1422,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             return self._update_router_for_message_month(None)
 
         # Register the channels, then update the router
-        d = self.deferToThread(self.ps.message.save_channels, self.ps.uaid,
-                               channels)
+        d = self.db_call(DELIVERY, self.ps.message.save_channels,
+                         self.ps.uaid, channels)
         d.addCallback(self._update_router_for_message_month)
         return d
 
@@ -965,8 +1431,14 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         """Update the router for the message month"""
         # This is returned so that the error handling in _rotate_message_table
         # still applies since the deferred chain is fully followed.
-        d = self.deferToThread(self.ap_settings.router.update_message_month,
-                               self.ps.uaid, self.ps.message_month)
+        router_updates = self.ap_settings.router_updates
+        if router_updates is not None:
+            d = self._track_defer(router_updates.update_message_month(
+                self.ps.uaid, self.ps.message_month))
+        else:
+            d = self.db_call(DELIVERY,
+                             self.ap_settings.router.update_message_month,
+                             self.ps.uaid, self.ps.message_month)
         d.addCallback(lambda x: self.transport.resumeProducing())
         return d
 
@@ -1066,8 +1538,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         # Clear out any existing tracked messages for this channel
         if self.ps.use_webpush:
-            self.ps.direct_updates[chid] = []
-            self.ps.updates_sent[chid] = []
+            self.ps.direct_updates.discard_channel(chid)
+            self.ps.updates_sent.discard_channel(chid)
         else:
             self.ps.direct_updates.pop(chid, None)
             self.ps.updates_sent.pop(chid, None)
@@ -1114,41 +1586,47 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         # Split off the updateid if its not a direct update
         version, updateid = version.split(":")
 
-        def ver_filter(update):
-            return update.version == version
-
-        found = filter(ver_filter, self.ps.direct_updates[chid])
-        if found:
-            msg = found[0]
+        msg = self.ps.direct_updates.remove(chid, version)
+        if msg:
             size = len(msg.data) if msg.data else 0
             self.log.info("Ack", router_key="webpush", channelID=chid,
                           message_id=version, message_source="direct",
                           message_size=size, uaid_hash=self.ps.uaid_hash,
                           user_agent=self.ps.user_agent, code=code)
-            self.ps.direct_updates[chid].remove(msg)
             return
 
-        found = filter(ver_filter, self.ps.updates_sent[chid])
-        if found:
-            msg = found[0]
+        msg = self.ps.updates_sent.get(chid, version)
+        if msg:
             size = len(msg.data) if msg.data else 0
             self.log.info("Ack", router_key="webpush", channelID=chid,
                           message_id=version, message_source="stored",
                           message_size=size, uaid_hash=self.ps.uaid_hash,
                           user_agent=self.ps.user_agent, code=code)
-            d = self.force_retry(self.ps.message.delete_message,
-                                 uaid=self.ps.uaid,
-                                 channel_id=chid,
-                                 message_id=version,
-                                 updateid=updateid)
+            d = self._delete_message(chid, version, updateid)
             # We don't remove the update until we know the delete ran
             # This is because we don't use range queries on dynamodb and we
             # need to make sure this notification is deleted from the db before
             # we query it again (to avoid dupes).
-            d.addBoth(self._handle_webpush_update_remove, chid, msg)
+            d.addBoth(self._handle_webpush_update_remove, chid, version)
             return d
 
-    def _handle_webpush_update_remove(self, result, chid, notif):
+    def _delete_message(self, chid, version, updateid):
+        """Delete a stored webpush message, retrying until it succeeds
+
+        Uses the node-wide ack batcher when configured.
+
+        """
+        batcher = self.ap_settings.ack_batcher
+        if batcher:
+            return batcher.delete(self.ps.message, self.ps.uaid, chid,
+                                  version)
+        return self.force_retry(self.ps.message.delete_message,
+                                uaid=self.ps.uaid,
+                                channel_id=chid,
+                                message_id=version,
+                                updateid=updateid)
+
+    def _handle_webpush_update_remove(self, result, chid, version):
         """Handle clearing out the updates_sent
 
         It's possible the client may leave before this runs, so this is
@@ -1156,8 +1634,8 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         """
         try:
-            self.ps.updates_sent[chid].remove(notif)
-        except (AttributeError, ValueError):
+            self.ps.updates_sent.remove(chid, version)
+        except AttributeError:
             pass
 
     def _handle_simple_ack(self, chid, version, code):
@@ -1224,12 +1702,13 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
 
         # When using webpush, we don't check again if we have outstanding
         # notifications
-        if self.ps.use_webpush and any(self.ps.updates_sent.values()):
+        if self.ps.use_webpush and self.ps.updates_sent:
             return
 
         # Should we check again?
-        if self.ps._check_notifications or self.ps._more_notifications:
-            self.process_notifications()
+        if self.ps._wake_pending or self.ps._check_notifications or \
+           self.ps._more_notifications:
+            self._wake_notifications()
 
     def bad_message(self, typ):
         """Error helper for sending a 401 status back"""
@@ -1250,11 +1729,58 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
         notifications from an endpoint.
 
         """
-        chid, version = (update["channelID"], update["version"])
-        if not self.ps.use_webpush and \
-           self._newer_notification_sent(chid, version):
+        msg = self._direct_message(update)
+        if msg is None:
             return
+        self._record_direct(update)
+        self.sendJSON(msg)
+
+    def queue_notifications(self, update):
+        """Accept a notification from an endpoint while output is paused
+
+        The notification is sent once output resumes, or stored with the
+        other direct updates if the client disconnects first.
 
+        :returns: False if the outbound queue is full.
+
+        """
+        msg = self._direct_message(update)
+        if msg is None:
+            return True
+        payload = json.dumps(msg).encode('utf8')
+        ps = self.ps
+        if ps._outbound is None:
+            ps._outbound = deque()
+        if (len(ps._outbound) >= self.ap_settings.outbound_queue_size or
+                ps._outbound_bytes + len(payload) >
+                self.ap_settings.outbound_queue_bytes):
+            ps.metrics.increment("client.outbound.overflow",
+                                 tags=self.base_tags)
+            if not ps._outbound:
+                ps._outbound = None
+            return False
+        self._record_direct(update)
+        ps._outbound.append(payload)
+        ps._outbound_bytes += len(payload)
+        ps.metrics.gauge("client.outbound.depth", len(ps._outbound),
+                         tags=self.base_tags)
+        return True
+
+    def _flush_outbound(self):
+        """Send the notifications queued while output was paused, until it's
+        paused again"""
+        ps = self.ps
+        while ps._outbound and not ps._paused:
+            payload = ps._outbound.popleft()
+            ps._outbound_bytes -= len(payload)
+            self.sendMessage(payload, False)
+        if not ps._outbound:
+            ps._outbound = None
+
+    def _direct_message(self, update):
+        """Returns the message delivering a notification from an endpoint,
+        or None if a newer one was already sent"""
+        chid, version = (update["channelID"], update["version"])
         if self.ps.use_webpush:
             response = dict(
                 messageType="notification",
@@ -1265,19 +1791,162 @@ class PushServerProtocol(WebSocketServerProtocol, policies.TimeoutMixin):
             if data:
                 response["data"] = data
                 response["headers"] = update["headers"]
-            self.ps.direct_updates[chid].append(
+            return response
+        if self._newer_notification_sent(chid, version):
+            return None
+        return {"messageType": "notification", "updates": [update]}
+
+    def _record_direct(self, update):
+        """Track a notification from an endpoint until it's acked"""
+        chid, version = (update["channelID"], update["version"])
+        if self.ps.use_webpush:
+            self.ps.direct_updates.add(
                 Notification(channel_id=chid, version=version,
-                             data=data, headers=update.get("headers"),
+                             data=update.get("data"),
+                             headers=update.get("headers"),
                              ttl=update["ttl"], timestamp=update["timestamp"])
             )
-            self.sendJSON(response)
         else:
             self.ps.direct_updates[chid] = version
-            msg = {"messageType": "notification", "updates": [update]}
-            self.sendJSON(msg)
 
 
-class RouterHandler(cyclone.web.RequestHandler, ErrorLogger):
+def forward_request(settings, uaid, method, path, body, forwarded,
+                    fallback):
+    """Forward an internal routing request for a client held by another
+    worker of a multi-process node, if any
+
+    :param body: Body of the request, or None.
+    :param forwarded: Called with the other worker's response.
+    :param fallback: Called with no arguments to handle the request on this
+                     worker instead if the other worker can't be reached.
+    :returns: A deferred firing with the result of ``forwarded`` or
+              ``fallback``, or None if no other worker holds the client.
+
+    """
+    worker = _worker_holding(settings, uaid)
+    if worker is None:
+        return None
+    d = _send_to_worker(settings, worker, method, path, body)
+    d.addCallback(forwarded)
+    d.addErrback(_forward_failed, settings, fallback)
+    return d
+
+
+def _worker_holding(settings, uaid):
+    """Return the other worker of this node holding a client, or None"""
+    if settings.uaid_index is None or uaid in settings.clients:
+        return None
+    return settings.uaid_index.find(uaid)
+
+
+def _send_to_worker(settings, worker, method, path, body):
+    settings.metrics.increment("updates.worker.forwarded")
+    return settings.agent.request(
+        method,
+        (settings.worker_urls[worker] + path).encode("utf8"),
+        Headers({FORWARDED_HEADER: [str(settings.uaid_index.worker)]}),
+        FileBodyProducer(StringIO(body)) if body else None,
+    )
+
+
+def _forward_failed(err, settings, fallback):
+    settings.metrics.increment("updates.worker.forward_failed")
+    log.failure("Failed to forward to worker", err)
+    return fallback()
+
+
+class WorkerForwarder(object):
+    """Forwards internal routing requests for a client held by another
+    worker of a multi-process node"""
+    def forward_to_worker(self, uaid, fallback):
+        """Forward the request to the other worker holding the client, if
+        any
+
+        :param fallback: Called with the UAID to reply instead if the worker
+                         can't be reached.
+        :returns: A deferred finishing the reply, or None if no other
+                  worker holds the client.
+
+        """
+        if self.request.headers.get(FORWARDED_HEADER):
+            return None
+        return forward_request(self.ap_settings, uaid, self.request.method,
+                               self.request.uri, self.request.body,
+                               self._forwarded, lambda: fallback(uaid))
+
+    def _forwarded(self, response):
+        self.set_status(response.code)
+        return readBody(response).addCallback(self.write)
+
+
+def route_update(settings, uaid, update):
+    """Deliver a notification from an endpoint to a connected client
+
+    :returns: The HTTP status and message of the result.
+
+    """
+    client = settings.clients.get(uaid)
+    if not client:
+        settings.metrics.increment("updates.router.disconnected")
+        return 404, "Client not connected."
+
+    if client.paused:
+        if not client.queue_notifications(update):
+            settings.metrics.increment("updates.router.busy")
+            return 503, "Client busy."
+        settings.metrics.increment("updates.router.queued")
+        return 200, "Client accepted for delivery"
+
+    client.send_notifications(update)
+    settings.metrics.increment("updates.router.received")
+    return 200, "Client accepted for delivery"
+
+
+def check_notifications(settings, uaid):
+    """Start a stored notification check for a connected client
+
+    :returns: The HTTP status and message of the result.
+
+    """
+    client = settings.clients.get(uaid)
+    if not client:
+        pending = settings.pending_hellos.get(uaid)
+        if pending is not None:
+            # Stored before the hello registered the client, which may
+            # have read the record from before the store
+            pending.ps._stored_during_hello = True
+        settings.metrics.increment("updates.notification.disconnected")
+        return 404, "Client not connected."
+
+    if client.paused:
+        # Client already busy waiting for stuff, flag for check once
+        # its output resumes
+        client.ps._check_notifications = True
+        client._defer_notifications()
+        settings.metrics.increment("updates.notification.flagged")
+        return 202, "Flagged for Notification check"
+
+    # Client is online and idle, start a notification check
+    client.process_notifications()
+    settings.metrics.increment("updates.notification.checking")
+    return 200, "Notification check started"
+
+
+def drop_duplicate(settings, uaid, connected_at):
+    """Drop a connected client that has connected to a new node
+
+    :returns: The HTTP status and message of the result.
+
+    """
+    client = settings.clients.get(uaid)
+    if client and client.ps.connected_at == connected_at:
+        client.sendClose()
+        return 200, "Terminated duplicate"
+    return 200, ""
+
+
+class RouterHandler(cyclone.web.RequestHandler, ErrorLogger,
+                    WorkerForwarder):
     """Router Handler
 
     Handles routing a notification to a connected client from an endpoint.
@@ -1289,26 +1958,97 @@ class RouterHandler(cyclone.web.RequestHandler, ErrorLogger):
 
         Attempt delivery of a notification to a connected client.
 
+        """
+        d = self.forward_to_worker(uaid, self._route)
+        if d is not None:
+            return d
+        return self._route(uaid)
+
+    def _route(self, uaid):
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return self.write("Invalid notification.")
+        code, message = route_update(self.ap_settings, uaid, update)
+        if code != 200:
+            self.set_status(code)
+        return self.write(message)
+
+
+class BulkRouterHandler(cyclone.web.RequestHandler, ErrorLogger):
+    """Bulk Router Handler
+
+    Handles routing a batch of notifications to connected clients from an
+    endpoint.
+
+    """
+
+    def post(self):
+        """HTTP Post
+
+        Attempt delivery of each notification of the batch, replying with
+        the HTTP status of each in order. Notifications for clients held by
+        another worker of this node are forwarded to it in a batch of their
+        own. Notifications for clients this node doesn't hold get a 404, for
+        the endpoint to store them.
+
         """
         settings = self.ap_settings
-        client = settings.clients.get(uaid)
-        if not client:
-            self.set_status(404)
-            settings.metrics.increment("updates.router.disconnected")
-            return self.write("Client not connected.")
-
-        if client.paused:
-            self.set_status(503)
-            settings.metrics.increment("updates.router.busy")
-            return self.write("Client busy.")
+        try:
+            batch = json.loads(self.request.body)
+            if not isinstance(batch, list):
+                raise TypeError("Batch is not a list")
+            items = [(item["uaid"], item["update"]) for item in batch]
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            return self.write("Invalid batch.")
+        settings.metrics.increment("updates.router.bulk")
+
+        results = [None] * len(items)
+        by_worker = {}
+        forwarded = self.request.headers.get(FORWARDED_HEADER)
+        for index, (uaid, update) in enumerate(items):
+            worker = None if forwarded else _worker_holding(settings, uaid)
+            if worker is None:
+                results[index] = route_update(settings, uaid, update)[0]
+            else:
+                by_worker.setdefault(worker, []).append(index)
+        if not by_worker:
+            return self.write({"results": results})
+
+        d = DeferredList([
+            self._forward_items(target, indexes, items, results)
+            for target, indexes in by_worker.iteritems()
+        ])
+        d.addCallback(lambda _: self.write({"results": results}))
+        return d
 
-        update = json.loads(self.request.body)
-        client.send_notifications(update)
-        settings.metrics.increment("updates.router.received")
-        return self.write("Client accepted for delivery")
+    def _forward_items(self, worker, indexes, items, results):
+        """Forward the notifications at ``indexes`` to another worker,
+        filling in their statuses"""
+        settings = self.ap_settings
+        body = json.dumps([dict(uaid=items[index][0], update=items[index][1])
+                           for index in indexes])
+
+        def forwarded(reply):
+            for index, code in zip(indexes, reply["results"]):
+                results[index] = code
+
+        def fallback():
+            for index in indexes:
+                results[index] = route_update(settings, *items[index])[0]
+
+        d = _send_to_worker(settings, worker, "POST", self.request.uri, body)
+        d.addCallback(readBody)
+        d.addCallback(json.loads)
+        d.addCallback(forwarded)
+        d.addErrback(_forward_failed, settings, fallback)
+        return d
 
 
-class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
+class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger,
+                          WorkerForwarder):
 
     def put(self, uaid, *args):
         """HTTP Put
@@ -1317,24 +2057,16 @@ class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
         notifications.
 
         """
-        client = self.ap_settings.clients.get(uaid)
-        settings = self.ap_settings
-        if not client:
-            self.set_status(404)
-            settings.metrics.increment("updates.notification.disconnected")
-            return self.write("Client not connected.")
-
-        if client.paused:
-            # Client already busy waiting for stuff, flag for check
-            client._check_notifications = True
-            self.set_status(202)
-            settings.metrics.increment("updates.notification.flagged")
-            return self.write("Flagged for Notification check")
-
-        # Client is online and idle, start a notification check
-        client.process_notifications()
-        settings.metrics.increment("updates.notification.checking")
-        self.write("Notification check started")
+        d = self.forward_to_worker(uaid, self._check)
+        if d is not None:
+            return d
+        return self._check(uaid)
+
+    def _check(self, uaid):
+        code, message = check_notifications(self.ap_settings, uaid)
+        if code != 200:
+            self.set_status(code)
+        return self.write(message)
 
     def delete(self, uaid, ignored, connectionTime):
         """HTTP Delete
@@ -1342,10 +2074,61 @@ class NotificationHandler(cyclone.web.RequestHandler, ErrorLogger):
         Drop a connected client as the client has connected to a new node.
 
         """
-        client = self.ap_settings.clients.get(uaid)
-        if client and client.ps.connected_at == int(connectionTime):
-            client.sendClose()
-            return self.write("Terminated duplicate")
+        _, message = drop_duplicate(self.ap_settings, uaid,
+                                    int(connectionTime))
+        return self.write(message)
+
+
+class ChannelServerProtocol(ChannelProtocol):
+    """Handles internal routing requests sent over a node's binary channel
+
+    Each request is handled as its HTTP endpoint would, and answered with
+    the HTTP status the endpoint would reply with.
+
+    """
+    ap_settings = None
+
+    def frameReceived(self, request_id, command, body):
+        settings = self.ap_settings
+        try:
+            uaid, args = decode_uaid(body)
+            if command == PUSH:
+                update = json.loads(args)
+                request = ("PUT", "/push/" + uaid, args,
+                           lambda: route_update(settings, uaid, update)[0])
+            elif command == CHECK:
+                request = ("PUT", "/notif/" + uaid, None,
+                           lambda: check_notifications(settings, uaid)[0])
+            elif command == DISCONNECT:
+                connected_at = CONNECTED_AT.unpack(args)[0]
+                request = ("DELETE",
+                           "/notif/%s/%s" % (uaid, connected_at), None,
+                           lambda: drop_duplicate(settings, uaid,
+                                                  connected_at)[0])
+            else:
+                raise ValueError("Unknown command %r" % command)
+        except (IndexError, ValueError, struct.error) as exc:
+            self.log.info("Dropping channel with an invalid request: {exc}",
+                          exc=exc)
+            self.transport.loseConnection()
+            return
+
+        method, path, args, handle = request
+        d = forward_request(settings, uaid, method, path, args,
+                            self._forwarded, handle)
+        if d is None:
+            self._reply(handle(), request_id)
+            return
+        d.addCallback(self._reply, request_id)
+
+    def _forwarded(self, response):
+        d = IgnoreBody.ignore(response)
+        d.addCallback(lambda response: response.code)
+        return d
+
+    def _reply(self, code, request_id):
+        if self.transport.connected:
+            self.sendFrame(request_id, RESULT, STATUS.pack(code))
 
 
 class DefaultResource(Resource):
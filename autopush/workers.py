@@ -0,0 +1,209 @@
+"""Multi-process connection nodes
+
+A connection node runs a single reactor, so it only uses one core. With
+``workers`` set, :func:`spawn_workers` forks that many worker processes,
+which each listen on the websocket port with ``SO_REUSEPORT`` so the kernel
+spreads incoming clients across them. Every worker runs its own internal
+router on the router port plus its worker number, and registers that as the
+node of its clients.
+
+Routing requests for a client that moved between workers of the same host
+can still arrive at the wrong worker, from a stale router cache. The
+:class:`UAIDIndex` shared by the workers lets that worker forward the request
+to the one holding the client.
+
+"""
+import errno
+import mmap
+import os
+import signal
+import socket
+import uuid
+
+from twisted.logger import Logger
+
+# Linux value, Python 2 doesn't always expose it
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+SLOT_SIZE = 16
+EMPTY = b"\x00" * SLOT_SIZE
+DELETED = b"\xff" * SLOT_SIZE
+
+log = Logger()
+
+
+class UAIDIndex(object):
+    """Shared memory index of the UAIDs connected to each worker
+
+    Each worker has its own open addressing hash table in a shared anonymous
+    mmap, created before the workers are forked. Only a worker writes to its
+    table, and the others read it to find which worker holds a UAID. A read
+    racing a write may miss a UAID, so the index is only a hint and a miss
+    falls back to treating the client as not connected.
+
+    """
+    def __init__(self, workers, slots=262144):
+        """Create a new UAIDIndex
+
+        :param workers: Number of workers sharing the index.
+        :param slots: UAIDs each worker's table holds, keep this above twice
+                      the clients a worker holds.
+
+        """
+        self.workers = workers
+        self.slots = slots
+        self.worker = None
+        self.mm = mmap.mmap(-1, workers * slots * SLOT_SIZE)
+        # Slots of the worker's table holding a UAID or a deletion
+        self._used = 0
+        # Slots of the worker's table holding a deletion
+        self._deleted = 0
+
+    def claim(self, worker):
+        """Take over a worker's table, in that worker's process"""
+        self.worker = worker
+        self._clear()
+
+    def add(self, uaid):
+        """Record a UAID as connected to this worker
+
+        :returns: False if the worker's table is full.
+
+        """
+        key = uuid.UUID(uaid).bytes
+        if self._used >= self.slots * 3 / 4:
+            # Only a table with deletions in it has anything to reclaim
+            if self._deleted:
+                self._compact()
+            if self._used >= self.slots * 3 / 4:
+                return False
+        self._insert(key)
+        return True
+
+    def _insert(self, key):
+        free = None
+        for offset in self._probe(self.worker, key):
+            slot = self.mm[offset:offset + SLOT_SIZE]
+            if slot == key:
+                return
+            if slot == DELETED and free is None:
+                free = offset
+            elif slot == EMPTY:
+                if free is None:
+                    free = offset
+                    self._used += 1
+                break
+        if self.mm[free:free + SLOT_SIZE] == DELETED:
+            self._deleted -= 1
+        self.mm[free:free + SLOT_SIZE] = key
+
+    def remove(self, uaid):
+        """Remove a UAID no longer connected to this worker"""
+        key = uuid.UUID(uaid).bytes
+        offset = self._find(self.worker, key)
+        if offset is not None:
+            self.mm[offset:offset + SLOT_SIZE] = DELETED
+            self._deleted += 1
+
+    def find(self, uaid):
+        """Return the other worker a UAID is connected to, if any"""
+        key = uuid.UUID(uaid).bytes
+        for worker in xrange(self.workers):
+            if worker == self.worker:
+                continue
+            if self._find(worker, key) is not None:
+                return worker
+        return None
+
+    def _probe(self, worker, key):
+        """Offsets of the slots to look in for a key, in order"""
+        start = worker * self.slots * SLOT_SIZE
+        slot = int(key[:8].encode("hex"), 16) % self.slots
+        for _ in xrange(self.slots):
+            yield start + slot * SLOT_SIZE
+            slot = (slot + 1) % self.slots
+
+    def _find(self, worker, key):
+        for offset in self._probe(worker, key):
+            slot = self.mm[offset:offset + SLOT_SIZE]
+            if slot == key:
+                return offset
+            if slot == EMPTY:
+                return None
+        return None
+
+    def _clear(self):
+        start = self.worker * self.slots * SLOT_SIZE
+        self.mm[start:start + self.slots * SLOT_SIZE] = \
+            EMPTY * self.slots
+        self._used = 0
+        self._deleted = 0
+
+    def _compact(self):
+        """Rebuild the worker's table without its deletions"""
+        start = self.worker * self.slots * SLOT_SIZE
+        table = self.mm[start:start + self.slots * SLOT_SIZE]
+        self._clear()
+        for i in xrange(0, len(table), SLOT_SIZE):
+            key = table[i:i + SLOT_SIZE]
+            if key != EMPTY and key != DELETED:
+                self._insert(key)
+
+
+def reuseport_socket(port, interface="", backlog=50):
+    """Return a listening TCP socket bound with ``SO_REUSEPORT``, for
+    :meth:`IReactorSocket.adoptStreamPort`"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    return sock
+
+
+def spawn_workers(count):
+    """Fork ``count`` worker processes, and supervise them
+
+    Returns the worker number in each worker. In the supervisor it returns
+    None once every worker has exited. Workers that fail are restarted,
+    until the supervisor is sent ``SIGTERM``, ``SIGINT`` or ``SIGUSR1``,
+    which it passes on to the workers.
+
+    """
+    pids = {}
+    for worker in range(count):
+        pid = os.fork()
+        if pid == 0:
+            return worker
+        pids[pid] = worker
+
+    stopping = []
+
+    def forward(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:  # pragma: nocover
+                pass
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
+        signal.signal(signum, forward)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            raise  # pragma: nocover
+        worker = pids.pop(pid, None)
+        if worker is None or status == 0 or stopping:
+            continue
+        log.error("Worker {worker} exited with status {status}, "
+                  "restarting", worker=worker, status=status)
+        pid = os.fork()
+        if pid == 0:
+            return worker
+        pids[pid] = worker
+    return None